@@ -1,30 +1,37 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update
 from telegram.ext import ContextTypes
-import asyncio
 import logging
-from telegram.error import TelegramError, Forbidden, BadRequest
-from database import load_users, update_blocked_status
+from database import run_db, count_recipients_async, create_broadcast_job, set_broadcast_status_message, set_broadcast_job_status, resume_broadcast_job, list_broadcast_jobs
+from broadcast_jobs import wake_workers, stop_job_locally, load_job, edit_job_status, format_final_report, BROADCAST_CHUNK_SIZE
 
 # Налаштування логування
 logger = logging.getLogger(__name__)
 
+# Ваш Telegram ID для доступу до команд розсилки
+ADMIN_ID = 293102975
+
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /broadcast: розсилає повідомлення з текстом, картинкою, кнопкою або просто текстом."""
     user_id = update.message.from_user.id
-    # Ваш Telegram ID для доступу до команди /broadcast
-    admin_id = 293102975
     
     # Перевіряємо, чи користувач є адміністратором
-    if user_id != admin_id:
+    if user_id != ADMIN_ID:
         await update.message.reply_text("Ця команда доступна лише адміністратору!")
         return
 
+    # Режим копіювання: команда надіслана у відповідь на підготовлене повідомлення
+    if update.message.reply_to_message is not None:
+        await broadcast_copy(update, context)
+        return
+
     # Перевіряємо аргументи
     if not context.args:
         await update.message.reply_text(
             "Використання:\n"
             "1. Простий текст: /broadcast <текст> [all]\n"
-            "2. З картинкою: /broadcast <текст> <URL_картинки> <текст_кнопки> <URL_посилання> [all]\n\n"
+            "2. З картинкою: /broadcast <текст> <URL_картинки> <текст_кнопки> <URL_посилання> [all]\n"
+            "3. Будь-яке повідомлення (фото, відео, форматування): підготуйте його в цьому чаті та "
+            "відповідайте на нього командою /broadcast [текст_кнопки URL_посилання] [all]\n\n"
             "Приклади:\n"
             "• /broadcast Привіт, це тест!\n"
             "• /broadcast Привіт, це тест! all\n"
@@ -84,128 +91,162 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Помилка: не вказано текст для розсилки! (знайдено тільки 'all')")
             return
 
-        # Завантажуємо список користувачів
-        users = load_users(subscribed_only=not send_to_all)
-        if not users:
+        # Рахуємо отримувачів (дешево завдяки частковому індексу); сам список читається потоком
+        total = await count_recipients_async(subscribed_only=not send_to_all)
+        if total == 0:
             status_text = "всіх" if send_to_all else "підписаних"
             await update.message.reply_text(f"Список користувачів порожній або немає {status_text} користувачів!")
             return
-
-        status_message = await update.message.reply_text(f"🚀 Розпочинаю розсилку для {len(users)} користувачів...")
-
-        # Лічильники
-        sent_count = 0
-        blocked_count = 0
-        error_count = 0
+        total_text = str(total) if total is not None else "?"
 
         # Перевіряємо тип розсилки
         if len(args) == 4:
             # Повна розсилка з картинкою та кнопкою
             text, image_url, button_text, button_url = args
-            logger.info(f"Розпочинаємо повну розсилку з картинкою для {len(users)} користувачів")
-
-            # Створюємо інлайн-кнопку з URL
-            keyboard = [[InlineKeyboardButton(button_text, url=button_url)]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            for i, user_id in enumerate(users):
-                try:
-                    await context.bot.send_photo(
-                        chat_id=user_id,
-                        photo=image_url,
-                        caption=text,
-                        reply_markup=reply_markup
-                    )
-                    sent_count += 1
-                    logger.info(f"Повідомлення з картинкою надіслано користувачу {user_id}")
-                    
-                    # Оновлюємо статус кожні 50 повідомлень
-                    if (i + 1) % 50 == 0:
-                        await status_message.edit_text(
-                            f"📤 Надіслано: {sent_count}/{len(users)}\n"
-                            f"❌ Заблоковано: {blocked_count}\n"
-                            f"⚠️ Помилок: {error_count}"
-                        )
-                    
-                    # Затримка для запобігання rate limit
-                    await asyncio.sleep(0.1)
-                    
-                except Forbidden:
-                    blocked_count += 1
-                    logger.warning(f"Користувач {user_id} заблокував бота")
-                    update_blocked_status(user_id, True)
-                except BadRequest as e:
-                    if "chat not found" in str(e).lower():
-                        blocked_count += 1
-                        logger.warning(f"Чат з користувачем {user_id} не знайдено")
-                        update_blocked_status(user_id, True)
-                    else:
-                        error_count += 1
-                        logger.error(f"BadRequest для користувача {user_id}: {e}")
-                except TelegramError as e:
-                    error_count += 1
-                    logger.error(f"TelegramError для користувача {user_id}: {e}")
-                except Exception as e:
-                    error_count += 1
-                    logger.error(f"Невідома помилка для користувача {user_id}: {e}")
+            payload = {
+                'kind': 'photo',
+                'text': text,
+                'image_url': image_url,
+                'button_text': button_text,
+                'button_url': button_url,
+            }
+            logger.info(f"Розпочинаємо повну розсилку з картинкою для {total_text} користувачів")
         else:
             # Простий текст
             if len(args) > 1 and len(args) != 4:
                 text = full_text  # Використовуємо повний текст для складних повідомлень
             else:
                 text = args[0] if args else full_text
-            
-            logger.info(f"Розпочинаємо розсилку тексту: '{text[:50]}...' для {len(users)} користувачів")
-            
-            for i, user_id in enumerate(users):
-                try:
-                    await context.bot.send_message(chat_id=user_id, text=text)
-                    sent_count += 1
-                    logger.info(f"Текст надіслано користувачу {user_id}")
-                    
-                    # Оновлюємо статус кожні 50 повідомлень
-                    if (i + 1) % 50 == 0:
-                        await status_message.edit_text(
-                            f"📤 Надіслано: {sent_count}/{len(users)}\n"
-                            f"❌ Заблоковано: {blocked_count}\n"
-                            f"⚠️ Помилок: {error_count}"
-                        )
-                    
-                    # Затримка для запобігання rate limit
-                    await asyncio.sleep(0.1)
-                    
-                except Forbidden:
-                    blocked_count += 1
-                    logger.warning(f"Користувач {user_id} заблокував бота")
-                    update_blocked_status(user_id, True)
-                except BadRequest as e:
-                    if "chat not found" in str(e).lower():
-                        blocked_count += 1
-                        logger.warning(f"Чат з користувачем {user_id} не знайдено")
-                        update_blocked_status(user_id, True)
-                    else:
-                        error_count += 1
-                        logger.error(f"BadRequest для користувача {user_id}: {e}")
-                except TelegramError as e:
-                    error_count += 1
-                    logger.error(f"TelegramError для користувача {user_id}: {e}")
-                except Exception as e:
-                    error_count += 1
-                    logger.error(f"Невідома помилка для користувача {user_id}: {e}")
-
-        # Фінальний звіт
-        final_message = (
-            f"✅ Розсилка завершена!\n\n"
-            f"👥 Всього користувачів: {len(users)}\n"
-            f"📤 Успішно надіслано: {sent_count}\n"
-            f"❌ Заблоковано боту: {blocked_count}\n"
-            f"⚠️ Помилок: {error_count}\n\n"
-            f"📊 Успішність: {(sent_count/len(users)*100):.1f}%" if users else "📊 Успішність: 0%"
-        )
-        
-        await status_message.edit_text(final_message)
-        logger.info(f"Розсилка завершена. Надіслано: {sent_count}, Заблоковано: {blocked_count}, Помилок: {error_count}")
-        
+            payload = {'kind': 'text', 'text': text}
+            logger.info(f"Розпочинаємо розсилку тексту: '{text[:50]}...' для {total_text} користувачів")
+
+        await _start_broadcast(update, payload, send_to_all, total)
+
+    except Exception as e:
+        logger.error(f"Критична помилка при розсилці: {e}")
+        await update.message.reply_text(f"❌ Критична помилка: {e}")
+
+# Створення розсилки в БД і сигнал воркерам
+async def _start_broadcast(update: Update, payload, send_to_all, total):
+    total_text = str(total) if total is not None else "?"
+    # Зберігаємо розсилку в БД частинами; їх розбирають воркери (у цьому та інших процесах),
+    # тож розсилка не займає обробник і продовжується після перезапуску
+    job_id = await run_db(create_broadcast_job, payload, not send_to_all, update.effective_chat.id, total, BROADCAST_CHUNK_SIZE)
+    if job_id is None:
+        await update.message.reply_text("❌ Не вдалося створити розсилку. Спробуйте ще раз.")
+        return
+    status_message = await update.message.reply_text(
+        f"🚀 Розпочинаю розсилку #{job_id} для {total_text} користувачів...\n"
+        f"Пауза: /broadcast_pause {job_id}, скасування: /broadcast_cancel {job_id}"
+    )
+    await run_db(set_broadcast_status_message, job_id, status_message.message_id)
+    wake_workers()
+
+# Розсилка копії підготовленого повідомлення
+async def broadcast_copy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/broadcast у відповідь на повідомлення: розсилає його копію через copy_message.
+
+    Telegram копіює повідомлення на своєму боці, тож медіа не завантажується повторно для
+    кожного отримувача, а форматування зберігається. Повідомлення-оригінал не можна видаляти,
+    поки розсилка не завершиться.
+    """
+    try:
+        words = list(context.args or [])
+        send_to_all = bool(words) and words[-1].lower() == 'all'
+        if send_to_all:
+            words = words[:-1]
+        payload = {
+            'kind': 'copy',
+            'from_chat_id': update.effective_chat.id,
+            'message_id': update.message.reply_to_message.message_id,
+        }
+        if words:
+            # Необов'язкова кнопка: "<текст кнопки> <URL>"
+            if len(words) < 2 or not words[-1].startswith(('http://', 'https://', 'tg://')):
+                await update.message.reply_text(
+                    "Помилка: кнопка задається як /broadcast <текст_кнопки> <URL_посилання> [all] у відповідь на повідомлення"
+                )
+                return
+            payload['button_text'] = ' '.join(words[:-1])
+            payload['button_url'] = words[-1]
+
+        total = await count_recipients_async(subscribed_only=not send_to_all)
+        if total == 0:
+            status_text = "всіх" if send_to_all else "підписаних"
+            await update.message.reply_text(f"Список користувачів порожній або немає {status_text} користувачів!")
+            return
+        logger.info(f"Розпочинаємо розсилку копії повідомлення {payload['message_id']} для {total} користувачів")
+        await _start_broadcast(update, payload, send_to_all, total)
     except Exception as e:
         logger.error(f"Критична помилка при розсилці: {e}")
         await update.message.reply_text(f"❌ Критична помилка: {e}")
+
+
+# Розбір id розсилки з аргументів команди керування
+async def _job_from_args(update: Update, context: ContextTypes.DEFAULT_TYPE, command):
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("Ця команда доступна лише адміністратору!")
+        return None
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text(f"Використання: /{command} <id_розсилки>")
+        return None
+    job = await load_job(int(context.args[0]))
+    if job is None:
+        await update.message.reply_text(f"Розсилку #{context.args[0]} не знайдено")
+    return job
+
+async def broadcast_pause(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /broadcast_pause <id>: призупиняє розсилку зі збереженням прогресу."""
+    job = await _job_from_args(update, context, "broadcast_pause")
+    if job is None:
+        return
+    if not await run_db(set_broadcast_job_status, job['id'], 'paused', ('running',)):
+        await update.message.reply_text(f"Розсилку #{job['id']} не можна призупинити (статус: {job['status']})")
+        return
+    stop_job_locally(job['id'], 'paused')
+    await update.message.reply_text(f"⏸ Розсилку #{job['id']} призупинено. Відновити: /broadcast_resume {job['id']}")
+
+async def broadcast_resume(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /broadcast_resume <id>: продовжує розсилку з контрольних точок."""
+    job = await _job_from_args(update, context, "broadcast_resume")
+    if job is None:
+        return
+    status = await run_db(resume_broadcast_job, job['id'])
+    if status is None:
+        await update.message.reply_text(f"Розсилку #{job['id']} не можна відновити (статус: {job['status']})")
+        return
+    if status == 'done':
+        # Усі частини вже були розіслані до паузи — відновлювати нічого, розсилку завершено
+        job = await load_job(job['id']) or job
+        await edit_job_status(context.bot, job, format_final_report(job))
+        await update.message.reply_text(f"✅ Розсилку #{job['id']} завершено: усі частини вже розіслано")
+        return
+    wake_workers()
+    await update.message.reply_text(f"▶️ Розсилку #{job['id']} відновлено")
+
+async def broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /broadcast_cancel <id>: скасовує розсилку."""
+    job = await _job_from_args(update, context, "broadcast_cancel")
+    if job is None:
+        return
+    if not await run_db(set_broadcast_job_status, job['id'], 'cancelled', ('running', 'paused')):
+        await update.message.reply_text(f"Розсилку #{job['id']} не можна скасувати (статус: {job['status']})")
+        return
+    stop_job_locally(job['id'], 'cancelled')
+    await update.message.reply_text(f"🛑 Розсилку #{job['id']} скасовано")
+
+async def broadcast_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /broadcast_jobs: останні розсилки та їхній стан."""
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("Ця команда доступна лише адміністратору!")
+        return
+    jobs = await run_db(list_broadcast_jobs, None, 10)
+    if not jobs:
+        await update.message.reply_text("Розсилок ще не було")
+        return
+    lines = [
+        f"#{job['id']} [{job['status']}] надіслано {job['sent']}/{job['total'] if job['total'] is not None else '?'}, "
+        f"заблоковано {job['blocked']}, помилок {job['errors']}"
+        for job in jobs
+    ]
+    await update.message.reply_text("Останні розсилки:\n\n" + "\n".join(lines))
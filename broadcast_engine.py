@@ -0,0 +1,363 @@
+import os
+import asyncio
+import logging
+from collections import deque
+from telegram.error import TelegramError, Forbidden, BadRequest, RetryAfter
+from metrics import broadcast_messages, broadcast_throttled, broadcast_rate
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Параметри розсилки
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))  # кількість паралельних відправників
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # початкова швидкість, повідомлень на секунду для всього бота
+BROADCAST_MIN_RATE = float(os.getenv("BROADCAST_MIN_RATE", "1"))  # нижче цього AIMD швидкість не знижує
+BROADCAST_MAX_RATE = float(os.getenv("BROADCAST_MAX_RATE", "30"))  # вище цього не піднімає (ліміт Telegram ~30/с)
+BROADCAST_RATE_INCREASE = float(os.getenv("BROADCAST_RATE_INCREASE", "1"))  # +N повідомлень/с після кожної секунди без обмежень
+BROADCAST_RATE_DECREASE = float(os.getenv("BROADCAST_RATE_DECREASE", "0.5"))  # множник швидкості після RetryAfter
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "5"))  # скільки разів повторювати користувача після RetryAfter
+BROADCAST_PER_CHAT_INTERVAL = float(os.getenv("BROADCAST_PER_CHAT_INTERVAL", "1.0"))  # мінімальний інтервал між повідомленнями в один чат
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))  # як часто оновлювати повідомлення зі статусом
+BLOCKED_BATCH_SIZE = int(os.getenv("BLOCKED_BATCH_SIZE", "500"))  # записуємо заблокованих пачками такого розміру
+BLOCKED_FLUSH_INTERVAL = float(os.getenv("BLOCKED_FLUSH_INTERVAL", "5"))  # або щонайпізніше через стільки секунд
+
+
+class TokenBucket:
+    """Глобальний ліміт швидкості: rate токенів на секунду, не більше capacity накопичених."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = None
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    @property
+    def paused(self):
+        return asyncio.get_running_loop().time() < self._paused_until
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self._tokens = min(self._tokens, self.capacity)
+
+    def pause(self, seconds):
+        """Зупиняє видачу токенів на seconds (наприклад, після RetryAfter)."""
+        now = asyncio.get_running_loop().time()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0.0
+
+    def _refill(self, now):
+        if self._updated is not None:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            while True:
+                now = loop.time()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    self._updated = loop.time()
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class PerChatLimiter:
+    """Не частіше одного повідомлення в чат за interval секунд."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._next_allowed = {}
+
+    async def acquire(self, chat_id):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        allowed_at = max(now, self._next_allowed.get(chat_id, now))
+        self._next_allowed[chat_id] = allowed_at + self.interval
+        if len(self._next_allowed) > 10000:
+            # Прибираємо чати, для яких обмеження вже минуло
+            self._next_allowed = {cid: t for cid, t in self._next_allowed.items() if t > now}
+        if allowed_at > now:
+            await asyncio.sleep(allowed_at - now)
+
+
+class BlockedUserBatcher:
+    """Збирає заблокованих під час розсилки користувачів і записує їх пачками.
+
+    flush(user_ids) — корутина, що записує пачку (один UPDATE ... WHERE user_id = ANY(...)).
+    add() не чекає на БД: запис відбувається у фоновій задачі за розміром пачки
+    або за інтервалом, а stop() дописує залишок.
+    """
+
+    def __init__(self, flush, batch_size=BLOCKED_BATCH_SIZE, flush_interval=BLOCKED_FLUSH_INTERVAL):
+        self._flush = flush
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+    async def add(self, user_id):
+        self._pending.append(user_id)
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self):
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    async def flush(self):
+        if not self._pending:
+            return
+        user_ids, self._pending = self._pending, []
+        if not await self._flush(user_ids):
+            logger.error(f"Не вдалося записати {len(user_ids)} заблокованих користувачів")
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Помилка запису заблокованих користувачів: {e}")
+        await self.flush()
+
+
+class BroadcastStats:
+    """Лічильники розсилки: надіслано / заблоковано / помилки."""
+
+    def __init__(self, total=None):
+        self.total = total
+        self.sent = 0
+        self.blocked = 0
+        self.errors = 0
+        self.throttled = 0  # кількість відповідей RetryAfter
+        self.rate = 0.0  # поточна швидкість, повідомлень/с
+
+    @property
+    def processed(self):
+        return self.sent + self.blocked + self.errors
+
+
+class BroadcastEngine:
+    """Паралельна розсилка з глобальним token bucket та лімітом на чат.
+
+    Швидкість підбирається за AIMD: після кожної секунди успішних відправок вона
+    зростає на rate_increase, а після RetryAfter множиться на rate_decrease, і відправка
+    призупиняється на retry_after секунд. Користувачі, що отримали RetryAfter,
+    повертаються в чергу (не більше max_retries разів).
+
+    Отримувачі читаються з асинхронного ітератора через обмежену чергу, тож
+    довжина списку не впливає на пам'ять. total — кількість для звіту, якщо відома.
+
+    send(chat_id) — корутина, що надсилає повідомлення одному користувачу.
+    on_blocked(chat_id) — корутина, що викликається, коли користувач заблокував бота
+    або чат не знайдено. on_result(chat_id, outcome) — синхронний виклик з остаточним
+    результатом ('sent' / 'blocked' / 'error'). on_progress(stats) — періодичне оновлення статусу.
+    stop() зупиняє розсилку: воркери дообробляють поточні повідомлення й виходять.
+    """
+
+    def __init__(self, send, on_blocked=None, on_progress=None, on_result=None,
+                 workers=BROADCAST_WORKERS, rate=BROADCAST_RATE,
+                 min_rate=BROADCAST_MIN_RATE, max_rate=BROADCAST_MAX_RATE,
+                 rate_increase=BROADCAST_RATE_INCREASE, rate_decrease=BROADCAST_RATE_DECREASE,
+                 max_retries=BROADCAST_MAX_RETRIES,
+                 per_chat_interval=BROADCAST_PER_CHAT_INTERVAL,
+                 progress_interval=BROADCAST_PROGRESS_INTERVAL):
+        self.send = send
+        self.on_blocked = on_blocked
+        self.on_progress = on_progress
+        self.on_result = on_result
+        self.workers = workers
+        self.progress_interval = progress_interval
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_increase = rate_increase
+        self.rate_decrease = rate_decrease
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(min(max(rate, min_rate), max_rate))
+        self.chat_limiter = PerChatLimiter(per_chat_interval)
+        self.stats = BroadcastStats()
+        self._retry = deque()
+        self._attempts = {}
+        self._successes_since_increase = 0
+        self._stopping = False
+
+    @property
+    def stopped(self):
+        return self._stopping
+
+    def stop(self):
+        self._stopping = True
+
+    async def run(self, recipients, total=None):
+        self.stats = BroadcastStats(total=total)
+        self.stats.rate = self.bucket.rate
+        broadcast_rate.set(self.bucket.rate)
+        queue = asyncio.Queue(maxsize=self.workers * 4)
+        producer = asyncio.create_task(self._produce(recipients, queue))
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.workers)]
+        reporter = asyncio.create_task(self._report_progress()) if self.on_progress else None
+        try:
+            await asyncio.gather(*workers)
+            # Воркери могли зупинитися раніше за producer (stop()) — тоді він чекає на put
+            producer.cancel()
+            try:
+                await producer
+            except asyncio.CancelledError:
+                pass
+        finally:
+            for task in [producer, *workers]:
+                task.cancel()
+            if reporter is not None:
+                reporter.cancel()
+        return self.stats
+
+    async def _produce(self, recipients, queue):
+        try:
+            if hasattr(recipients, "__aiter__"):
+                async for user_id in recipients:
+                    if self._stopping:
+                        break
+                    await queue.put(user_id)
+            else:
+                for user_id in recipients:
+                    if self._stopping:
+                        break
+                    await queue.put(user_id)
+        finally:
+            # По одному сигналу завершення на кожного воркера
+            for _ in range(self.workers):
+                await queue.put(None)
+
+    async def _worker(self, queue):
+        while not self._stopping:
+            if self._retry:
+                user_id = self._retry.popleft()
+            else:
+                user_id = await queue.get()
+                if user_id is None:
+                    break
+            await self._deliver(user_id)
+        # Дообробляємо повтори, що лишились після завершення черги
+        while self._retry and not self._stopping:
+            await self._deliver(self._retry.popleft())
+
+    async def _deliver(self, user_id):
+        await self.bucket.acquire()
+        await self.chat_limiter.acquire(user_id)
+        try:
+            await self.send(user_id)
+            self._record(user_id, 'sent')
+            self._on_success()
+            logger.debug(f"Повідомлення надіслано користувачу {user_id}")
+        except RetryAfter as e:
+            self._on_throttled(user_id, e)
+        except Forbidden:
+            self._record(user_id, 'blocked')
+            logger.warning(f"Користувач {user_id} заблокував бота")
+            await self._mark_blocked(user_id)
+        except BadRequest as e:
+            if "chat not found" in str(e).lower():
+                self._record(user_id, 'blocked')
+                logger.warning(f"Чат з користувачем {user_id} не знайдено")
+                await self._mark_blocked(user_id)
+            else:
+                self._record(user_id, 'error')
+                logger.error(f"BadRequest для користувача {user_id}: {e}")
+        except TelegramError as e:
+            self._record(user_id, 'error')
+            logger.error(f"TelegramError для користувача {user_id}: {e}")
+        except Exception as e:
+            self._record(user_id, 'error')
+            logger.error(f"Невідома помилка для користувача {user_id}: {e}")
+
+    def _record(self, user_id, outcome):
+        self._attempts.pop(user_id, None)
+        if outcome == 'sent':
+            self.stats.sent += 1
+        elif outcome == 'blocked':
+            self.stats.blocked += 1
+        else:
+            self.stats.errors += 1
+        broadcast_messages.inc(outcome=outcome)
+        if self.on_result is not None:
+            self.on_result(user_id, outcome)
+
+    def _on_success(self):
+        # Additive increase: після ~секунди відправок без обмежень трохи пришвидшуємось
+        self._successes_since_increase += 1
+        if self._successes_since_increase >= self.bucket.rate and self.bucket.rate < self.max_rate:
+            self._successes_since_increase = 0
+            self._set_rate(min(self.max_rate, self.bucket.rate + self.rate_increase))
+
+    def _on_throttled(self, user_id, error):
+        retry_after = error.retry_after
+        retry_after = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+        self.stats.throttled += 1
+        broadcast_throttled.inc()
+        # Multiplicative decrease — один раз на вікно обмеження, а не для кожного воркера,
+        # що отримав RetryAfter одночасно
+        if not self.bucket.paused:
+            self._set_rate(max(self.min_rate, self.bucket.rate * self.rate_decrease))
+            logger.warning(f"RetryAfter {retry_after}s, знижуємо швидкість розсилки до {self.bucket.rate:.1f}/с")
+        self._successes_since_increase = 0
+        self.bucket.pause(retry_after)
+        attempts = self._attempts.get(user_id, 0) + 1
+        if attempts > self.max_retries:
+            self._attempts.pop(user_id, None)
+            self._record(user_id, 'error')
+            logger.error(f"Користувач {user_id} пропущений після {self.max_retries} повторів через RetryAfter")
+            return
+        self._attempts[user_id] = attempts
+        self._retry.append(user_id)
+
+    def set_max_rate(self, max_rate):
+        """Змінює стелю швидкості (частка глобального ліміту, коли воркерів кілька)."""
+        self.max_rate = max(self.min_rate, max_rate)
+        if self.bucket.rate > self.max_rate:
+            self._set_rate(self.max_rate)
+
+    def _set_rate(self, rate):
+        self.bucket.set_rate(rate)
+        self.stats.rate = rate
+        broadcast_rate.set(rate)
+
+    async def _mark_blocked(self, user_id):
+        if self.on_blocked is None:
+            return
+        try:
+            await self.on_blocked(user_id)
+        except Exception as e:
+            logger.error(f"Не вдалося позначити користувача {user_id} заблокованим: {e}")
+
+    async def _report_progress(self):
+        last_processed = 0
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            if self.stats.processed == last_processed:
+                continue
+            last_processed = self.stats.processed
+            try:
+                await self.on_progress(self.stats)
+            except Exception as e:
+                logger.warning(f"Не вдалося оновити статус розсилки: {e}")
@@ -0,0 +1,474 @@
+import os
+import socket
+import uuid
+import asyncio
+import logging
+from collections import deque
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from database import (
+    run_db,
+    iter_recipients,
+    mark_users_blocked_async,
+    get_broadcast_job,
+    list_broadcast_jobs,
+    claim_broadcast_chunk,
+    save_chunk_progress,
+    release_broadcast_chunk,
+    complete_broadcast_chunk,
+    heartbeat_broadcast_worker,
+    remove_broadcast_worker,
+    get_broadcast_rate,
+    set_broadcast_file_id,
+)
+from broadcast_engine import BroadcastEngine, BlockedUserBatcher, BROADCAST_RATE, BROADCAST_MAX_RATE, BROADCAST_PROGRESS_INTERVAL
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Як часто зберігати контрольну точку частини (і перевіряти паузу/скасування та оренду)
+BROADCAST_CHECKPOINT_INTERVAL = float(os.getenv("BROADCAST_CHECKPOINT_INTERVAL", "2"))
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "5000"))  # отримувачів в одній частині
+BROADCAST_LEASE_SECONDS = int(os.getenv("BROADCAST_LEASE_SECONDS", "60"))  # після цього частину впалого воркера бере інший
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", "5"))  # як часто шукати нові частини без сигналу
+BROADCAST_HEARTBEAT_INTERVAL = float(os.getenv("BROADCAST_HEARTBEAT_INTERVAL", "10"))  # пульс воркера для поділу ліміту
+BROADCAST_FINAL_SAVE_ATTEMPTS = 3  # спроб записати останню контрольну точку перед завершенням частини
+BROADCAST_INPROCESS_WORKER = os.getenv("BROADCAST_INPROCESS_WORKER", "1") == "1"  # чи розсилати також з процесу бота
+
+
+# Відправник для збереженого payload розсилки.
+# on_file_id(file_id) викликається один раз, коли фото за URL вперше завантажено в Telegram:
+# далі всім отримувачам надсилається лише file_id, без повторного завантаження URL.
+def build_sender(bot, payload, on_file_id=None):
+    kind = payload.get('kind')
+    reply_markup = None
+    if payload.get('button_text') and payload.get('button_url'):
+        keyboard = [[InlineKeyboardButton(payload['button_text'], url=payload['button_url'])]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+    if kind == 'copy':
+        async def send(chat_id):
+            await bot.copy_message(
+                chat_id=chat_id,
+                from_chat_id=payload['from_chat_id'],
+                message_id=payload['message_id'],
+                reply_markup=reply_markup
+            )
+        return send
+    if kind == 'photo':
+        photo = {'value': payload.get('file_id') or payload['image_url']}
+
+        async def send(chat_id):
+            message = await bot.send_photo(
+                chat_id=chat_id,
+                photo=photo['value'],
+                caption=payload['text'],
+                reply_markup=reply_markup
+            )
+            if photo['value'] == payload['image_url'] and message.photo:
+                photo['value'] = message.photo[-1].file_id
+                if on_file_id is not None:
+                    await on_file_id(photo['value'])
+        return send
+    if kind == 'text':
+        async def send(chat_id):
+            await bot.send_message(chat_id=chat_id, text=payload['text'])
+        return send
+    raise ValueError(f"Невідомий тип розсилки: {kind}")
+
+
+def _counters(job):
+    return {key: job[key] for key in ('sent', 'blocked', 'errors', 'throttled')}
+
+
+# Текст статусу розсилки для адміністратора
+def format_progress(job, rate=None):
+    counters = _counters(job)
+    total_text = str(job['total']) if job['total'] is not None else "?"
+    text = (
+        f"📤 Розсилка #{job['id']}: надіслано {counters['sent']}/{total_text}\n"
+        f"❌ Заблоковано: {counters['blocked']}\n"
+        f"⚠️ Помилок: {counters['errors']}\n"
+    )
+    if rate is not None:
+        text += f"🚦 Швидкість: {rate:.1f}/с, обмежень Telegram: {counters['throttled']}"
+    else:
+        text += f"🚦 Обмежень Telegram: {counters['throttled']}"
+    return text
+
+
+def format_final_report(job):
+    counters = _counters(job)
+    processed = counters['sent'] + counters['blocked'] + counters['errors']
+    return (
+        f"✅ Розсилка #{job['id']} завершена!\n\n"
+        f"👥 Всього користувачів: {processed}\n"
+        f"📤 Успішно надіслано: {counters['sent']}\n"
+        f"❌ Заблоковано боту: {counters['blocked']}\n"
+        f"⚠️ Помилок: {counters['errors']}\n"
+        f"🚦 Обмежень Telegram (RetryAfter): {counters['throttled']}\n\n"
+        + (f"📊 Успішність: {(counters['sent']/processed*100):.1f}%" if processed else "📊 Успішність: 0%")
+    )
+
+
+async def edit_job_status(bot, job, text):
+    if not job.get('admin_chat_id') or not job.get('status_message_id'):
+        return
+    try:
+        await bot.edit_message_text(
+            chat_id=job['admin_chat_id'],
+            message_id=job['status_message_id'],
+            text=text,
+        )
+    except Exception as e:
+        logger.warning(f"Не вдалося оновити статус розсилки #{job['id']}: {e}")
+
+
+class BroadcastChunkRunner:
+    """Розсилає одну орендовану частину (діапазон user_id) з контрольними точками.
+
+    Отримувачі частини йдуть за зростанням user_id, починаючи з її checkpoint_user_id.
+    Кожні BROADCAST_CHECKPOINT_INTERVAL секунд checkpoint зсувається до найбільшого user_id,
+    до якого оброблено всіх, оброблені після нього користувачі записуються в
+    broadcast_deliveries, а оренда продовжується. Якщо воркер впаде, частину після закінчення оренди візьме
+    інший воркер і продовжить з checkpoint, пропускаючи записаних у broadcast_deliveries.
+    Повторно можуть отримати повідомлення лише ті, кого оброблено за останній інтервал.
+    """
+
+    def __init__(self, worker, job, chunk):
+        self.worker = worker
+        self.job = job
+        self.chunk = chunk
+        self.job_id = job['id']
+        self.chunk_no = chunk['chunk_no']
+        self.engine = None
+        self.stop_reason = None  # paused / cancelled / lost / shutdown
+        self._checkpoint = chunk['checkpoint_user_id'] if chunk['checkpoint_user_id'] is not None else chunk['first_user_id']
+        self._saved = {'sent': 0, 'blocked': 0, 'errors': 0, 'throttled': 0}
+        self._dispatched = deque()  # user_id у порядку видачі (зростання)
+        self._completed = set()
+        self._pending = []  # [(user_id, outcome)] ще не записані в БД
+        self._saver_stop = asyncio.Event()
+
+    def stop(self, reason):
+        if self.stop_reason is None:
+            self.stop_reason = reason
+        if self.engine is not None:
+            self.engine.stop()
+
+    def _deltas(self):
+        stats = self.engine.stats
+        current = {'sent': stats.sent, 'blocked': stats.blocked, 'errors': stats.errors, 'throttled': stats.throttled}
+        return current, {key: current[key] - self._saved[key] for key in current}
+
+    async def _recipients(self):
+        async for user_id in iter_recipients(
+            subscribed_only=self.job['subscribed_only'],
+            after_user_id=self._checkpoint,
+            job_id=self.job_id,
+            until_user_id=self.chunk['last_user_id'],
+        ):
+            self._dispatched.append(user_id)
+            yield user_id
+
+    def _on_result(self, user_id, outcome):
+        self._pending.append((user_id, outcome))
+        self._completed.add(user_id)
+
+    async def _save(self):
+        # Зсуваємо checkpoint, поки всі видані підряд отримувачі оброблені
+        advanced = []
+        while self._dispatched and self._dispatched[0] in self._completed:
+            user_id = self._dispatched.popleft()
+            self._completed.discard(user_id)
+            advanced.append(user_id)
+        checkpoint = advanced[-1] if advanced else None
+        deliveries, self._pending = self._pending, []
+        current, deltas = self._deltas()
+        status = await run_db(
+            save_chunk_progress, self.job_id, self.chunk_no, self.worker.worker_id,
+            deliveries, checkpoint, deltas, BROADCAST_LEASE_SECONDS,
+        )
+        if status is None:
+            # Не вдалося записати — спробуємо ще раз з наступною контрольною точкою
+            self._pending = deliveries + self._pending
+            self._dispatched.extendleft(reversed(advanced))
+            self._completed.update(advanced)
+            return None
+        if status != 'lost':
+            self._saved = current
+            if checkpoint is not None:
+                self._checkpoint = checkpoint
+        return status
+
+    async def _checkpoint_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._saver_stop.wait(), timeout=BROADCAST_CHECKPOINT_INTERVAL)
+                return
+            except asyncio.TimeoutError:
+                pass
+            status = await self._save()
+            if status == 'lost':
+                logger.warning(f"Оренду частини #{self.job_id}/{self.chunk_no} втрачено, зупиняю")
+                self.stop('lost')
+                return
+            if status is not None and status != 'running':
+                logger.info(f"Розсилка #{self.job_id} отримала статус {status}, зупиняю частину {self.chunk_no}")
+                self.stop(status)
+
+    async def _final_save(self):
+        for attempt in range(BROADCAST_FINAL_SAVE_ATTEMPTS):
+            status = await self._save()
+            if status is not None:
+                return status
+            await asyncio.sleep(1 + attempt)
+        return None
+
+    async def _remember_file_id(self, file_id):
+        # Зберігаємо в payload, щоб інші частини та воркери теж надсилали file_id
+        self.job['payload']['file_id'] = file_id
+        await run_db(set_broadcast_file_id, self.job_id, file_id)
+
+    async def run(self):
+        """Повертає True, якщо ця частина була останньою і розсилку завершено."""
+        send = build_sender(self.worker.bot, self.job['payload'], on_file_id=self._remember_file_id)
+        blocked_batcher = BlockedUserBatcher(mark_users_blocked_async)
+        self.engine = BroadcastEngine(
+            send,
+            on_blocked=blocked_batcher.add,
+            on_result=self._on_result,
+            rate=min(self.worker.rate, self.worker.max_rate),
+            max_rate=self.worker.max_rate,
+        )
+        if self.stop_reason is not None:
+            self.engine.stop()
+        logger.info(f"Розсилка #{self.job_id}, частина {self.chunk_no}: старт з user_id > {self._checkpoint}")
+        blocked_batcher.start()
+        saver = asyncio.create_task(self._checkpoint_loop())
+        final_status = None
+        try:
+            await self.engine.run(self._recipients())
+        finally:
+            # Не скасовуємо збереження посеред запису, а чекаємо його завершення
+            self._saver_stop.set()
+            await saver
+            await blocked_batcher.stop()
+            # Наступна частина продовжить з підібраної AIMD швидкості, а не з початкової
+            self.worker.rate = self.engine.stats.rate
+            if self.stop_reason != 'lost':
+                final_status = await self._final_save()
+        if self.stop_reason == 'lost' or final_status == 'lost':
+            # Частину вже орендував інший воркер
+            return False
+        if final_status is None:
+            # Лічильники й доставки після останньої контрольної точки не записано: частину не
+            # завершуємо, а повертаємо в чергу — її продовжать з останньої збереженої точки
+            logger.error(f"Розсилка #{self.job_id}, частина {self.chunk_no}: не вдалося зберегти прогрес, повертаю частину в чергу")
+            await run_db(release_broadcast_chunk, self.job_id, self.chunk_no, self.worker.worker_id)
+            return False
+        if self.engine.stopped or final_status != 'running':
+            # Пауза чи скасування, зокрема помічені лише на останній контрольній точці: частину
+            # не завершуємо, щоб після відновлення розсилку завершив воркер, який її візьме
+            await run_db(release_broadcast_chunk, self.job_id, self.chunk_no, self.worker.worker_id)
+            return False
+        return await run_db(complete_broadcast_chunk, self.job_id, self.chunk_no, self.worker.worker_id)
+
+
+class BroadcastWorker:
+    """Воркер розсилки: орендує частини розсилок (SELECT ... FOR UPDATE SKIP LOCKED) і розсилає їх.
+
+    Воркерів може бути скільки завгодно (у процесі бота та в окремих процесах
+    broadcast_worker.py). Глобальний ліміт BROADCAST_MAX_RATE ділиться порівну між живими
+    воркерами, що зараз орендують частини (простійні воркери частку не займають), а AIMD
+    кожного воркера працює в межах його частки. Підібрана швидкість переходить між частинами.
+    """
+
+    def __init__(self, bot, worker_id=None):
+        self.bot = bot
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.max_rate = BROADCAST_MAX_RATE
+        self.rate = BROADCAST_RATE  # швидкість, з якої стартує наступна частина
+        self.current = None  # BroadcastChunkRunner, що виконується зараз
+        self._wakeup = asyncio.Event()
+        self._beat = asyncio.Event()  # позачерговий пульс, щойно воркер орендував частину
+        self._stopping = False
+        self._jobs = {}  # кеш розсилок: job_id -> рядок broadcast_jobs
+
+    def wake(self):
+        """Нова або відновлена розсилка — шукаємо частини одразу, не чекаючи інтервалу."""
+        self._wakeup.set()
+
+    def stop_job(self, job_id, reason):
+        self._jobs.pop(job_id, None)
+        if self.current is not None and self.current.job_id == job_id:
+            self.current.stop(reason)
+
+    async def _heartbeat_loop(self):
+        while not self._stopping:
+            rate = self.current.engine.stats.rate if self.current is not None and self.current.engine is not None else 0.0
+            active = await run_db(heartbeat_broadcast_worker, self.worker_id, rate, BROADCAST_HEARTBEAT_INTERVAL * 3)
+            if active is not None:
+                self.max_rate = BROADCAST_MAX_RATE / max(active, 1)
+                if self.current is not None and self.current.engine is not None:
+                    self.current.engine.set_max_rate(self.max_rate)
+            try:
+                await asyncio.wait_for(self._beat.wait(), timeout=BROADCAST_HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._beat.clear()
+
+    async def _load_job(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            job = await run_db(get_broadcast_job, job_id)
+            if job is not None:
+                self._jobs[job_id] = job
+        return job
+
+    async def _run_chunk(self, chunk):
+        job = await self._load_job(chunk['job_id'])
+        if job is None:
+            await run_db(release_broadcast_chunk, chunk['job_id'], chunk['chunk_no'], self.worker_id)
+            await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+            return
+        self.current = BroadcastChunkRunner(self, job, chunk)
+        if self._stopping:
+            self.current.stop('shutdown')
+        # Частки інших воркерів і наша перераховуються одразу, а не на наступному пульсі
+        self._beat.set()
+        try:
+            finished = await self.current.run()
+        except Exception as e:
+            logger.error(f"Помилка розсилки #{job['id']}, частина {chunk['chunk_no']}: {e}")
+            # Частину візьме інший воркер після закінчення оренди
+            await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+            return
+        finally:
+            self.current = None
+        if finished:
+            self._jobs.pop(job['id'], None)
+            final_job = await run_db(get_broadcast_job, job['id'])
+            if final_job is not None:
+                await edit_job_status(self.bot, final_job, format_final_report(final_job))
+                logger.info(
+                    f"Розсилка #{job['id']} завершена. Надіслано: {final_job['sent']}, "
+                    f"Заблоковано: {final_job['blocked']}, Помилок: {final_job['errors']}"
+                )
+
+    async def run(self):
+        logger.info(f"Воркер розсилки {self.worker_id} запущено")
+        heartbeat = asyncio.create_task(self._heartbeat_loop())
+        try:
+            while not self._stopping:
+                chunk = await run_db(claim_broadcast_chunk, self.worker_id, BROADCAST_LEASE_SECONDS)
+                if chunk is not None:
+                    await self._run_chunk(chunk)
+                    continue
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=BROADCAST_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            heartbeat.cancel()
+            await run_db(remove_broadcast_worker, self.worker_id)
+            logger.info(f"Воркер розсилки {self.worker_id} зупинено")
+
+    def stop(self):
+        """Зупинка воркера: поточна частина зберігає checkpoint і повертається в чергу."""
+        self._stopping = True
+        self._wakeup.set()
+        if self.current is not None:
+            self.current.stop('shutdown')
+
+
+class BroadcastProgressReporter:
+    """Оновлює повідомлення зі статусом розсилок за лічильниками в broadcast_jobs.
+
+    Лічильники поповнюють усі воркери, тож статус редагує один процес (бот), а не кожен воркер.
+    """
+
+    def __init__(self, bot, interval=BROADCAST_PROGRESS_INTERVAL):
+        self.bot = bot
+        self.interval = interval
+        self._last = {}  # job_id -> лічильники, показані востаннє
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.report_once()
+            except Exception as e:
+                logger.warning(f"Не вдалося оновити статус розсилок: {e}")
+
+    async def report_once(self):
+        jobs = await run_db(list_broadcast_jobs, ('running',), 20)
+        if not jobs:
+            self._last = {}
+            return
+        rate, _ = await run_db(get_broadcast_rate, BROADCAST_HEARTBEAT_INTERVAL * 3)
+        for job in jobs:
+            counters = _counters(job)
+            if self._last.get(job['id']) == counters:
+                continue
+            self._last[job['id']] = counters
+            await edit_job_status(self.bot, job, format_progress(job, rate))
+        running_ids = {job['id'] for job in jobs}
+        self._last = {job_id: c for job_id, c in self._last.items() if job_id in running_ids}
+
+
+# Воркер і звітування в процесі бота
+_worker = None
+_worker_task = None
+_reporter_task = None
+
+
+# Запуск воркера розсилки у процесі бота.
+# Задачі не реєструються через application.create_task, бо Application.stop() чекав би
+# на завершення багатогодинної розсилки; натомість stop_inprocess_worker() зупиняє їх.
+def start_inprocess_worker(application, with_worker=True):
+    global _worker, _worker_task
+    if with_worker and _worker is None:
+        _worker = BroadcastWorker(application.bot)
+        _worker_task = asyncio.create_task(_worker.run())
+
+
+async def stop_inprocess_worker(timeout=30):
+    global _worker, _worker_task
+    if _worker is not None:
+        # Воркер дочекається збереження checkpoint і поверне частину в чергу
+        _worker.stop()
+        await asyncio.wait([_worker_task], timeout=timeout)
+        _worker = None
+        _worker_task = None
+
+
+# Звітування про хід розсилок. Має працювати в одному процесі на весь бот,
+# тож при кількох інстансах його запускає лише власник advisory lock (coordination.py).
+def start_progress_reporter(bot):
+    global _reporter_task
+    if _reporter_task is None:
+        _reporter_task = asyncio.create_task(BroadcastProgressReporter(bot).run())
+
+
+async def stop_progress_reporter():
+    global _reporter_task
+    if _reporter_task is not None:
+        _reporter_task.cancel()
+        _reporter_task = None
+
+
+# Сигнал локальному воркеру, що з'явилась нова або відновлена розсилка
+def wake_workers():
+    if _worker is not None:
+        _worker.wake()
+
+
+# Зупинка частини розсилки, що виконується в цьому процесі (пауза/скасування).
+# Воркери інших процесів помітять новий статус на наступній контрольній точці.
+def stop_job_locally(job_id, status):
+    if _worker is not None:
+        _worker.stop_job(job_id, status)
+
+
+async def load_job(job_id):
+    return await run_db(get_broadcast_job, job_id)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Окремий процес-воркер розсилки. Можна запускати кілька копій проти однієї бази даних:
+кожна орендує свої частини розсилок, а глобальний ліміт швидкості ділиться між ними.
+"""
+
+import os
+import signal
+import asyncio
+import logging
+from telegram import Bot
+from database import init_db, shutdown_executor, close_pool
+from broadcast_jobs import BroadcastWorker
+from metrics import MetricsServer, MetricsRequest
+
+# Налаштування логування
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Порт /metrics воркера (0 — вимкнено); має відрізнятися від METRICS_PORT бота на тому ж хості
+BROADCAST_WORKER_METRICS_PORT = int(os.getenv("BROADCAST_WORKER_METRICS_PORT", "0"))
+
+
+async def main():
+    worker = None
+    metrics_server = MetricsServer(port=BROADCAST_WORKER_METRICS_PORT)
+    metrics_server.start()
+    try:
+        async with Bot(TOKEN, request=MetricsRequest()) as bot:
+            worker = BroadcastWorker(bot)
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, worker.stop)
+            await worker.run()
+    finally:
+        await metrics_server.stop()
+
+
+if __name__ == "__main__":
+    if not TOKEN:
+        logger.error("TELEGRAM_BOT_TOKEN не знайдено в змінних середовища!")
+        exit(1)
+    init_db()
+    try:
+        asyncio.run(main())
+    finally:
+        shutdown_executor()
+        close_pool()
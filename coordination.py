@@ -0,0 +1,188 @@
+import os
+import json
+import uuid
+import zlib
+import socket
+import asyncio
+import logging
+from database import run_db, open_dedicated_connection, notify
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Ідентифікатор цього процесу серед інстансів бота
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+COORDINATION_CHECK_INTERVAL = float(os.getenv("COORDINATION_CHECK_INTERVAL", "10"))  # як часто пробувати взяти lock / перевіряти з'єднання
+COORDINATION_LOCK_NAMESPACE = 7130  # перший ключ pg_try_advisory_lock(int, int), щоб не перетинатися з іншими застосунками
+CACHE_CHANNEL = "bot_cache"
+
+
+def _lock_key(name):
+    # Другий ключ advisory lock — стабільний int4 з назви задачі
+    return zlib.crc32(name.encode()) - 2**31
+
+
+def _try_lock(conn, key):
+    cur = conn.cursor()
+    cur.execute("SELECT pg_try_advisory_lock(%s, %s)", (COORDINATION_LOCK_NAMESPACE, key))
+    return cur.fetchone()[0]
+
+
+def _ping(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT 1")
+    cur.fetchone()
+
+
+def _close(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+class SingletonJob:
+    """Фонова задача, що має працювати лише в одному інстансі бота.
+
+    Кожен інстанс періодично пробує взяти сесійний advisory lock на окремому з'єднанні;
+    власник lock запускає задачу (start), решта чекають. Якщо процес власника впав або
+    втратив з'єднання, Postgres знімає lock, і задачу підхоплює інший інстанс.
+    """
+
+    def __init__(self, name, start, stop, check_interval=COORDINATION_CHECK_INTERVAL):
+        self.name = name
+        self._start_job = start  # синхронна функція запуску
+        self._stop_job = stop  # корутина зупинки
+        self.check_interval = check_interval
+        self.key = _lock_key(name)
+        self.leader = False
+        self._conn = None
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._resign()
+
+    async def _resign(self):
+        if self.leader:
+            self.leader = False
+            await self._stop_job()
+            logger.info(f"Задачу {self.name} зупинено в інстансі {INSTANCE_ID}")
+        if self._conn is not None:
+            # Закриття з'єднання знімає advisory lock
+            _close(self._conn)
+            self._conn = None
+
+    async def _run(self):
+        while True:
+            try:
+                if self._conn is None:
+                    self._conn = await run_db(open_dedicated_connection)
+                if self.leader:
+                    await run_db(_ping, self._conn)
+                elif await run_db(_try_lock, self._conn, self.key):
+                    self.leader = True
+                    self._start_job()
+                    logger.info(f"Інстанс {INSTANCE_ID} виконує задачу {self.name}")
+            except Exception as e:
+                logger.warning(f"Координація {self.name}: з'єднання втрачено ({e}), повторю")
+                await self._resign()
+            await asyncio.sleep(self.check_interval)
+
+
+class CacheBus:
+    """Інвалідація локальних кешів між інстансами через LISTEN/NOTIFY.
+
+    publish(cache, data) надсилає NOTIFY; інші інстанси викликають обробник,
+    зареєстрований через subscribe(cache, handler). Власні повідомлення ігноруються.
+    Після перепідключення викликається reset(), бо повідомлення за час розриву втрачено.
+    """
+
+    def __init__(self, channel=CACHE_CHANNEL):
+        self.channel = channel
+        self._handlers = {}  # cache -> (handler, reset)
+        self._conn = None
+        self._lost = None
+        self._task = None
+
+    def subscribe(self, cache, handler, reset=None):
+        self._handlers[cache] = (handler, reset)
+
+    async def publish(self, cache, data):
+        payload = json.dumps({'instance': INSTANCE_ID, 'cache': cache, 'data': data})
+        return await run_db(notify, self.channel, payload)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def _on_readable(self):
+        try:
+            self._conn.poll()
+        except Exception as e:
+            logger.warning(f"LISTEN {self.channel}: з'єднання втрачено ({e})")
+            self._lost.set()
+            return
+        while self._conn.notifies:
+            message = self._conn.notifies.pop(0)
+            try:
+                event = json.loads(message.payload)
+                if event.get('instance') == INSTANCE_ID:
+                    continue
+                entry = self._handlers.get(event.get('cache'))
+                if entry is not None:
+                    entry[0](event.get('data'))
+            except Exception as e:
+                logger.error(f"Помилка обробки повідомлення {self.channel}: {e}")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        connected_before = False
+        while True:
+            conn = None
+            try:
+                conn = await run_db(open_dedicated_connection)
+                await run_db(conn.cursor().execute, f"LISTEN {self.channel}")
+                self._conn = conn
+                self._lost = asyncio.Event()
+                if connected_before:
+                    for _, reset in self._handlers.values():
+                        if reset is not None:
+                            reset()
+                connected_before = True
+                loop.add_reader(conn.fileno(), self._on_readable)
+                logger.info(f"Інстанс {INSTANCE_ID} слухає {self.channel}")
+                try:
+                    await self._lost.wait()
+                finally:
+                    loop.remove_reader(conn.fileno())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"LISTEN {self.channel}: не вдалося підключитися ({e})")
+            finally:
+                if conn is not None:
+                    _close(conn)
+                self._conn = None
+            await asyncio.sleep(COORDINATION_CHECK_INTERVAL)
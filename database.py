@@ -1,9 +1,20 @@
 import os
+import gzip
+import time
+import inspect
+import asyncio
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from collections import OrderedDict
+from contextlib import contextmanager, asynccontextmanager
 import psycopg2
+from psycopg2 import extensions, errors, sql
 from urllib.parse import urlparse  # Виправлений імпорт
 from telegram.error import TelegramError
-from psycopg2.extras import Json
+from psycopg2.extras import Json, RealDictCursor, execute_values
+from metrics import db_seconds, cache_lookups
 
 # Налаштування логування
 logger = logging.getLogger(__name__)
@@ -25,264 +36,2272 @@ else:
     DB_PASSWORD = os.getenv("PGPASSWORD")
     DB_NAME = os.getenv("PGDATABASE")
 
-# Ініціалізація бази даних
-def init_db():
-    conn = None  # Ініціалізація conn як None
-    try:
-        conn = psycopg2.connect(
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        cur = conn.cursor()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                username VARCHAR(255),
-                first_name VARCHAR(255),
-                last_name VARCHAR(255),
-                phone_number VARCHAR(32),
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
-                updated_at TIMESTAMP WITH TIME ZONE,
-                is_subscribed BOOLEAN DEFAULT FALSE,
-                language_code VARCHAR(10),
-                interaction_count INTEGER DEFAULT 0,
-                is_blocked BOOLEAN DEFAULT FALSE
-            )
-        """)
-        # На випадок, якщо таблиця створена раніше без phone_number
-        cur.execute("""
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS phone_number VARCHAR(32)
-        """)
-        
-        # Якщо раніше зберігали телефони у user_contacts — перенесемо їх у users
+# Параметри пулу з'єднань
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # секунд на очікування вільного з'єднання
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.getenv("DB_POOL_HEALTHCHECK_INTERVAL", "30"))  # перевіряти SELECT 1, якщо з'єднання простоювало довше
+
+
+class PoolTimeoutError(Exception):
+    """Не вдалося отримати з'єднання з пулу за DB_POOL_TIMEOUT секунд."""
+
+
+class ConnectionPool:
+    """Потокобезпечний пул з'єднань psycopg2 з обмеженням розміру та перевіркою здоров'я.
+
+    На відміну від psycopg2.pool.ThreadedConnectionPool, тримає відкритими до maxconn
+    простоюючих з'єднань (а не лише minconn) і чекає на вільне з'єднання до timeout,
+    замість того щоб одразу кидати PoolError.
+    """
+
+    def __init__(self, minconn, maxconn, timeout, healthcheck_interval, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._connect_kwargs = connect_kwargs
+        self._idle = []  # [(conn, час останнього використання)]
+        self._opened = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._opened += 1
+
+    def _connect(self):
+        return psycopg2.connect(**self._connect_kwargs)
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.healthcheck_interval:
+            return True
         try:
-            cur.execute("SELECT to_regclass('public.user_contacts')")
-            exists = cur.fetchone()[0]
-            if exists:
-                cur.execute(
-                    """
-                    UPDATE users u
-                    SET phone_number = c.phone_number,
-                        first_name = COALESCE(u.first_name, c.first_name),
-                        last_name  = COALESCE(u.last_name,  c.last_name),
-                        updated_at = NOW()
-                    FROM user_contacts c
-                    WHERE u.user_id = c.user_id
-                      AND (u.phone_number IS NULL OR u.phone_number = '')
-                    """
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception as e:
+            logger.warning(f"З'єднання з пулу не пройшло перевірку: {e}")
+            return False
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeoutError("Пул з'єднань закрито")
+                if self._idle:
+                    # LIFO: найсвіжіше з'єднання рідше потребує перевірки
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._opened < self.maxconn:
+                    self._opened += 1
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeoutError(
+                        f"Немає вільного з'єднання з БД за {self.timeout} с (max={self.maxconn})"
+                    )
+                self._cond.wait(remaining)
+        # Мережеві операції виконуємо поза блокуванням
+        try:
+            if conn is not None and self._is_healthy(conn, last_used):
+                return conn
+            if conn is not None:
+                self._discard(conn)
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._opened -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn):
+        broken = conn.closed
+        if not broken:
+            status = conn.info.transaction_status
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                broken = True
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
+        with self._cond:
+            if broken or self._closed:
+                self._opened -= 1
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self):
+        """Знімок стану пулу: відкрито / простоюють / зайнято з'єднань."""
+        with self._cond:
+            return {'open': self._opened, 'idle': len(self._idle), 'in_use': self._opened - len(self._idle), 'max': self.maxconn}
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._discard(conn)
+            self._opened -= len(self._idle)
+            self._idle = []
+            self._cond.notify_all()
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_db_call = threading.local()  # failed: у виклику через run_db сталася помилка БД
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    DB_POOL_MIN,
+                    DB_POOL_MAX,
+                    DB_POOL_TIMEOUT,
+                    DB_POOL_HEALTHCHECK_INTERVAL,
+                    dbname=DB_NAME,
+                    user=DB_USER,
+                    password=DB_PASSWORD,
+                    host=DB_HOST,
+                    port=DB_PORT,
                 )
-        except Exception as migrate_err:
-            logger.warning(f"Міграція телефонів із user_contacts пропущена: {migrate_err}")
-        
-        # Таблиця логів переписок
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS message_logs (
-                id BIGSERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                direction VARCHAR(10) NOT NULL, -- 'in' або 'out'
-                message_type VARCHAR(50) NOT NULL,
-                content TEXT,
-                extra JSONB,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
-            )
-        """)
-        cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_message_logs_user_created
-            ON message_logs(user_id, created_at)
-        """)
-
-        conn.commit()
-        logger.info(f"База даних ініціалізована (db={DB_NAME}, host={DB_HOST})")
+                logger.info(f"Пул з'єднань створено (min={DB_POOL_MIN}, max={DB_POOL_MAX})")
+    return _pool
+
+# З'єднання з пулу: незакомічена транзакція відкочується при поверненні.
+# Функції БД перехоплюють помилки й повертають None/False, тож помилка, що пройшла
+# через з'єднання, позначається окремо — за цією позначкою run_db рахує outcome="error".
+@contextmanager
+def get_connection():
+    try:
+        pool = get_pool()
+        conn = pool.getconn()
+        try:
+            yield conn
+        finally:
+            pool.putconn(conn)
+    except Exception:
+        _db_call.failed = True
+        raise
+
+# Окреме з'єднання поза пулом: для сесійних advisory lock і LISTEN,
+# які живуть, поки відкрите з'єднання
+def open_dedicated_connection():
+    conn = psycopg2.connect(
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        host=DB_HOST,
+        port=DB_PORT,
+    )
+    conn.autocommit = True
+    return conn
+
+# Закриття пулу при завершенні роботи
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+# Стан пулу для метрик; None, якщо пул ще не створено
+def pool_stats():
+    pool = _pool
+    return pool.stats() if pool is not None else None
+
+# Умови вибору отримувачів розсилки. Часткові індекси в init_db побудовані саме
+# з цими предикатами, тому запити мають використовувати їх без змін.
+RECIPIENTS_SUBSCRIBED = "is_subscribed AND NOT is_blocked"
+RECIPIENTS_ALL = "NOT is_blocked"
+
+def _recipients_predicate(subscribed_only):
+    return RECIPIENTS_SUBSCRIBED if subscribed_only else RECIPIENTS_ALL
+
+# Версійовані міграції схеми. Застосовані версії записуються в schema_migrations,
+# тож на "теплому" старті init_db робить лише один SELECT. Нові зміни схеми
+# додаються новою версією в кінець MIGRATIONS, а не правкою вже застосованих.
+
+# 1: схема, яку раніше init_db створював на кожному старті
+def _migration_001_baseline(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username VARCHAR(255),
+            first_name VARCHAR(255),
+            last_name VARCHAR(255),
+            phone_number VARCHAR(32),
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            updated_at TIMESTAMP WITH TIME ZONE,
+            is_subscribed BOOLEAN DEFAULT FALSE,
+            language_code VARCHAR(10),
+            interaction_count INTEGER DEFAULT 0,
+            is_blocked BOOLEAN DEFAULT FALSE
+        )
+    """)
+    # На випадок, якщо таблиця створена раніше без phone_number
+    cur.execute("""
+        ALTER TABLE users
+        ADD COLUMN IF NOT EXISTS phone_number VARCHAR(32)
+    """)
+
+    # Таблиця логів переписок
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS message_logs (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            direction VARCHAR(10) NOT NULL, -- 'in' або 'out'
+            message_type VARCHAR(50) NOT NULL,
+            content TEXT,
+            extra JSONB,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_message_logs_user_created
+        ON message_logs(user_id, created_at)
+    """)
+    # Часткові індекси під вибірку отримувачів розсилки (предикати збігаються з RECIPIENTS_*)
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_users_recipients_subscribed
+        ON users(user_id) WHERE {RECIPIENTS_SUBSCRIBED}
+    """)
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_users_recipients_all
+        ON users(user_id) WHERE {RECIPIENTS_ALL}
+    """)
+    # Збережені розсилки: стан, лічильники та контрольна точка для відновлення
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id BIGSERIAL PRIMARY KEY,
+            status VARCHAR(16) NOT NULL DEFAULT 'running', -- running / paused / cancelled / done
+            payload JSONB NOT NULL,
+            subscribed_only BOOLEAN NOT NULL DEFAULT TRUE,
+            admin_chat_id BIGINT,
+            status_message_id BIGINT,
+            total INTEGER,
+            sent INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            errors INTEGER NOT NULL DEFAULT 0,
+            throttled INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            finished_at TIMESTAMP WITH TIME ZONE
+        )
+    """)
+    # Частини розсилки: діапазони user_id, які воркери беруть в оренду (SKIP LOCKED)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_chunks (
+            job_id BIGINT NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+            chunk_no INTEGER NOT NULL,
+            first_user_id BIGINT, -- діапазон (first_user_id, last_user_id]; NULL — без межі
+            last_user_id BIGINT,
+            checkpoint_user_id BIGINT, -- усі отримувачі частини з user_id <= checkpoint вже оброблені
+            status VARCHAR(16) NOT NULL DEFAULT 'pending', -- pending / leased / done
+            leased_by VARCHAR(100),
+            lease_expires_at TIMESTAMP WITH TIME ZONE,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            PRIMARY KEY (job_id, chunk_no)
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_broadcast_chunks_claimable
+        ON broadcast_chunks(job_id, chunk_no) WHERE status <> 'done'
+    """)
+    # Живі воркери розсилки (для розподілу глобального ліміту швидкості)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_workers (
+            worker_id VARCHAR(100) PRIMARY KEY,
+            rate REAL NOT NULL DEFAULT 0,
+            last_seen TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        )
+    """)
+    # Оброблені отримувачі після контрольної точки (щоб не надсилати повторно при відновленні)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id BIGINT NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            status VARCHAR(10) NOT NULL, -- sent / blocked / error
+            PRIMARY KEY (job_id, user_id)
+        )
+    """)
+    # Заплановані відкладені повідомлення (фолов-ап після онбордингу тощо)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS scheduled_followups (
+            user_id BIGINT NOT NULL,
+            kind VARCHAR(32) NOT NULL,
+            chat_id BIGINT NOT NULL,
+            due_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            locked_until TIMESTAMP WITH TIME ZONE, -- оренда обробника; після неї рядок знову доступний
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            PRIMARY KEY (user_id, kind)
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_scheduled_followups_due
+        ON scheduled_followups(due_at)
+    """)
+    # Оброблені update_id: після перезапуску черга оновлень дочитується без повторів
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id BIGINT PRIMARY KEY,
+            processed_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        )
+    """)
+    # file_id завантажених у Telegram файлів за хешем вмісту (реєстр медіа)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS media_files (
+            content_hash VARCHAR(64) PRIMARY KEY, -- sha256 вмісту файлу
+            file_id TEXT NOT NULL,
+            path TEXT,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        )
+    """)
+
+# 2 (фонова): перенесення телефонів зі старої таблиці user_contacts у users.
+# Виконується пачками по user_id у фоні (BackgroundMigrations), щоб не тримати
+# блокування на великій таблиці під час старту. Повертає (наступний ключ, чи завершено).
+def _migration_002_user_contacts_batch(cur, after_user_id, batch_size):
+    cur.execute("SELECT to_regclass('public.user_contacts')")
+    if cur.fetchone()[0] is None:
+        return None, True
+    cur.execute(
+        """
+        WITH batch AS (
+            SELECT user_id, phone_number, first_name, last_name
+            FROM user_contacts
+            WHERE user_id > %s
+            ORDER BY user_id
+            LIMIT %s
+        ), moved AS (
+            UPDATE users u
+            SET phone_number = c.phone_number,
+                first_name = COALESCE(u.first_name, c.first_name),
+                last_name  = COALESCE(u.last_name,  c.last_name),
+                updated_at = NOW()
+            FROM batch c
+            WHERE u.user_id = c.user_id
+              AND (u.phone_number IS NULL OR u.phone_number = '')
+        )
+        SELECT MAX(user_id), COUNT(*) FROM batch
+        """,
+        (after_user_id if after_user_id is not None else -2**63, batch_size),
+    )
+    last_user_id, count = cur.fetchone()
+    return last_user_id, count < batch_size
+
+# Місячні секції message_logs: message_logs_yYYYYmMM з діапазоном [1-ше число місяця, 1-ше число наступного)
+def _month_start(value, months=0):
+    index = value.year * 12 + value.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+def _create_message_log_partitions(cur, first_month, months):
+    for k in range(months):
+        start = _month_start(first_month, k)
+        end = _month_start(start, 1)
+        name = f"message_logs_y{start.year}m{start.month:02d}"
+        # Місяць може вже бути покритий секцією legacy — тоді пропускаємо його
+        cur.execute("SAVEPOINT message_log_partition")
+        try:
+            cur.execute(
+                sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF message_logs FOR VALUES FROM (%s) TO (%s)")
+                .format(sql.Identifier(name)),
+                (start, end),
+            )
+            cur.execute("RELEASE SAVEPOINT message_log_partition")
+        except errors.InvalidObjectDefinition as e:
+            cur.execute("ROLLBACK TO SAVEPOINT message_log_partition")
+            logger.info(f"Секцію {name} не створено: {str(e).strip()}")
+        except errors.CheckViolation:
+            # У message_logs_default уже є рядки цього місяця (секцію не створили вчасно)
+            cur.execute("ROLLBACK TO SAVEPOINT message_log_partition")
+            moved = _move_default_partition_rows(cur, name, start, end)
+            logger.warning(f"Секцію {name} створено із запізненням: перенесено {moved} рядків з message_logs_default")
+
+# Створення секції місяця, рядки якого вже потрапили в message_logs_default: default від'єднується,
+# створюється секція, рядки переносяться, default приєднується назад (в одній транзакції).
+# Поки транзакція триває, вставки в message_logs чекають — рядків у default зазвичай небагато.
+def _move_default_partition_rows(cur, name, start, end):
+    columns = "id, user_id, direction, message_type, content, extra, created_at"
+    cur.execute("ALTER TABLE message_logs DETACH PARTITION message_logs_default")
+    cur.execute(
+        sql.SQL("CREATE TABLE {} PARTITION OF message_logs FOR VALUES FROM (%s) TO (%s)").format(sql.Identifier(name)),
+        (start, end),
+    )
+    cur.execute(
+        sql.SQL(f"""
+            WITH moved AS (
+                DELETE FROM message_logs_default
+                WHERE created_at >= %s AND created_at < %s
+                RETURNING {columns}
+            )
+            INSERT INTO {{}} ({columns}) SELECT {columns} FROM moved
+        """).format(sql.Identifier(name)),
+        (start, end),
+    )
+    moved = cur.rowcount
+    cur.execute("ALTER TABLE message_logs ATTACH PARTITION message_logs_default DEFAULT")
+    return moved
+
+def _message_logs_partitioned(cur):
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = 'message_logs'::regclass")
+    return cur.fetchone()[0] == 'p'
+
+# 3: message_logs стає таблицею, секціонованою за місяцями created_at (фонова міграція).
+# Наявна таблиця стає секцією message_logs_legacy (усе до кінця наступного місяця), нові
+# місяці йдуть в окремі секції, а message_logs_default ловить решту. Кроки (after_key):
+#   None / id      — пачками проставляє created_at рядкам без дати (інакше вони не пройдуть межі секції);
+#   ('constraint',) — CHECK з межею секції, NOT VALID (миттєво);
+#   ('validate', межа) — VALIDATE CONSTRAINT: сканує таблицю, але не блокує запис;
+#   ('index', межа)  — BRIN-індекс CONCURRENTLY, щоб при приєднанні його не будувати;
+#   ('switch', межа) — перейменування і ATTACH PARTITION в одній короткій транзакції:
+#                      перевірений CHECK дозволяє Postgres пропустити сканування.
+# Після перезапуску процесу кроки починаються спочатку (вже виконані проходять швидко).
+MESSAGE_LOGS_LEGACY_CHECK = "message_logs_legacy_bound"
+MIGRATION_LOCK_TIMEOUT = "5s"  # DDL не чекає за довгими транзакціями, а повторюється пізніше
+
+def _migration_003_partition_message_logs(cur, after_key, batch_size):
+    if _message_logs_partitioned(cur):
+        return None, True
+    if after_key is None or isinstance(after_key, int):
+        cur.execute(
+            """
+            WITH batch AS (
+                SELECT id, created_at FROM message_logs
+                WHERE id > %s
+                ORDER BY id
+                LIMIT %s
+            ), fixed AS (
+                UPDATE message_logs m
+                SET created_at = 'epoch'
+                FROM batch b
+                WHERE m.id = b.id AND b.created_at IS NULL
+            )
+            SELECT MAX(id), COUNT(*) FROM batch
+            """,
+            (after_key if after_key is not None else -2**63, batch_size),
+        )
+        last_id, count = cur.fetchone()
+        return (last_id, False) if count == batch_size else (('constraint',), False)
+    step = after_key[0]
+    if step == 'constraint':
+        # Запас у місяць: поки CHECK не перевірено і таблицю не перемкнуто, нові рядки мають його проходити
+        legacy_end = datetime.combine(_month_start(datetime.now(timezone.utc).date(), 2), datetime.min.time(), timezone.utc)
+        cur.execute(f"SET LOCAL lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'")
+        cur.execute(sql.SQL("ALTER TABLE message_logs DROP CONSTRAINT IF EXISTS {}").format(sql.Identifier(MESSAGE_LOGS_LEGACY_CHECK)))
+        cur.execute(
+            sql.SQL("ALTER TABLE message_logs ADD CONSTRAINT {} CHECK (created_at IS NOT NULL AND created_at < %s) NOT VALID")
+            .format(sql.Identifier(MESSAGE_LOGS_LEGACY_CHECK)),
+            (legacy_end,),
+        )
+        return ('validate', legacy_end), False
+    legacy_end = after_key[1]
+    if step == 'validate':
+        cur.execute(sql.SQL("ALTER TABLE message_logs VALIDATE CONSTRAINT {}").format(sql.Identifier(MESSAGE_LOGS_LEGACY_CHECK)))
+        return ('index', legacy_end), False
+    if step == 'index':
+        # CREATE INDEX CONCURRENTLY не працює в транзакції — окреме з'єднання з autocommit
+        conn = open_dedicated_connection()
+        try:
+            index_cur = conn.cursor()
+            index_cur.execute("""
+                SELECT i.indisvalid FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE c.relname = 'idx_message_logs_legacy_created_brin'
+            """)
+            row = index_cur.fetchone()
+            if row is not None and not row[0]:
+                # Залишок перерваної спроби
+                index_cur.execute("DROP INDEX CONCURRENTLY idx_message_logs_legacy_created_brin")
+            index_cur.execute("""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_message_logs_legacy_created_brin
+                ON message_logs USING brin (created_at)
+            """)
+        finally:
+            conn.close()
+        return ('switch', legacy_end), False
+    cur.execute(f"SET LOCAL lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'")
+    # Межі місячних секцій задаються датами — рахуємо їх за UTC, як і межу legacy
+    cur.execute("SET LOCAL TimeZone = 'UTC'")
+    cur.execute("ALTER TABLE message_logs RENAME TO message_logs_legacy")
+    cur.execute("ALTER INDEX IF EXISTS idx_message_logs_user_created RENAME TO idx_message_logs_legacy_user_created")
+    cur.execute("""
+        CREATE TABLE message_logs (
+            id BIGINT NOT NULL DEFAULT nextval('message_logs_id_seq'),
+            user_id BIGINT NOT NULL,
+            direction VARCHAR(10) NOT NULL, -- 'in' або 'out'
+            message_type VARCHAR(50) NOT NULL,
+            content TEXT,
+            extra JSONB,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        ) PARTITION BY RANGE (created_at)
+    """)
+    cur.execute("ALTER SEQUENCE message_logs_id_seq OWNED BY message_logs.id")
+    # Індекси секціонованої таблиці; у legacy підхоплюються вже наявні однакові індекси
+    cur.execute("CREATE INDEX idx_message_logs_user_created ON message_logs(user_id, created_at)")
+    cur.execute("CREATE INDEX idx_message_logs_created_brin ON message_logs USING brin (created_at)")
+    cur.execute(
+        "ALTER TABLE message_logs ATTACH PARTITION message_logs_legacy FOR VALUES FROM (MINVALUE) TO (%s)",
+        (legacy_end,),
+    )
+    cur.execute(sql.SQL("ALTER TABLE message_logs_legacy DROP CONSTRAINT {}").format(sql.Identifier(MESSAGE_LOGS_LEGACY_CHECK)))
+    cur.execute("CREATE TABLE message_logs_default PARTITION OF message_logs DEFAULT")
+    _create_message_log_partitions(cur, legacy_end, 3)
+    return None, True
+
+# 4: BRIN-індекс для вибірок message_logs за часовим вікном (крихітний, бо created_at
+# росте разом із фізичним порядком рядків). Поки секціонування (3) в черзі, індекс
+# створить саме воно.
+def _migration_004_message_logs_brin(cur):
+    if not _message_logs_partitioned(cur):
+        return
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_message_logs_created_brin
+        ON message_logs USING brin (created_at)
+    """)
+
+# 5: лічильники користувачів для /stats, які підтримує тригер на users.
+# Лічильники розбиті на STATS_SHARDS рядків за user_id, щоб одночасні записи різних
+# користувачів не чекали на один рядок; /stats підсумовує STATS_SHARDS рядків.
+STATS_SHARDS = 16
+
+def _migration_005_user_stats_counters(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_stats_counters (
+            shard SMALLINT PRIMARY KEY,
+            total BIGINT NOT NULL DEFAULT 0,
+            subscribed BIGINT NOT NULL DEFAULT 0, -- RECIPIENTS_SUBSCRIBED
+            blocked BIGINT NOT NULL DEFAULT 0,
+            with_contact BIGINT NOT NULL DEFAULT 0, -- поділилися телефоном
+            recounted_at TIMESTAMP WITH TIME ZONE
+        )
+    """)
+    cur.execute(
+        "INSERT INTO user_stats_counters (shard) SELECT generate_series(0, %s - 1) ON CONFLICT DO NOTHING",
+        (STATS_SHARDS,),
+    )
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION user_stats_counters_update() RETURNS trigger AS $$
+        DECLARE
+            d_total INTEGER := 0;
+            d_subscribed INTEGER := 0;
+            d_blocked INTEGER := 0;
+            d_contact INTEGER := 0;
+            shard_no SMALLINT;
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                d_total := 1;
+                d_subscribed := (COALESCE(NEW.is_subscribed, FALSE) AND NOT COALESCE(NEW.is_blocked, FALSE))::int;
+                d_blocked := COALESCE(NEW.is_blocked, FALSE)::int;
+                d_contact := (COALESCE(NEW.phone_number, '') <> '')::int;
+                shard_no := NEW.user_id % {STATS_SHARDS};
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                d_total := d_total - 1;
+                d_subscribed := d_subscribed - (COALESCE(OLD.is_subscribed, FALSE) AND NOT COALESCE(OLD.is_blocked, FALSE))::int;
+                d_blocked := d_blocked - COALESCE(OLD.is_blocked, FALSE)::int;
+                d_contact := d_contact - (COALESCE(OLD.phone_number, '') <> '')::int;
+                shard_no := OLD.user_id % {STATS_SHARDS};
+            END IF;
+            IF d_total = 0 AND d_subscribed = 0 AND d_blocked = 0 AND d_contact = 0 THEN
+                RETURN NULL;
+            END IF;
+            UPDATE user_stats_counters
+            SET total = total + d_total,
+                subscribed = subscribed + d_subscribed,
+                blocked = blocked + d_blocked,
+                with_contact = with_contact + d_contact
+            WHERE shard = shard_no;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS users_stats_counters ON users")
+    # Зміни профілю (ім'я, username) тригер не запускають
+    cur.execute("""
+        CREATE TRIGGER users_stats_counters
+        AFTER INSERT OR DELETE OR UPDATE OF is_subscribed, is_blocked, phone_number ON users
+        FOR EACH ROW EXECUTE FUNCTION user_stats_counters_update()
+    """)
+    # Точні початкові значення записує перший перерахунок (StatsRecount), без сканування users під час міграції
+
+# 6: погодинні й щоденні агрегати воронки онбордингу (див. rollup_funnel_slice).
+# funnel_user_steps пам'ятає, коли користувач уперше дійшов до кроку, щоб рахувати
+# унікальних користувачів без повторного перегляду message_logs.
+def _migration_006_funnel_rollups(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS funnel_user_steps (
+            user_id BIGINT NOT NULL,
+            step VARCHAR(32) NOT NULL,
+            first_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            PRIMARY KEY (user_id, step)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS funnel_hourly (
+            bucket TIMESTAMP NOT NULL, -- година за UTC
+            step VARCHAR(32) NOT NULL,
+            events BIGINT NOT NULL DEFAULT 0,
+            users BIGINT NOT NULL DEFAULT 0, -- дійшли до кроку вперше
+            PRIMARY KEY (bucket, step)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS funnel_daily (
+            day DATE NOT NULL, -- за UTC
+            step VARCHAR(32) NOT NULL,
+            events BIGINT NOT NULL DEFAULT 0,
+            users BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, step)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            name VARCHAR(64) PRIMARY KEY,
+            high_water TIMESTAMP WITH TIME ZONE,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        )
+    """)
+
+# 7: частини нових розсилок нарізає воркер по одній (див. _plan_broadcast_chunk), тож
+# /broadcast не проходить по всіх отримувачах. Розсилки, створені раніше, вже розбиті на частини.
+def _migration_007_broadcast_chunk_planning(cur):
+    cur.execute("""
+        ALTER TABLE broadcast_jobs
+            ADD COLUMN IF NOT EXISTS chunk_size INTEGER,
+            ADD COLUMN IF NOT EXISTS planned_until BIGINT, -- верхня межа останньої нарізаної частини
+            ADD COLUMN IF NOT EXISTS planned BOOLEAN NOT NULL DEFAULT TRUE -- усі частини нарізано
+    """)
+
+# (версія, назва, функція, фонова). Синхронні міграції — f(cur), фонові — f(cur, after_key, batch_size).
+MIGRATIONS = [
+    (1, "baseline", _migration_001_baseline, False),
+    (2, "user_contacts_phones", _migration_002_user_contacts_batch, True),
+    (3, "partition_message_logs", _migration_003_partition_message_logs, True),
+    (4, "message_logs_brin", _migration_004_message_logs_brin, False),
+    (5, "user_stats_counters", _migration_005_user_stats_counters, False),
+    (6, "funnel_rollups", _migration_006_funnel_rollups, False),
+    (7, "broadcast_chunk_planning", _migration_007_broadcast_chunk_planning, False),
+]
+MIGRATIONS_LOCK_KEY = 7130_0001  # pg_advisory_xact_lock: міграції застосовує один процес
+
+# Незавершені фонові міграції після init_db: [(версія, назва, функція)]
+pending_background_migrations = []
+
+def _applied_migrations(conn, cur):
+    try:
+        cur.execute("SELECT version FROM schema_migrations")
+    except errors.UndefinedTable:
+        # Перший запуск з міграціями
+        conn.rollback()
+        return set()
+    return {row[0] for row in cur.fetchall()}
+
+def _mark_migration_applied(cur, version, name):
+    cur.execute(
+        "INSERT INTO schema_migrations (version, name) VALUES (%s, %s) ON CONFLICT (version) DO NOTHING",
+        (version, name),
+    )
+
+# Ініціалізація бази даних: застосовує нові міграції схеми
+def init_db():
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            applied = _applied_migrations(conn, cur)
+            conn.commit()
+            pending = [m for m in MIGRATIONS if m[0] not in applied]
+            if pending and any(not background for *_, background in pending):
+                # Кілька інстансів можуть стартувати одночасно: чекаємо на lock і перечитуємо
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK_KEY,))
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INTEGER PRIMARY KEY,
+                        name VARCHAR(100) NOT NULL,
+                        applied_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                    )
+                """)
+                applied = _applied_migrations(conn, cur)
+                for version, name, migrate, background in MIGRATIONS:
+                    if version in applied or background:
+                        continue
+                    migrate(cur)
+                    _mark_migration_applied(cur, version, name)
+                    logger.info(f"Міграцію {version} ({name}) застосовано")
+                conn.commit()
+                pending = [m for m in MIGRATIONS if m[0] not in applied and m[3]]
+            pending_background_migrations[:] = [(version, name, migrate) for version, name, migrate, _ in pending]
+            if pending_background_migrations:
+                logger.info(f"Фонові міграції в черзі: {', '.join(name for _, name, _ in pending_background_migrations)}")
+            logger.info(f"База даних ініціалізована (db={DB_NAME}, host={DB_HOST})")
     except Exception as e:
         logger.error(f"Помилка ініціалізації бази даних: {e}")
-    finally:
-        if conn is not None:  # Закриваємо лише якщо з’єднання існує
-            conn.close()
+
+# Одна пачка фонової міграції в окремій транзакції; коли пачки скінчились,
+# версія записується в schema_migrations. Повертає (наступний ключ, чи завершено) або None при помилці.
+def run_background_migration_batch(version, name, migrate, after_key, batch_size):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            next_key, done = migrate(cur, after_key, batch_size)
+            if done:
+                _mark_migration_applied(cur, version, name)
+            conn.commit()
+            return next_key, done
+    except Exception as e:
+        logger.error(f"Помилка фонової міграції {version} ({name}) після {after_key}: {e}")
+        return None
 
 # Завантаження списку користувачів
 def load_users(subscribed_only=True):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        cur = conn.cursor()
-        if subscribed_only:
-            cur.execute("""
-                SELECT user_id FROM users WHERE is_subscribed = TRUE AND is_blocked = FALSE
-            """)
-        else:
-            cur.execute("""
-                SELECT user_id FROM users WHERE is_blocked = FALSE
-            """)
-        users = [row[0] for row in cur.fetchall()]
-        return users
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f"SELECT user_id FROM users WHERE {_recipients_predicate(subscribed_only)}")
+            users = [row[0] for row in cur.fetchall()]
+            return users
     except Exception as e:
         logger.error(f"Помилка завантаження користувачів: {e}")
         return []
-    finally:
-        if conn is not None:
-            conn.close()
 
-# Збереження користувача
-def save_user(user_id, username=None, first_name=None, last_name=None, language_code=None):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO users (user_id, username, first_name, last_name, language_code, updated_at)
-            VALUES (%s, %s, %s, %s, %s, NOW())
-            ON CONFLICT (user_id) DO UPDATE
-            SET username = EXCLUDED.username,
-                first_name = EXCLUDED.first_name,
-                last_name = EXCLUDED.last_name,
-                language_code = EXCLUDED.language_code,
-                updated_at = NOW()
-        """, (user_id, username, first_name, last_name, language_code))
-        conn.commit()
+# Сторінка історії переписки користувача, від новіших до старіших.
+# before — курсор (created_at, id) останнього рядка попередньої сторінки. Повертає None при помилці.
+def fetch_user_history_page(user_id, before=None, limit=100):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            if before is None:
+                cur.execute(
+                    """
+                    SELECT id, user_id, direction, message_type, content, extra, created_at
+                    FROM message_logs
+                    WHERE user_id = %s
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT %s
+                    """,
+                    (user_id, limit),
+                )
+            else:
+                cur.execute(
+                    """
+                    SELECT id, user_id, direction, message_type, content, extra, created_at
+                    FROM message_logs
+                    WHERE user_id = %s AND (created_at, id) < (%s, %s)
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT %s
+                    """,
+                    (user_id, before[0], before[1], limit),
+                )
+            return cur.fetchall()
+    except Exception as e:
+        logger.error(f"Помилка завантаження історії користувача {user_id}: {e}")
+        return None
+
+# Сторінка логів усіх користувачів у вікні [start, end), від старіших до новіших.
+# after — курсор (created_at, id). Повертає None при помилці.
+def fetch_log_window_page(start, end, after=None, limit=500):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute(
+                """
+                SELECT id, user_id, direction, message_type, content, extra, created_at
+                FROM message_logs
+                WHERE created_at >= %(start)s AND created_at < %(end)s
+                  AND (%(after_ts)s::timestamptz IS NULL OR (created_at, id) > (%(after_ts)s::timestamptz, %(after_id)s::bigint))
+                ORDER BY created_at, id
+                LIMIT %(limit)s
+                """,
+                {
+                    'start': start,
+                    'end': end,
+                    'after_ts': after[0] if after else None,
+                    'after_id': after[1] if after else None,
+                    'limit': limit,
+                },
+            )
+            return cur.fetchall()
+    except Exception as e:
+        logger.error(f"Помилка завантаження логів за {start} - {end}: {e}")
+        return None
+
+# Створення секцій message_logs на поточний і months_ahead наступних місяців
+def ensure_message_log_partitions(months_ahead=3):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            if not _message_logs_partitioned(cur):
+                # Фонова міграція секціонування ще не завершилась
+                conn.commit()
+                return True
+            _create_message_log_partitions(cur, datetime.now(timezone.utc).date(), months_ahead + 1)
+            conn.commit()
+            return True
+    except Exception as e:
+        logger.error(f"Помилка створення секцій message_logs: {e}")
+        return False
+
+# Архівування секцій message_logs, що повністю старші за retention_months місяців:
+# секція потоково вивантажується COPY TO у archive_dir/<секція>.csv.gz, після чого
+# від'єднується і видаляється. Повертає список заархівованих секцій або None при помилці.
+def archive_message_log_partitions(retention_months, archive_dir):
+    cutoff = _month_start(datetime.now(timezone.utc).date(), -retention_months)
+    archived = []
+    try:
+        os.makedirs(archive_dir, exist_ok=True)
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT c.relname
+                FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'message_logs'::regclass
+                  AND (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'TO \(''([^'']+)''\)'))[1]::timestamptz <= %s
+                ORDER BY c.relname
+                """,
+                (cutoff,),
+            )
+            names = [row[0] for row in cur.fetchall()]
+            conn.commit()
+            for name in names:
+                path = os.path.join(archive_dir, f"{name}.csv.gz")
+                with gzip.open(path + ".tmp", "wb") as f:
+                    cur.copy_expert(
+                        sql.SQL("COPY {} TO STDOUT WITH (FORMAT csv, HEADER)").format(sql.Identifier(name)).as_string(conn),
+                        f,
+                    )
+                os.replace(path + ".tmp", path)
+                # Видаляємо лише після того, як архів повністю записано
+                cur.execute(sql.SQL("ALTER TABLE message_logs DETACH PARTITION {}").format(sql.Identifier(name)))
+                cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+                conn.commit()
+                archived.append(name)
+                logger.info(f"Секцію {name} заархівовано в {path}")
+        return archived
+    except Exception as e:
+        logger.error(f"Помилка архівування секцій message_logs: {e}")
+        return None
+
+# Одна сторінка отримувачів розсилки (keyset-пагінація по user_id).
+# Якщо вказано job_id, пропускаються вже оброблені в цій розсилці користувачі.
+# Повертає None у разі помилки, щоб не сплутати її з кінцем списку.
+def fetch_recipients_page(subscribed_only=True, after_user_id=None, limit=1000, job_id=None, until_user_id=None):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            delivered_filter = ""
+            if job_id is not None:
+                delivered_filter = """
+                  AND NOT EXISTS (
+                      SELECT 1 FROM broadcast_deliveries d
+                      WHERE d.job_id = %(job_id)s AND d.user_id = users.user_id
+                  )"""
+            cur.execute(
+                f"""
+                SELECT user_id FROM users
+                WHERE {_recipients_predicate(subscribed_only)}
+                  AND user_id > %(after)s
+                  AND (%(until)s::bigint IS NULL OR user_id <= %(until)s::bigint){delivered_filter}
+                ORDER BY user_id
+                LIMIT %(limit)s
+                """,
+                {
+                    'after': after_user_id if after_user_id is not None else -2**63,
+                    'limit': limit,
+                    'job_id': job_id,
+                    'until': until_user_id,
+                },
+            )
+            return [row[0] for row in cur.fetchall()]
+    except Exception as e:
+        logger.error(f"Помилка завантаження сторінки отримувачів після {after_user_id}: {e}")
+        return None
+
+# Кількість отримувачів розсилки (index-only scan по частковому індексу)
+def count_recipients(subscribed_only=True):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f"SELECT COUNT(*) FROM users WHERE {_recipients_predicate(subscribed_only)}")
+            return cur.fetchone()[0]
+    except Exception as e:
+        logger.error(f"Помилка підрахунку отримувачів: {e}")
+        return None
+
+# Останні збережені профілі користувачів: повторний /start з тими ж даними не йде в БД
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+_profile_cache = OrderedDict()  # user_id -> (username, first_name, last_name, language_code)
+_profile_cache_lock = threading.Lock()
+
+def _profile_unchanged(user_id, profile):
+    with _profile_cache_lock:
+        if _profile_cache.get(user_id) == profile:
+            _profile_cache.move_to_end(user_id)
+            cache_lookups.inc(cache="profile", result="hit")
+            return True
+    cache_lookups.inc(cache="profile", result="miss")
+    return False
+
+def _remember_profile(user_id, profile):
+    with _profile_cache_lock:
+        _profile_cache[user_id] = profile
+        _profile_cache.move_to_end(user_id)
+        while len(_profile_cache) > PROFILE_CACHE_SIZE:
+            _profile_cache.popitem(last=False)
+
+# Профіль у БД змінено в обхід кешу (контакт, інший інстанс): наступний save_user піде в БД
+def forget_profile(user_id):
+    with _profile_cache_lock:
+        _profile_cache.pop(user_id, None)
+
+def clear_profile_cache():
+    with _profile_cache_lock:
+        _profile_cache.clear()
+
+# Upsert користувача; рядок не переписується, якщо профіль не змінився (без зайвого WAL)
+def _save_user(cur, user_id, username=None, first_name=None, last_name=None, language_code=None):
+    cur.execute("""
+        INSERT INTO users (user_id, username, first_name, last_name, language_code, updated_at)
+        VALUES (%s, %s, %s, %s, %s, NOW())
+        ON CONFLICT (user_id) DO UPDATE
+        SET username = EXCLUDED.username,
+            first_name = EXCLUDED.first_name,
+            last_name = EXCLUDED.last_name,
+            language_code = EXCLUDED.language_code,
+            updated_at = NOW()
+        WHERE (users.username, users.first_name, users.last_name, users.language_code)
+              IS DISTINCT FROM
+              (EXCLUDED.username, EXCLUDED.first_name, EXCLUDED.last_name, EXCLUDED.language_code)
+    """, (user_id, username, first_name, last_name, language_code))
+    if cur.rowcount:
         logger.info(f"Користувач {user_id} збережений")
+    return cur.rowcount > 0
+
+# Збереження користувача. Повертає True, якщо рядок у БД змінився (тоді профіль
+# у кешах інших інстансів застарів), False — якщо ні, None — при помилці.
+def save_user(user_id, username=None, first_name=None, last_name=None, language_code=None):
+    profile = (username, first_name, last_name, language_code)
+    if _profile_unchanged(user_id, profile):
+        return False
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            changed = _save_user(cur, user_id, *profile)
+            conn.commit()
+        _remember_profile(user_id, profile)
+        return changed
     except Exception as e:
         logger.error(f"Помилка збереження користувача {user_id}: {e}")
-    finally:
-        if conn is not None:
-            conn.close()
+        return None
+
+def _update_subscription_status(cur, user_id, is_subscribed):
+    cur.execute("""
+        UPDATE users
+        SET is_subscribed = %s,
+            updated_at = NOW(),
+            interaction_count = interaction_count + 1
+        WHERE user_id = %s
+    """, (is_subscribed, user_id))
+    logger.info(f"Статус підписки для користувача {user_id} оновлено: {is_subscribed}")
 
 # Оновлення статусу підписки
 def update_subscription_status(user_id, is_subscribed):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        cur = conn.cursor()
-        cur.execute("""
-            UPDATE users
-            SET is_subscribed = %s,
-                updated_at = NOW(),
-                interaction_count = interaction_count + 1
-            WHERE user_id = %s
-        """, (is_subscribed, user_id))
-        conn.commit()
-        logger.info(f"Статус підписки для користувача {user_id} оновлено: {is_subscribed}")
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            _update_subscription_status(cur, user_id, is_subscribed)
+            conn.commit()
     except Exception as e:
         logger.error(f"Помилка оновлення статусу підписки для {user_id}: {e}")
-    finally:
-        if conn is not None:
-            conn.close()
+
+# Сторінка користувачів з поточним статусом підписки (keyset по user_id) для звірки з каналом.
+# Повертає None у разі помилки.
+def fetch_subscription_page(after_user_id=None, limit=1000):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT user_id, is_subscribed FROM users
+                WHERE NOT is_blocked AND user_id > %s
+                ORDER BY user_id
+                LIMIT %s
+                """,
+                (after_user_id if after_user_id is not None else -2**63, limit),
+            )
+            return cur.fetchall()
+    except Exception as e:
+        logger.error(f"Помилка завантаження сторінки підписок після {after_user_id}: {e}")
+        return None
+
+# Випадкова вибірка користувачів для часткової звірки підписок
+def sample_subscription_states(limit):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT user_id, is_subscribed FROM users WHERE NOT is_blocked ORDER BY random() LIMIT %s",
+                (limit,),
+            )
+            return cur.fetchall()
+    except Exception as e:
+        logger.error(f"Помилка вибірки користувачів для звірки підписок: {e}")
+        return None
+
+# Пакетне оновлення статусів підписки: changes — [(user_id, is_subscribed)].
+# Рядки, де статус не змінився, не переписуються. Повертає True, якщо запис вдався.
+def set_subscription_statuses(changes):
+    if not changes:
+        return True
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            execute_values(
+                cur,
+                """
+                UPDATE users
+                SET is_subscribed = v.is_subscribed,
+                    updated_at = NOW()
+                FROM (VALUES %s) AS v(user_id, is_subscribed)
+                WHERE users.user_id = v.user_id
+                  AND users.is_subscribed IS DISTINCT FROM v.is_subscribed
+                """,
+                changes,
+                template="(%s::bigint, %s::boolean)",
+                page_size=len(changes),
+            )
+            updated = cur.rowcount
+            conn.commit()
+            if updated:
+                logger.info(f"Оновлено статус підписки для {updated} користувачів")
+            return True
+    except Exception as e:
+        logger.error(f"Помилка пакетного оновлення підписок ({len(changes)} записів): {e}")
+        return False
 
 # Оновлення статусу блокування
 def update_blocked_status(user_id, is_blocked):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        cur = conn.cursor()
-        cur.execute("""
-            UPDATE users
-            SET is_blocked = %s,
-                updated_at = NOW()
-            WHERE user_id = %s
-        """, (is_blocked, user_id))
-        conn.commit()
-        logger.info(f"Статус блокування для користувача {user_id} оновлено: {is_blocked}")
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE users
+                SET is_blocked = %s,
+                    updated_at = NOW()
+                WHERE user_id = %s
+            """, (is_blocked, user_id))
+            conn.commit()
+            logger.info(f"Статус блокування для користувача {user_id} оновлено: {is_blocked}")
     except Exception as e:
         logger.error(f"Помилка оновлення статусу блокування для {user_id}: {e}")
-    finally:
-        if conn is not None:
-            conn.close()
 
-# Збереження контакту користувача (в таблиці users)
-def save_contact(user_id, phone_number, first_name=None, last_name=None):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        cur = conn.cursor()
-        # Спочатку пробуємо оновити існуючого користувача
-        cur.execute(
-            """
-            UPDATE users
-            SET phone_number = %s,
-                first_name = COALESCE(%s, first_name),
-                last_name = COALESCE(%s, last_name),
-                updated_at = NOW()
-            WHERE user_id = %s
-            """,
-            (phone_number, first_name, last_name, user_id),
-        )
-        # Якщо рядків не оновлено — вставляємо нового користувача
-        if cur.rowcount == 0:
+# Пакетне позначення користувачів заблокованими (одним UPDATE)
+def mark_users_blocked(user_ids):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
             cur.execute(
                 """
-                INSERT INTO users (user_id, username, first_name, last_name, phone_number, updated_at)
-                VALUES (%s, %s, %s, %s, %s, NOW())
-                ON CONFLICT (user_id) DO UPDATE
-                SET phone_number = EXCLUDED.phone_number,
-                    first_name = COALESCE(EXCLUDED.first_name, users.first_name),
-                    last_name = COALESCE(EXCLUDED.last_name, users.last_name),
+                UPDATE users
+                SET is_blocked = TRUE,
                     updated_at = NOW()
+                WHERE user_id = ANY(%s)
+                  AND NOT is_blocked
                 """,
-                (user_id, None, first_name, last_name, phone_number),
+                (list(user_ids),),
             )
-        conn.commit()
-        logger.info(f"Контакт (phone) для користувача {user_id} збережений у users")
+            conn.commit()
+            logger.info(f"Позначено заблокованими {cur.rowcount} з {len(user_ids)} користувачів")
+            return True
+    except Exception as e:
+        logger.error(f"Помилка пакетного оновлення статусу блокування ({len(user_ids)} користувачів): {e}")
+        return False
+
+# Збереження телефону одним upsert (існуючому користувачу оновлюються телефон та ім'я)
+def _save_contact(cur, user_id, phone_number, first_name=None, last_name=None):
+    cur.execute(
+        """
+        INSERT INTO users (user_id, first_name, last_name, phone_number, updated_at)
+        VALUES (%s, %s, %s, %s, NOW())
+        ON CONFLICT (user_id) DO UPDATE
+        SET phone_number = EXCLUDED.phone_number,
+            first_name = COALESCE(EXCLUDED.first_name, users.first_name),
+            last_name = COALESCE(EXCLUDED.last_name, users.last_name),
+            updated_at = NOW()
+        """,
+        (user_id, first_name, last_name, phone_number),
+    )
+    logger.info(f"Контакт (phone) для користувача {user_id} збережений у users")
+
+# Збереження контакту користувача. Ім'я з контакту переписує профіль, тож запис
+# у кеші профілів скидається. Повертає True після успішного коміту.
+def save_contact(user_id, phone_number, first_name=None, last_name=None):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            _save_contact(cur, user_id, phone_number, first_name, last_name)
+            conn.commit()
+        forget_profile(user_id)
+        return True
     except Exception as e:
         logger.error(f"Помилка збереження телефону для {user_id}: {e}")
-    finally:
-        if conn is not None:
-            conn.close()
+        return None
 
 # Лог переписки
 def log_message(user_id: int, direction: str, message_type: str, content: str | None = None, extra: dict | None = None):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        cur = conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO message_logs (user_id, direction, message_type, content, extra)
-            VALUES (%s, %s, %s, %s, %s)
-            """,
-            (user_id, direction, message_type, content, Json(extra) if extra is not None else None),
-        )
-        conn.commit()
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                INSERT INTO message_logs (user_id, direction, message_type, content, extra)
+                VALUES (%s, %s, %s, %s, %s)
+                """,
+                (user_id, direction, message_type, content, Json(extra) if extra is not None else None),
+            )
+            conn.commit()
     except Exception as e:
         logger.error(f"Помилка запису логу для {user_id}: {e}")
+
+# Пакетний запис логів переписки одним багаторядковим INSERT
+def log_messages_bulk(rows):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            execute_values(
+                cur,
+                """
+                INSERT INTO message_logs (user_id, direction, message_type, content, extra)
+                VALUES %s
+                """,
+                [
+                    (user_id, direction, message_type, content, Json(extra) if extra is not None else None)
+                    for user_id, direction, message_type, content, extra in rows
+                ],
+                page_size=len(rows),
+            )
+            conn.commit()
+            return True
+    except Exception as e:
+        logger.error(f"Помилка пакетного запису {len(rows)} логів: {e}")
+        return False
+
+# Створення збереженої розсилки. Частини по chunk_size отримувачів нарізають воркери
+# по одній (_plan_broadcast_chunk), тож створення не залежить від кількості отримувачів.
+def create_broadcast_job(payload, subscribed_only, admin_chat_id, total=None, chunk_size=5000):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                INSERT INTO broadcast_jobs (payload, subscribed_only, admin_chat_id, total, chunk_size, planned)
+                VALUES (%s, %s, %s, %s, %s, FALSE)
+                RETURNING id
+                """,
+                (Json(payload), subscribed_only, admin_chat_id, total, chunk_size),
+            )
+            job_id = cur.fetchone()[0]
+            conn.commit()
+            logger.info(f"Створено розсилку #{job_id} (частини по {chunk_size})")
+            return job_id
+    except Exception as e:
+        logger.error(f"Помилка створення розсилки: {e}")
+        return None
+
+# Завантаження розсилки за id
+def get_broadcast_job(job_id):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute("SELECT * FROM broadcast_jobs WHERE id = %s", (job_id,))
+            return cur.fetchone()
+    except Exception as e:
+        logger.error(f"Помилка завантаження розсилки #{job_id}: {e}")
+        return None
+
+# Список розсилок (останні спочатку), за потреби — лише з певними статусами
+def list_broadcast_jobs(statuses=None, limit=10):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            if statuses:
+                cur.execute(
+                    "SELECT * FROM broadcast_jobs WHERE status = ANY(%s) ORDER BY id DESC LIMIT %s",
+                    (list(statuses), limit),
+                )
+            else:
+                cur.execute("SELECT * FROM broadcast_jobs ORDER BY id DESC LIMIT %s", (limit,))
+            return cur.fetchall()
+    except Exception as e:
+        logger.error(f"Помилка завантаження списку розсилок: {e}")
+        return []
+
+# Збереження id повідомлення зі статусом розсилки (щоб оновлювати його після перезапуску)
+def set_broadcast_status_message(job_id, message_id):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "UPDATE broadcast_jobs SET status_message_id = %s, updated_at = NOW() WHERE id = %s",
+                (message_id, job_id),
+            )
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Помилка збереження статусного повідомлення розсилки #{job_id}: {e}")
+
+# Збереження file_id фото розсилки після першого завантаження
+def set_broadcast_file_id(job_id, file_id):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                UPDATE broadcast_jobs
+                SET payload = payload || jsonb_build_object('file_id', %s::text), updated_at = NOW()
+                WHERE id = %s
+                """,
+                (file_id, job_id),
+            )
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Помилка збереження file_id розсилки #{job_id}: {e}")
+
+# Зміна статусу розсилки; from_statuses обмежує допустимі переходи.
+# Повертає True, якщо статус змінено.
+def set_broadcast_job_status(job_id, status, from_statuses=None):
+    allowed = list(from_statuses) if from_statuses else None
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                UPDATE broadcast_jobs
+                SET status = %s,
+                    updated_at = NOW(),
+                    finished_at = CASE WHEN %s IN ('done', 'cancelled') THEN NOW() ELSE finished_at END
+                WHERE id = %s
+                  AND (%s::text[] IS NULL OR status = ANY(%s::text[]))
+                """,
+                (status, status, job_id, allowed, allowed),
+            )
+            changed = cur.rowcount > 0
+            if changed and status == 'cancelled':
+                # Скасовану розсилку не продовжать, тож записи доставки більше не потрібні
+                cur.execute("DELETE FROM broadcast_deliveries WHERE job_id = %s", (job_id,))
+            conn.commit()
+            if changed:
+                logger.info(f"Розсилка #{job_id}: статус {status}")
+            return changed
+    except Exception as e:
+        logger.error(f"Помилка зміни статусу розсилки #{job_id}: {e}")
+        return False
+
+# Відновлення розсилки з паузи. Якщо всі її частини вже завершені (пауза настала після
+# того, як остання частина дійшла до кінця), розсилка одразу позначається done.
+# Повертає новий статус ('running' або 'done') або None, якщо розсилка не була на паузі чи сталася помилка.
+def resume_broadcast_job(job_id):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                UPDATE broadcast_jobs
+                SET status = 'running', updated_at = NOW()
+                WHERE id = %s AND status = 'paused'
+                """,
+                (job_id,),
+            )
+            if cur.rowcount == 0:
+                conn.rollback()
+                return None
+            status = 'done' if _finish_broadcast_job(cur, job_id) else 'running'
+            conn.commit()
+            logger.info(f"Розсилка #{job_id}: статус {status}")
+            return status
+    except Exception as e:
+        logger.error(f"Помилка відновлення розсилки #{job_id}: {e}")
+        return None
+
+# Прибирання записів broadcast_deliveries: розсилки на паузі довше за paused_days днів
+# скасовуються (0 — ніколи), а записи завершених і скасованих розсилок видаляються (зокрема
+# дописані воркером уже після скасування). Повертає (скасовано, видалено записів) або None при помилці.
+def prune_broadcast_deliveries(paused_days):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cancelled = 0
+            if paused_days > 0:
+                cur.execute(
+                    """
+                    UPDATE broadcast_jobs
+                    SET status = 'cancelled', finished_at = NOW(), updated_at = NOW()
+                    WHERE status = 'paused' AND updated_at < NOW() - make_interval(days => %s)
+                    """,
+                    (paused_days,),
+                )
+                cancelled = cur.rowcount
+            cur.execute(
+                """
+                DELETE FROM broadcast_deliveries d
+                USING broadcast_jobs j
+                WHERE d.job_id = j.id AND j.status IN ('done', 'cancelled')
+                """
+            )
+            deleted = cur.rowcount
+            conn.commit()
+            return cancelled, deleted
+    except Exception as e:
+        logger.error(f"Помилка прибирання записів доставки розсилок: {e}")
+        return None
+
+# Нарізання наступної частини розсилки одразу в оренду воркеру. Межа частини — chunk_size-й
+# отримувач після межі попередньої (коротке сканування часткового індексу); якщо отримувачів
+# менше, частина остання і не обмежена згори, тож до неї потрапляють і нові користувачі.
+# Рядок розсилки блокується, тож два воркери не наріжуть ту саму частину.
+def _plan_broadcast_chunk(cur, worker_id, lease_seconds):
+    cur.execute(
+        """
+        SELECT id, subscribed_only, chunk_size, planned_until
+        FROM broadcast_jobs
+        WHERE status = 'running' AND NOT planned
+        ORDER BY id
+        LIMIT 1
+        FOR UPDATE
+        """
+    )
+    job = cur.fetchone()
+    if job is None:
+        return None
+    first_user_id = job['planned_until']
+    cur.execute(
+        f"""
+        SELECT user_id FROM users
+        WHERE {_recipients_predicate(job['subscribed_only'])} AND user_id > %s
+        ORDER BY user_id
+        OFFSET %s LIMIT 1
+        """,
+        (first_user_id if first_user_id is not None else -2**63, job['chunk_size'] - 1),
+    )
+    row = cur.fetchone()
+    last_user_id = row['user_id'] if row else None
+    cur.execute("SELECT COALESCE(MAX(chunk_no) + 1, 0) AS chunk_no FROM broadcast_chunks WHERE job_id = %s", (job['id'],))
+    chunk_no = cur.fetchone()['chunk_no']
+    cur.execute(
+        """
+        INSERT INTO broadcast_chunks (job_id, chunk_no, first_user_id, last_user_id, status, leased_by, lease_expires_at)
+        VALUES (%s, %s, %s, %s, 'leased', %s, NOW() + make_interval(secs => %s))
+        RETURNING *
+        """,
+        (job['id'], chunk_no, first_user_id, last_user_id, worker_id, lease_seconds),
+    )
+    chunk = cur.fetchone()
+    cur.execute(
+        """
+        UPDATE broadcast_jobs
+        SET planned_until = COALESCE(%s, planned_until), planned = %s, updated_at = NOW()
+        WHERE id = %s
+        """,
+        (last_user_id, last_user_id is None, job['id']),
+    )
+    return chunk
+
+# Оренда наступної вільної частини розсилки. SKIP LOCKED дозволяє кільком воркерам
+# одночасно брати різні частини; частини з простроченою орендою (воркер впав) беруться знову.
+# Якщо вільних частин немає, нарізається наступна частина розсилки, яку ще не розбито до кінця.
+def claim_broadcast_chunk(worker_id, lease_seconds):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute(
+                """
+                UPDATE broadcast_chunks c
+                SET status = 'leased',
+                    leased_by = %s,
+                    lease_expires_at = NOW() + make_interval(secs => %s),
+                    updated_at = NOW()
+                FROM (
+                    SELECT c2.job_id, c2.chunk_no
+                    FROM broadcast_chunks c2
+                    JOIN broadcast_jobs j ON j.id = c2.job_id
+                    WHERE j.status = 'running'
+                      AND (c2.status = 'pending'
+                           OR (c2.status = 'leased' AND c2.lease_expires_at < NOW()))
+                    ORDER BY c2.job_id, c2.chunk_no
+                    LIMIT 1
+                    FOR UPDATE OF c2 SKIP LOCKED
+                ) free
+                WHERE c.job_id = free.job_id AND c.chunk_no = free.chunk_no
+                RETURNING c.*
+                """,
+                (worker_id, lease_seconds),
+            )
+            chunk = cur.fetchone()
+            if chunk is None:
+                chunk = _plan_broadcast_chunk(cur, worker_id, lease_seconds)
+            conn.commit()
+            return chunk
+    except Exception as e:
+        logger.error(f"Помилка оренди частини розсилки: {e}")
+        return None
+
+# Контрольна точка частини: оброблені отримувачі, приріст лічильників розсилки,
+# checkpoint частини та продовження оренди — в одній транзакції.
+# У broadcast_deliveries тримаються лише отримувачі після checkpoint: продовження частини
+# починається з checkpoint, тож записи до нього не потрібні й видаляються, щойно він їх наздожене.
+# Повертає статус розсилки; 'lost', якщо оренду перехопив інший воркер; None у разі помилки.
+def save_chunk_progress(job_id, chunk_no, worker_id, deliveries, checkpoint_user_id, deltas, lease_seconds):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                UPDATE broadcast_chunks
+                SET checkpoint_user_id = COALESCE(%s, checkpoint_user_id),
+                    lease_expires_at = NOW() + make_interval(secs => %s),
+                    updated_at = NOW()
+                WHERE job_id = %s AND chunk_no = %s AND leased_by = %s AND status = 'leased'
+                RETURNING first_user_id, checkpoint_user_id
+                """,
+                (checkpoint_user_id, lease_seconds, job_id, chunk_no, worker_id),
+            )
+            row = cur.fetchone()
+            if row is None:
+                conn.rollback()
+                return 'lost'
+            first_user_id, checkpoint = row
+            if checkpoint is not None:
+                deliveries = [(user_id, status) for user_id, status in deliveries if user_id > checkpoint]
+            if checkpoint_user_id is not None:
+                # Записи попередніх контрольних точок (чи попереднього воркера), які checkpoint уже пройшов
+                cur.execute(
+                    """
+                    DELETE FROM broadcast_deliveries
+                    WHERE job_id = %s AND user_id <= %s
+                      AND (%s::bigint IS NULL OR user_id > %s::bigint)
+                    """,
+                    (job_id, checkpoint, first_user_id, first_user_id),
+                )
+            if deliveries:
+                execute_values(
+                    cur,
+                    """
+                    INSERT INTO broadcast_deliveries (job_id, user_id, status)
+                    VALUES %s
+                    ON CONFLICT (job_id, user_id) DO NOTHING
+                    """,
+                    [(job_id, user_id, status) for user_id, status in deliveries],
+                    page_size=len(deliveries),
+                )
+            cur.execute(
+                """
+                UPDATE broadcast_jobs
+                SET sent = sent + %s,
+                    blocked = blocked + %s,
+                    errors = errors + %s,
+                    throttled = throttled + %s,
+                    updated_at = NOW()
+                WHERE id = %s
+                RETURNING status
+                """,
+                (deltas['sent'], deltas['blocked'], deltas['errors'], deltas['throttled'], job_id),
+            )
+            row = cur.fetchone()
+            conn.commit()
+            return row[0] if row else None
+    except Exception as e:
+        logger.error(f"Помилка збереження прогресу розсилки #{job_id}/{chunk_no}: {e}")
+        return None
+
+# Повернення частини в чергу (пауза, скасування або зупинка воркера)
+def release_broadcast_chunk(job_id, chunk_no, worker_id):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                UPDATE broadcast_chunks
+                SET status = 'pending', leased_by = NULL, lease_expires_at = NULL, updated_at = NOW()
+                WHERE job_id = %s AND chunk_no = %s AND leased_by = %s AND status = 'leased'
+                """,
+                (job_id, chunk_no, worker_id),
+            )
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Помилка повернення частини розсилки #{job_id}/{chunk_no}: {e}")
+
+# Позначає розсилку done, якщо вона виконується, нарізана на частини до кінця і всі частини
+# завершені, та видаляє її записи broadcast_deliveries. Викликається в транзакції того,
+# хто змінює частини чи статус.
+def _finish_broadcast_job(cur, job_id):
+    # Блокуємо рядок розсилки, щоб дві останні частини не завершили її одночасно
+    cur.execute("SELECT status FROM broadcast_jobs WHERE id = %s FOR UPDATE", (job_id,))
+    cur.execute(
+        """
+        UPDATE broadcast_jobs
+        SET status = 'done', finished_at = NOW(), updated_at = NOW()
+        WHERE id = %s
+          AND status = 'running'
+          AND planned
+          AND NOT EXISTS (
+              SELECT 1 FROM broadcast_chunks WHERE job_id = %s AND status <> 'done'
+          )
+        """,
+        (job_id, job_id),
+    )
+    finished = cur.rowcount > 0
+    if finished:
+        cur.execute("DELETE FROM broadcast_deliveries WHERE job_id = %s", (job_id,))
+    return finished
+
+# Завершення частини. Якщо це була остання частина, розсилка позначається done,
+# а записи broadcast_deliveries видаляються. Повертає True, якщо розсилку завершив саме цей виклик.
+def complete_broadcast_chunk(job_id, chunk_no, worker_id):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                UPDATE broadcast_chunks
+                SET status = 'done', leased_by = NULL, lease_expires_at = NULL, updated_at = NOW()
+                WHERE job_id = %s AND chunk_no = %s AND leased_by = %s
+                """,
+                (job_id, chunk_no, worker_id),
+            )
+            finished = _finish_broadcast_job(cur, job_id)
+            conn.commit()
+            if finished:
+                logger.info(f"Розсилка #{job_id} завершена")
+            return finished
+    except Exception as e:
+        logger.error(f"Помилка завершення частини розсилки #{job_id}/{chunk_no}: {e}")
+        return False
+
+# Пульс воркера розсилки. Повертає кількість живих воркерів, що зараз орендують частини,
+# між якими ділиться глобальний ліміт швидкості.
+def heartbeat_broadcast_worker(worker_id, rate, alive_seconds):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                INSERT INTO broadcast_workers (worker_id, rate, last_seen)
+                VALUES (%s, %s, NOW())
+                ON CONFLICT (worker_id) DO UPDATE
+                SET rate = EXCLUDED.rate, last_seen = NOW()
+                """,
+                (worker_id, rate),
+            )
+            cur.execute(
+                "DELETE FROM broadcast_workers WHERE last_seen < NOW() - make_interval(secs => %s)",
+                (alive_seconds * 10,),
+            )
+            # Ліміт ділиться лише між живими воркерами, що зараз розсилають частину
+            cur.execute(
+                """
+                SELECT COUNT(DISTINCT c.leased_by)
+                FROM broadcast_chunks c
+                JOIN broadcast_workers w ON w.worker_id = c.leased_by
+                WHERE c.status = 'leased' AND c.lease_expires_at > NOW()
+                  AND w.last_seen >= NOW() - make_interval(secs => %s)
+                """,
+                (alive_seconds,),
+            )
+            active = cur.fetchone()[0]
+            conn.commit()
+            return active
+    except Exception as e:
+        logger.error(f"Помилка пульсу воркера розсилки {worker_id}: {e}")
+        return None
+
+# Видалення воркера при коректній зупинці
+def remove_broadcast_worker(worker_id):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM broadcast_workers WHERE worker_id = %s", (worker_id,))
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Помилка видалення воркера розсилки {worker_id}: {e}")
+
+# Сумарна поточна швидкість усіх живих воркерів розсилки
+def get_broadcast_rate(alive_seconds):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT COALESCE(SUM(rate), 0), COUNT(*) FROM broadcast_workers WHERE last_seen >= NOW() - make_interval(secs => %s)",
+                (alive_seconds,),
+            )
+            rate, workers = cur.fetchone()
+            return float(rate), workers
+    except Exception as e:
+        logger.error(f"Помилка отримання швидкості розсилки: {e}")
+        return None, 0
+
+# Чи оброблено оновлення раніше. None при помилці.
+def is_update_processed(update_id):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT 1 FROM processed_updates WHERE update_id = %s", (update_id,))
+            return cur.fetchone() is not None
+    except Exception as e:
+        logger.error(f"Помилка перевірки оновлення {update_id}: {e}")
+        return None
+
+# Найбільший записаний update_id (0, якщо записів немає). None при помилці.
+def max_processed_update_id():
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT COALESCE(MAX(update_id), 0) FROM processed_updates")
+            return cur.fetchone()[0]
+    except Exception as e:
+        logger.error(f"Помилка читання processed_updates: {e}")
+        return None
+
+# Запис пачки оброблених update_id одним INSERT
+def mark_updates_processed(update_ids):
+    if not update_ids:
+        return True
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            execute_values(
+                cur,
+                "INSERT INTO processed_updates (update_id) VALUES %s ON CONFLICT DO NOTHING",
+                [(update_id,) for update_id in update_ids],
+            )
+            conn.commit()
+            return True
+    except Exception as e:
+        logger.error(f"Помилка запису {len(update_ids)} оброблених оновлень: {e}")
+        return False
+
+# Видалення старих записів processed_updates (Telegram не доставляє оновлення старші за добу)
+def prune_processed_updates(keep_seconds):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "DELETE FROM processed_updates WHERE processed_at < NOW() - make_interval(secs => %s)",
+                (keep_seconds,),
+            )
+            deleted = cur.rowcount
+            conn.commit()
+            return deleted
+    except Exception as e:
+        logger.error(f"Помилка очищення processed_updates: {e}")
+        return None
+
+# Повідомлення іншим інстансам бота через NOTIFY (payload — рядок до 8000 байт)
+def notify(channel, payload):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT pg_notify(%s, %s)", (channel, payload))
+            conn.commit()
+            return True
+    except Exception as e:
+        logger.error(f"Помилка NOTIFY {channel}: {e}")
+        return False
+
+def _schedule_followup(cur, user_id, chat_id, kind, delay_seconds):
+    cur.execute(
+        """
+        INSERT INTO scheduled_followups (user_id, kind, chat_id, due_at)
+        VALUES (%s, %s, %s, NOW() + make_interval(secs => %s))
+        ON CONFLICT (user_id, kind) DO UPDATE
+        SET chat_id = EXCLUDED.chat_id,
+            due_at = EXCLUDED.due_at,
+            locked_until = NULL,
+            attempts = 0
+        """,
+        (user_id, kind, chat_id, delay_seconds),
+    )
+
+def _cancel_followup(cur, user_id, kind):
+    cur.execute("DELETE FROM scheduled_followups WHERE user_id = %s AND kind = %s", (user_id, kind))
+    return cur.rowcount > 0
+
+# Планування відкладеного повідомлення; повторне планування того ж kind переносить час
+def schedule_followup(user_id, chat_id, kind, delay_seconds):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            _schedule_followup(cur, user_id, chat_id, kind, delay_seconds)
+            conn.commit()
+            return True
+    except Exception as e:
+        logger.error(f"Помилка планування {kind} для {user_id}: {e}")
+        return False
+
+# Скасування запланованого повідомлення (напр., підписку вже підтверджено)
+def cancel_followup(user_id, kind):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cancelled = _cancel_followup(cur, user_id, kind)
+            conn.commit()
+            return cancelled
+    except Exception as e:
+        logger.error(f"Помилка скасування {kind} для {user_id}: {e}")
+        return False
+
+# Пачка повідомлень, час яких настав, з орендою на lease_seconds.
+# SKIP LOCKED дозволяє кільком процесам забирати різні рядки. Повертає None у разі помилки.
+def claim_due_followups(limit, lease_seconds):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute(
+                """
+                UPDATE scheduled_followups f
+                SET locked_until = NOW() + make_interval(secs => %s),
+                    attempts = f.attempts + 1
+                FROM (
+                    SELECT user_id, kind FROM scheduled_followups
+                    WHERE due_at <= NOW()
+                      AND (locked_until IS NULL OR locked_until < NOW())
+                    ORDER BY due_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                ) due
+                WHERE f.user_id = due.user_id AND f.kind = due.kind
+                RETURNING f.user_id, f.kind, f.chat_id, f.attempts
+                """,
+                (lease_seconds, limit),
+            )
+            rows = cur.fetchall()
+            conn.commit()
+            return rows
+    except Exception as e:
+        logger.error(f"Помилка вибірки запланованих повідомлень: {e}")
+        return None
+
+# Видалення виконаних повідомлень: keys — [(user_id, kind)]
+def finish_followups(keys):
+    if not keys:
+        return True
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            execute_values(
+                cur,
+                """
+                DELETE FROM scheduled_followups f
+                USING (VALUES %s) AS v(user_id, kind)
+                WHERE f.user_id = v.user_id AND f.kind = v.kind
+                """,
+                keys,
+                template="(%s::bigint, %s::varchar)",
+            )
+            conn.commit()
+            return True
+    except Exception as e:
+        logger.error(f"Помилка видалення виконаних повідомлень ({len(keys)}): {e}")
+        return False
+
+# Повернення невдалого повідомлення в чергу з затримкою
+def retry_followup(user_id, kind, delay_seconds):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                UPDATE scheduled_followups
+                SET due_at = NOW() + make_interval(secs => %s), locked_until = NULL
+                WHERE user_id = %s AND kind = %s
+                """,
+                (delay_seconds, user_id, kind),
+            )
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Помилка перенесення {kind} для {user_id}: {e}")
+
+# Через скільки секунд настане найближче повідомлення (None, якщо черга порожня)
+def next_followup_delay():
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT EXTRACT(EPOCH FROM MIN(GREATEST(due_at, COALESCE(locked_until, due_at))) - NOW())
+                FROM scheduled_followups
+                """
+            )
+            delay = cur.fetchone()[0]
+            return float(delay) if delay is not None else None
+    except Exception as e:
+        logger.error(f"Помилка визначення наступного запланованого повідомлення: {e}")
+        return None
+
+# file_id для файлу з заданим хешем вмісту (None, якщо файл ще не завантажувався)
+def get_media_file_id(content_hash):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT file_id FROM media_files WHERE content_hash = %s", (content_hash,))
+            row = cur.fetchone()
+            return row[0] if row else None
+    except Exception as e:
+        logger.error(f"Помилка завантаження file_id для {content_hash}: {e}")
+        return None
+
+# Збереження file_id, отриманого після завантаження файлу
+def save_media_file_id(content_hash, file_id, path=None):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                INSERT INTO media_files (content_hash, file_id, path)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (content_hash) DO UPDATE
+                SET file_id = EXCLUDED.file_id, path = EXCLUDED.path, created_at = NOW()
+                """,
+                (content_hash, file_id, path),
+            )
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Помилка збереження file_id для {content_hash}: {e}")
+
+# Видалення file_id, який Telegram більше не приймає (лише якщо його ще не замінили новим)
+def delete_media_file_id(content_hash, file_id):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "DELETE FROM media_files WHERE content_hash = %s AND file_id = %s",
+                (content_hash, file_id),
+            )
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Помилка видалення file_id для {content_hash}: {e}")
+
+# Статистика для /stats: лічильники користувачів (STATS_SHARDS рядків) і підсумки розсилок,
+# без COUNT(*) по users
+def get_user_stats():
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute("""
+                SELECT
+                    (SELECT SUM(total) FROM user_stats_counters) AS total,
+                    (SELECT SUM(subscribed) FROM user_stats_counters) AS subscribed,
+                    (SELECT SUM(blocked) FROM user_stats_counters) AS blocked,
+                    (SELECT SUM(with_contact) FROM user_stats_counters) AS with_contact,
+                    (SELECT MIN(recounted_at) FROM user_stats_counters) AS recounted_at,
+                    COUNT(*) AS broadcasts,
+                    COALESCE(SUM(sent), 0) AS broadcast_sent,
+                    COALESCE(SUM(blocked), 0) AS broadcast_blocked,
+                    COALESCE(SUM(errors), 0) AS broadcast_errors
+                FROM broadcast_jobs
+            """)
+            row = cur.fetchone()
+            return {key: (int(value) if key != 'recounted_at' and value is not None else value) for key, value in row.items()}
+    except Exception as e:
+        logger.error(f"Помилка отримання статистики: {e}")
+        return None
+
+STATS_COUNTERS = ('total', 'subscribed', 'blocked', 'with_contact')
+
+# Точний перерахунок лічильників статистики (виправляє можливий дрейф) без блокування записів.
+# Тригер змінює лічильники в тій самій транзакції, що й users, тож в одному знімку
+# (REPEATABLE READ) лічильники мають точно збігатися з підрахунком по users; різниця — дрейф.
+# Його додаємо до лічильників окремим коротким UPDATE, тож зміни після знімка, які тригер
+# уже врахував, не губляться. Повертає сумарний дрейф або None при помилці.
+def recount_user_stats():
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+            cur.execute(f"SELECT shard, {', '.join(STATS_COUNTERS)} FROM user_stats_counters")
+            counted = {row[0]: row[1:] for row in cur.fetchall()}
+            cur.execute(f"""
+                SELECT user_id % {STATS_SHARDS} AS shard,
+                       COUNT(*),
+                       COUNT(*) FILTER (WHERE {RECIPIENTS_SUBSCRIBED}),
+                       COUNT(*) FILTER (WHERE is_blocked),
+                       COUNT(*) FILTER (WHERE COALESCE(phone_number, '') <> '')
+                FROM users
+                GROUP BY 1
+            """)
+            exact = {row[0]: row[1:] for row in cur.fetchall()}
+            conn.commit()
+
+            zero = (0,) * len(STATS_COUNTERS)
+            deltas = [
+                (shard, *(e - c for e, c in zip(exact.get(shard, zero), values)))
+                for shard, values in counted.items()
+            ]
+            execute_values(
+                cur,
+                """
+                UPDATE user_stats_counters c
+                SET total = c.total + d.total,
+                    subscribed = c.subscribed + d.subscribed,
+                    blocked = c.blocked + d.blocked,
+                    with_contact = c.with_contact + d.with_contact,
+                    recounted_at = NOW()
+                FROM (VALUES %s) AS d (shard, total, subscribed, blocked, with_contact)
+                WHERE c.shard = d.shard
+                """,
+                deltas,
+                template="(%s::smallint, %s::bigint, %s::bigint, %s::bigint, %s::bigint)",
+            )
+            conn.commit()
+            return {key: sum(delta[k + 1] for delta in deltas) for k, key in enumerate(STATS_COUNTERS)}
+    except Exception as e:
+        logger.error(f"Помилка перерахунку статистики: {e}")
+        return None
+
+# Кроки воронки онбордингу в порядку проходження
+FUNNEL_STEPS = ["start", "contact", "invite", "subscribed", "region_menu"]
+# Меню регіонів до появи типу region_menu логувалося як text з цим початком
+REGION_MENU_LEGACY_PREFIX = "Тепер ви можете знаходити замовлення%"
+
+# Крок воронки для рядка message_logs (NULL — рядок до воронки не належить)
+FUNNEL_STEP_SQL = """
+    CASE
+        WHEN direction = 'in' AND message_type = 'command' AND content = '/start' THEN 'start'
+        WHEN direction = 'in' AND message_type = 'contact' THEN 'contact'
+        WHEN direction = 'out' AND message_type = 'invite' THEN 'invite'
+        WHEN direction = 'in' AND message_type = 'subscribed' THEN 'subscribed'
+        WHEN direction = 'out' AND (message_type = 'region_menu'
+            OR (message_type = 'text' AND content LIKE %(legacy_region_menu)s)) THEN 'region_menu'
+    END
+"""
+
+# Обробка наступного відрізка message_logs для агрегатів воронки.
+# Відрізок [high_water, min(high_water + slice_seconds, NOW() - lag_seconds)) агрегується одним
+# запитом за created_at (BRIN-індекс), тож живі вставки в поточну секцію не блокуються, а з
+# message_logs читаються лише нові рядки. lag_seconds залишає час дописатися пачкам log_writer,
+# чий created_at (час початку транзакції) трохи старший за коміт.
+# Агрегати й high_water оновлюються в одній транзакції, тож кожен рядок рахується рівно раз.
+# Повертає (новий high_water, чи наздогнали) або None при помилці.
+def rollup_funnel_slice(slice_seconds=3600, lag_seconds=60):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("INSERT INTO rollup_state (name) VALUES ('funnel') ON CONFLICT DO NOTHING")
+            cur.execute("SELECT high_water FROM rollup_state WHERE name = 'funnel' FOR UPDATE")
+            start = cur.fetchone()[0]
+            if start is None:
+                # Перший запуск: агрегуємо всю наявну історію з найстарішого рядка
+                cur.execute("SELECT date_trunc('hour', MIN(created_at)) FROM message_logs")
+                start = cur.fetchone()[0]
+                if start is None:
+                    conn.commit()
+                    return None, True
+            cur.execute(
+                "SELECT LEAST(%s::timestamptz + %s * INTERVAL '1 second', NOW() - %s * INTERVAL '1 second')",
+                (start, slice_seconds, lag_seconds),
+            )
+            end = cur.fetchone()[0]
+            if end <= start:
+                conn.commit()
+                return start, True
+            params = {'start': start, 'end': end, 'legacy_region_menu': REGION_MENU_LEGACY_PREFIX}
+            cur.execute(
+                f"""
+                WITH events AS (
+                    SELECT user_id, created_at, step
+                    FROM (
+                        SELECT user_id, created_at, {FUNNEL_STEP_SQL} AS step
+                        FROM message_logs
+                        WHERE created_at >= %(start)s AND created_at < %(end)s
+                    ) e
+                    WHERE step IS NOT NULL
+                ),
+                firsts AS (
+                    INSERT INTO funnel_user_steps (user_id, step, first_at)
+                    SELECT user_id, step, MIN(created_at) FROM events GROUP BY user_id, step
+                    ON CONFLICT DO NOTHING
+                    RETURNING step, first_at
+                ),
+                counts AS (
+                    SELECT date_trunc('hour', created_at AT TIME ZONE 'UTC') AS bucket, step, COUNT(*) AS events, 0 AS users
+                    FROM events GROUP BY 1, 2
+                    UNION ALL
+                    SELECT date_trunc('hour', first_at AT TIME ZONE 'UTC'), step, 0, COUNT(*)
+                    FROM firsts GROUP BY 1, 2
+                )
+                INSERT INTO funnel_hourly (bucket, step, events, users)
+                SELECT bucket, step, SUM(events), SUM(users) FROM counts GROUP BY bucket, step
+                ON CONFLICT (bucket, step) DO UPDATE
+                SET events = funnel_hourly.events + EXCLUDED.events,
+                    users = funnel_hourly.users + EXCLUDED.users
+                """,
+                params,
+            )
+            # Щоденні агрегати перераховуються з погодинних для зачеплених днів (≤ 24 рядки на крок)
+            cur.execute(
+                """
+                INSERT INTO funnel_daily (day, step, events, users)
+                SELECT bucket::date, step, SUM(events), SUM(users)
+                FROM funnel_hourly
+                WHERE bucket >= (%(start)s::timestamptz AT TIME ZONE 'UTC')::date
+                  AND bucket < %(end)s::timestamptz AT TIME ZONE 'UTC'
+                GROUP BY 1, 2
+                ON CONFLICT (day, step) DO UPDATE
+                SET events = EXCLUDED.events, users = EXCLUDED.users
+                """,
+                params,
+            )
+            cur.execute(
+                "UPDATE rollup_state SET high_water = %s, updated_at = NOW() WHERE name = 'funnel'",
+                (end,),
+            )
+            conn.commit()
+            return end, end < start + timedelta(seconds=slice_seconds)
+    except Exception as e:
+        logger.error(f"Помилка агрегації воронки: {e}")
+        return None
+
+# Підсумки воронки з агрегатів: {крок: {'events', 'users'}} і high_water.
+# hours — останні N годин з funnel_hourly, інакше days — останні N днів з funnel_daily (UTC).
+# Повертає None при помилці.
+def fetch_funnel_totals(days=7, hours=None):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            if hours is not None:
+                cur.execute(
+                    """
+                    SELECT step, SUM(events) AS events, SUM(users) AS users
+                    FROM funnel_hourly
+                    WHERE bucket >= date_trunc('hour', NOW() AT TIME ZONE 'UTC') - (%s - 1) * INTERVAL '1 hour'
+                    GROUP BY step
+                    """,
+                    (hours,),
+                )
+            else:
+                cur.execute(
+                    """
+                    SELECT step, SUM(events) AS events, SUM(users) AS users
+                    FROM funnel_daily
+                    WHERE day >= (NOW() AT TIME ZONE 'UTC')::date - (%s - 1)
+                    GROUP BY step
+                    """,
+                    (days,),
+                )
+            totals = {step: {'events': 0, 'users': 0} for step in FUNNEL_STEPS}
+            for row in cur.fetchall():
+                totals[row['step']] = {'events': int(row['events']), 'users': int(row['users'])}
+            cur.execute("SELECT high_water FROM rollup_state WHERE name = 'funnel'")
+            row = cur.fetchone()
+            return {'steps': totals, 'high_water': row['high_water'] if row else None}
+    except Exception as e:
+        logger.error(f"Помилка отримання воронки: {e}")
+        return None
+
+
+# Асинхронний доступ до БД для обробників.
+# Синхронні функції вище лишаються основною реалізацією; async-версії виконують їх
+# в обмеженому пулі потоків, щоб запити до БД не блокували event loop.
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(DB_POOL_MAX)))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+    return _executor
+
+# Виконується в потоці виконавця: результат функції і чи була в ній помилка БД
+def _call_db(func, args, kwargs):
+    _db_call.failed = False
+    result = func(*args, **kwargs)
+    return result, _db_call.failed
+
+async def run_db(func, *args, **kwargs):
+    """Виконує синхронну функцію БД у пулі потоків і повертає її результат.
+
+    Одночасно виконується не більше DB_EXECUTOR_WORKERS викликів, решта чекає в черзі
+    виконавця. За замовчуванням це дорівнює DB_POOL_MAX, тому потоки не чекають на
+    з'єднання з пулу. Помилки обробляються так само, як у синхронній функції.
+    """
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        result, failed = await loop.run_in_executor(_get_executor(), _call_db, func, args, kwargs)
+        if failed:
+            outcome = "error"
+        return result
+    except Exception:
+        outcome = "error"
+        raise
     finally:
-        if conn is not None:
-            conn.close()
+        db_seconds.observe(time.perf_counter() - started, function=getattr(func, "__name__", "unknown"), outcome=outcome)
+
+# Зупинка пулу потоків (після завершення всіх запитів)
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+
+# Виконання записів однієї дії користувача (UnitOfWork) в одній транзакції на одному з'єднанні.
+# Повертає результати операцій по порядку або None, якщо транзакцію не закомічено.
+def execute_unit_of_work(ops):
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            results = [op(cur, *args) for op, args in ops]
+            conn.commit()
+            return results
+    except Exception as e:
+        logger.error(f"Помилка запису змін ({len(ops)} операцій): {e}")
+        return None
+
+class UnitOfWork:
+    """Накопичує записи, які робить обробка одного оновлення, і виконує їх разом.
+
+    Операції виконуються в одній транзакції на одному з'єднанні за один виклик run_db
+    (замість окремого з'єднання й коміту на кожну). Логи переписки сюди не входять:
+    їх уже пачками з багатьох оновлень пише message_log.
+    """
+
+    def __init__(self):
+        self._ops = []
+        self._after_commit = []
+        self._results = []
+
+    def save_user(self, user_id, username=None, first_name=None, last_name=None, language_code=None, on_changed=None):
+        """Upsert профілю. on_changed() викликається після коміту, якщо рядок у БД змінився.
+        Повертає False, якщо профіль збігається з кешованим і запис не потрібен."""
+        profile = (username, first_name, last_name, language_code)
+        if _profile_unchanged(user_id, profile):
+            return False
+        index = len(self._ops)
+        self._ops.append((_save_user, (user_id, *profile)))
+        self.after_commit(lambda: _remember_profile(user_id, profile))
+        if on_changed is not None:
+            self.after_commit(lambda: on_changed() if self._results[index] else None)
+        return True
+
+    def save_contact(self, user_id, phone_number, first_name=None, last_name=None):
+        self._ops.append((_save_contact, (user_id, phone_number, first_name, last_name)))
+        # Ім'я з контакту переписує профіль, тож кешований профіль застарів
+        self.after_commit(lambda: forget_profile(user_id))
+
+    def update_subscription_status(self, user_id, is_subscribed):
+        self._ops.append((_update_subscription_status, (user_id, is_subscribed)))
+
+    def schedule_followup(self, user_id, chat_id, kind, delay_seconds):
+        self._ops.append((_schedule_followup, (user_id, chat_id, kind, delay_seconds)))
+
+    def cancel_followup(self, user_id, kind):
+        self._ops.append((_cancel_followup, (user_id, kind)))
+
+    def after_commit(self, callback):
+        """callback() викликається після успішного коміту; корутину, яку він поверне, буде дочекано."""
+        self._after_commit.append(callback)
+
+    async def commit(self):
+        if not self._ops:
+            return True
+        ops, callbacks = self._ops, self._after_commit
+        self._ops, self._after_commit = [], []
+        results = await run_db(execute_unit_of_work, ops)
+        if results is None:
+            return False
+        self._results = results
+        for callback in callbacks:
+            result = callback()
+            if inspect.isawaitable(result):
+                await result
+        return True
+
+# Записи обробника: async with unit_of_work() as uow: uow.update_subscription_status(...)
+# Зміни записуються одним комітом при нормальному виході з блоку; якщо блок завершився
+# винятком, накопичені записи відкидаються, а виняток іде далі.
+@asynccontextmanager
+async def unit_of_work():
+    uow = UnitOfWork()
+    yield uow
+    await uow.commit()
+
+async def count_recipients_async(subscribed_only=True):
+    return await run_db(count_recipients, subscribed_only)
+
+# Потокова видача отримувачів: сторінки підтягуються по мірі споживання,
+# тож увесь список ніколи не тримається в пам'яті
+async def iter_recipients(subscribed_only=True, page_size=1000, after_user_id=None, job_id=None, until_user_id=None):
+    while True:
+        page = await run_db(fetch_recipients_page, subscribed_only, after_user_id, page_size, job_id, until_user_id)
+        if page is None:
+            raise RuntimeError(f"Не вдалося завантажити отримувачів після user_id={after_user_id}")
+        for user_id in page:
+            yield user_id
+        if len(page) < page_size:
+            return
+        after_user_id = page[-1]
+
+# Потокова історія користувача (від новіших): сторінки підтягуються по мірі споживання
+async def iter_user_history(user_id, page_size=100, before=None):
+    while True:
+        page = await run_db(fetch_user_history_page, user_id, before, page_size)
+        if page is None:
+            raise RuntimeError(f"Не вдалося завантажити історію користувача {user_id}")
+        for row in page:
+            yield row
+        if len(page) < page_size:
+            return
+        before = (page[-1]['created_at'], page[-1]['id'])
+
+# Потокові логи за вікном [start, end) (від старіших). Вікно проходиться відрізками від
+# slice_length, щоб кожен запит читав лише кілька діапазонів BRIN, а не весь залишок вікна;
+# порожні й майже порожні відрізки подовжуються, тож кількість запитів не залежить від довжини вікна.
+async def iter_log_window(start, end, page_size=500, after=None, slice_length=timedelta(hours=1)):
+    length = slice_length
+    slice_start = max(start, after[0]) if after else start
+    while slice_start < end:
+        slice_end = min(end, slice_start + length)
+        dense = False
+        while True:
+            page = await run_db(fetch_log_window_page, slice_start, slice_end, after, page_size)
+            if page is None:
+                raise RuntimeError(f"Не вдалося завантажити логи за {slice_start} - {slice_end}")
+            for row in page:
+                yield row
+            if len(page) < page_size:
+                break
+            after = (page[-1]['created_at'], page[-1]['id'])
+            # Щільний відрізок: решту читаємо відрізками базової довжини, щоб сортування було коротким
+            dense = True
+            slice_end = min(slice_end, page[-1]['created_at'] + slice_length)
+        slice_start = slice_end
+        # Розріджені відрізки подвоюються: вікно за рік з кількома рядками — десятки запитів, а не 8760
+        length = slice_length if dense else length * 2
+
+async def mark_users_blocked_async(user_ids):
+    return await run_db(mark_users_blocked, user_ids)
+
+async def get_user_stats_async():
+    return await run_db(get_user_stats)
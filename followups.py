@@ -0,0 +1,108 @@
+import os
+import asyncio
+import logging
+from database import (
+    run_db,
+    claim_due_followups,
+    finish_followups,
+    retry_followup,
+    next_followup_delay,
+)
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Параметри планувальника відкладених повідомлень
+FOLLOWUP_BATCH_SIZE = int(os.getenv("FOLLOWUP_BATCH_SIZE", "50"))  # скільки повідомлень забирати за раз
+FOLLOWUP_POLL_INTERVAL = float(os.getenv("FOLLOWUP_POLL_INTERVAL", "5"))  # найдовша пауза між перевірками черги
+FOLLOWUP_LEASE_SECONDS = int(os.getenv("FOLLOWUP_LEASE_SECONDS", "60"))  # після цього повідомлення впалого процесу бере інший
+FOLLOWUP_MAX_ATTEMPTS = int(os.getenv("FOLLOWUP_MAX_ATTEMPTS", "3"))
+FOLLOWUP_RETRY_DELAY = float(os.getenv("FOLLOWUP_RETRY_DELAY", "30"))  # секунд до повтору після помилки (множиться на номер спроби)
+
+
+class FollowupScheduler:
+    """Відкладені повідомлення, що зберігаються в таблиці scheduled_followups.
+
+    Замість окремої задачі зі sleep на кожного користувача один цикл забирає з БД
+    пачки рядків, час яких настав, і викликає обробник для їхнього kind. Тож пам'ять
+    не залежить від кількості запланованих повідомлень, а черга переживає перезапуск.
+    Рядок видаляється лише після успішної обробки; якщо процес впав, оренда спливає
+    і повідомлення обробляється ще раз.
+
+    handlers — {kind: async def handler(user_id, chat_id)}.
+    """
+
+    def __init__(self, handlers, batch_size=FOLLOWUP_BATCH_SIZE, poll_interval=FOLLOWUP_POLL_INTERVAL,
+                 lease_seconds=FOLLOWUP_LEASE_SECONDS, max_attempts=FOLLOWUP_MAX_ATTEMPTS):
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+    def wake(self):
+        """Перерахувати паузу циклу після планування через UnitOfWork (цикл міг заснути до пізнішого повідомлення)."""
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+        logger.info("Планувальник відкладених повідомлень запущено")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        # Поточна пачка дообробляється; необроблені рядки лишаються в БД
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        logger.info("Планувальник відкладених повідомлень зупинено")
+
+    async def _sleep(self):
+        # Скидаємо сигнал до читання строку: wake() після цього моменту перерве очікування
+        self._wakeup.clear()
+        if self._stopping:
+            return
+        delay = await run_db(next_followup_delay)
+        timeout = self.poll_interval if delay is None else min(self.poll_interval, max(delay, 0.1))
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _handle(self, row):
+        user_id, kind = row['user_id'], row['kind']
+        handler = self.handlers.get(kind)
+        if handler is None:
+            logger.error(f"Немає обробника для запланованого повідомлення {kind}, видаляю")
+            return True
+        try:
+            await handler(user_id, row['chat_id'])
+            return True
+        except Exception as e:
+            if row['attempts'] >= self.max_attempts:
+                logger.error(f"{kind} для {user_id} не вдалося після {row['attempts']} спроб, видаляю: {e}")
+                return True
+            logger.warning(f"{kind} для {user_id} не вдалося (спроба {row['attempts']}), повторю: {e}")
+            await run_db(retry_followup, user_id, kind, FOLLOWUP_RETRY_DELAY * row['attempts'])
+            return False
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                rows = await run_db(claim_due_followups, self.batch_size, self.lease_seconds)
+                if not rows:
+                    await self._sleep()
+                    continue
+                results = await asyncio.gather(*(self._handle(row) for row in rows))
+                done = [(row['user_id'], row['kind']) for row, ok in zip(rows, results) if ok]
+                await run_db(finish_followups, done)
+            except Exception as e:
+                logger.error(f"Помилка планувальника відкладених повідомлень: {e}")
+                await asyncio.sleep(self.poll_interval)
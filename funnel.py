@@ -0,0 +1,114 @@
+import os
+import asyncio
+import logging
+from datetime import timezone
+from telegram import Update
+from telegram.ext import ContextTypes
+from broadcast import ADMIN_ID
+from database import run_db, rollup_funnel_slice, fetch_funnel_totals, FUNNEL_STEPS
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Параметри агрегації воронки онбордингу
+FUNNEL_ROLLUP_INTERVAL = float(os.getenv("FUNNEL_ROLLUP_INTERVAL", "60"))  # пауза, коли нові логи оброблено
+FUNNEL_ROLLUP_SLICE = int(os.getenv("FUNNEL_ROLLUP_SLICE", "3600"))  # секунд message_logs за одну транзакцію
+FUNNEL_ROLLUP_LAG = int(os.getenv("FUNNEL_ROLLUP_LAG", "60"))  # не чіпати логи, новіші за N секунд
+FUNNEL_DEFAULT_DAYS = 7
+
+STEP_TITLES = {
+    "start": "/start",
+    "contact": "Поділилися контактом",
+    "invite": "Отримали інвайт",
+    "subscribed": "Підписалися",
+    "region_menu": "Меню регіонів",
+}
+
+USAGE = (
+    "Використання:\n"
+    f"• /funnel [днів] — воронка за останні дні (за замовчуванням {FUNNEL_DEFAULT_DAYS})\n"
+    "• /funnel <годин>h — воронка за останні години, напр. /funnel 24h"
+)
+
+
+class FunnelRollup:
+    """Інкрементальна агрегація message_logs у funnel_hourly і funnel_daily.
+
+    Обробляє логи відрізками від збереженої позначки (rollup_state), тож кожен рядок
+    читається один раз, а звіт /funnel читає лише агрегати. Після простою (чи першого
+    запуску) наздоганяє відрізок за відрізком, потім перевіряє нові логи раз на interval.
+    """
+
+    def __init__(self, interval=FUNNEL_ROLLUP_INTERVAL, slice_seconds=FUNNEL_ROLLUP_SLICE, lag_seconds=FUNNEL_ROLLUP_LAG):
+        self.interval = interval
+        self.slice_seconds = slice_seconds
+        self.lag_seconds = lag_seconds
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                result = await run_db(rollup_funnel_slice, self.slice_seconds, self.lag_seconds)
+                if result is not None and not result[1]:
+                    # Ще не наздогнали — одразу наступний відрізок
+                    continue
+            except Exception as e:
+                logger.error(f"Помилка агрегації воронки: {e}")
+            await asyncio.sleep(self.interval)
+
+
+def _percent(part, whole):
+    return f"{part / whole * 100:.1f}%" if whole else "—"
+
+
+# Обробник команди /funnel: читає лише агрегати воронки
+async def funnel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("Ця команда доступна лише адміністратору!")
+        return
+    args = list(context.args or [])
+    try:
+        if args and args[0].lower().endswith("h"):
+            hours, days = max(1, int(args[0][:-1])), None
+            period = f"останні {hours} год"
+        else:
+            hours, days = None, max(1, int(args[0])) if args else FUNNEL_DEFAULT_DAYS
+            period = f"останні {days} дн"
+    except ValueError:
+        await update.message.reply_text(USAGE)
+        return
+
+    data = await run_db(fetch_funnel_totals, days, hours)
+    if data is None:
+        await update.message.reply_text("Помилка: не вдалося отримати воронку")
+        return
+    steps = data['steps']
+    first = steps[FUNNEL_STEPS[0]]['users']
+    lines = [f"Воронка онбордингу за {period} (UTC):", ""]
+    previous = None
+    for step in FUNNEL_STEPS:
+        users = steps[step]['users']
+        line = f"{STEP_TITLES[step]}: {users} ({_percent(users, first)} від /start"
+        if previous is not None:
+            line += f", {_percent(users, previous)} від попереднього кроку"
+        lines.append(line + f"; подій: {steps[step]['events']})")
+        previous = users
+    high_water = data['high_water']
+    lines.append("")
+    lines.append("Користувачі враховуються в період, коли вперше дійшли до кроку.")
+    lines.append(f"Дані до: {f'{high_water.astimezone(timezone.utc):%Y-%m-%d %H:%M} UTC' if high_water else '—'}")
+    await update.message.reply_text("\n".join(lines))
@@ -0,0 +1,121 @@
+import logging
+from datetime import datetime, timezone
+from telegram import Update
+from telegram.ext import ContextTypes
+from broadcast import ADMIN_ID
+from database import iter_user_history, iter_log_window
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+HISTORY_DEFAULT_LIMIT = 20
+HISTORY_MAX_LIMIT = 100
+HISTORY_CONTENT_PREVIEW = 200  # символів вмісту на рядок
+TELEGRAM_TEXT_LIMIT = 4000
+
+USAGE = (
+    "Використання:\n"
+    "• /history <user_id> [кількість] — остання переписка користувача\n"
+    "• /history <від> <до> [кількість] — усі повідомлення за період (UTC, напр. 2026-10-01T00:00 2026-10-01T06:00)\n"
+    f"Кількість — до {HISTORY_MAX_LIMIT}. Наступну сторінку бот підкаже командою з курсором."
+)
+
+
+def _parse_time(value):
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+# Курсор keyset-пагінації: "<id>@<created_at>"
+def format_cursor(row):
+    return f"{row['id']}@{row['created_at'].isoformat()}"
+
+
+def parse_cursor(value):
+    row_id, created_at = value.split("@", 1)
+    return (_parse_time(created_at), int(row_id))
+
+
+def format_row(row, with_user=False):
+    arrow = "👤" if row['direction'] == 'in' else "🤖"
+    content = (row['content'] or "").replace("\n", " ")
+    if len(content) > HISTORY_CONTENT_PREVIEW:
+        content = content[:HISTORY_CONTENT_PREVIEW] + "…"
+    user = f"{row['user_id']} " if with_user else ""
+    return f"{row['created_at']:%Y-%m-%d %H:%M:%S} {user}{arrow} {row['message_type']}: {content}"
+
+
+async def _collect(rows, limit):
+    """Перші limit рядків потоку і ознака, що є ще."""
+    collected = []
+    async for row in rows:
+        if len(collected) == limit:
+            return collected, True
+        collected.append(row)
+    return collected, False
+
+
+async def _reply_chunked(update: Update, lines):
+    chunk = []
+    size = 0
+    for line in lines:
+        if chunk and size + len(line) + 1 > TELEGRAM_TEXT_LIMIT:
+            await update.message.reply_text("\n".join(chunk))
+            chunk, size = [], 0
+        chunk.append(line)
+        size += len(line) + 1
+    if chunk:
+        await update.message.reply_text("\n".join(chunk))
+
+
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /history: історія переписки користувача або всі повідомлення за період.
+
+    Сторінки читаються keyset-курсором (created_at, id), тож кожна сторінка — індексний
+    пошук, а не OFFSET по мільйонах рядків.
+    """
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("Ця команда доступна лише адміністратору!")
+        return
+    args = list(context.args or [])
+    try:
+        if args and args[0].lstrip("-").isdigit():
+            user_id = int(args[0])
+            limit = int(args[1]) if len(args) > 1 else HISTORY_DEFAULT_LIMIT
+            cursor = parse_cursor(args[2]) if len(args) > 2 else None
+            window = None
+        elif len(args) >= 2:
+            window = (_parse_time(args[0]), _parse_time(args[1]))
+            limit = int(args[2]) if len(args) > 2 else HISTORY_DEFAULT_LIMIT
+            cursor = parse_cursor(args[3]) if len(args) > 3 else None
+        else:
+            await update.message.reply_text(USAGE)
+            return
+    except ValueError:
+        await update.message.reply_text(USAGE)
+        return
+    limit = max(1, min(limit, HISTORY_MAX_LIMIT))
+
+    try:
+        if window is None:
+            rows, more = await _collect(iter_user_history(user_id, page_size=limit + 1, before=cursor), limit)
+            header = f"Історія користувача {user_id} (від новіших):"
+            next_command = f"/history {user_id} {limit}"
+        else:
+            rows, more = await _collect(iter_log_window(window[0], window[1], page_size=limit + 1, after=cursor), limit)
+            header = f"Повідомлення за {args[0]} — {args[1]}:"
+            next_command = f"/history {args[0]} {args[1]} {limit}"
+    except RuntimeError as e:
+        logger.error(f"Помилка /history: {e}")
+        await update.message.reply_text("Помилка: не вдалося завантажити історію")
+        return
+
+    if not rows:
+        await update.message.reply_text("Повідомлень не знайдено")
+        return
+    lines = [header] + [format_row(row, with_user=window is not None) for row in rows]
+    if more:
+        lines.append(f"\nДалі: {next_command} {format_cursor(rows[-1])}")
+    await _reply_chunked(update, lines)
@@ -0,0 +1,66 @@
+import os
+import asyncio
+import logging
+from database import run_db, ensure_message_log_partitions, archive_message_log_partitions, prune_broadcast_deliveries
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Параметри обслуговування секцій message_logs
+MESSAGE_LOG_PARTITIONS_AHEAD = int(os.getenv("MESSAGE_LOG_PARTITIONS_AHEAD", "3"))  # на скільки місяців уперед створювати секції
+MESSAGE_LOG_RETENTION_MONTHS = int(os.getenv("MESSAGE_LOG_RETENTION_MONTHS", "12"))  # скільки місяців тримати в БД, 0 — без архівування
+MESSAGE_LOG_ARCHIVE_DIR = os.getenv("MESSAGE_LOG_ARCHIVE_DIR", "archive/message_logs")  # куди писати .csv.gz старих секцій
+MESSAGE_LOG_MAINTENANCE_INTERVAL = float(os.getenv("MESSAGE_LOG_MAINTENANCE_INTERVAL", "86400"))
+BROADCAST_PAUSED_RETENTION_DAYS = int(os.getenv("BROADCAST_PAUSED_RETENTION_DAYS", "30"))  # скасовувати розсилки на паузі довше за N днів, 0 — ніколи
+
+
+class MessageLogMaintenance:
+    """Обслуговування секціонованої message_logs: раз на інтервал створює секції
+    на наступні місяці і архівує та видаляє секції, старші за строк зберігання.
+
+    Старі дані видаляються разом із секцією (DROP TABLE), без DELETE і vacuum,
+    тож вставки в поточну секцію це не зачіпає. Заодно прибирає записи доставки
+    broadcast_deliveries завершених, скасованих і давно призупинених розсилок.
+    """
+
+    def __init__(self, months_ahead=MESSAGE_LOG_PARTITIONS_AHEAD, retention_months=MESSAGE_LOG_RETENTION_MONTHS,
+                 archive_dir=MESSAGE_LOG_ARCHIVE_DIR, interval=MESSAGE_LOG_MAINTENANCE_INTERVAL,
+                 paused_broadcast_days=BROADCAST_PAUSED_RETENTION_DAYS):
+        self.months_ahead = months_ahead
+        self.retention_months = retention_months
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self.paused_broadcast_days = paused_broadcast_days
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def run_once(self):
+        await run_db(ensure_message_log_partitions, self.months_ahead)
+        if self.retention_months > 0:
+            archived = await run_db(archive_message_log_partitions, self.retention_months, self.archive_dir)
+            if archived:
+                logger.info(f"Заархівовано секцій message_logs: {len(archived)}")
+        pruned = await run_db(prune_broadcast_deliveries, self.paused_broadcast_days)
+        if pruned and any(pruned):
+            logger.info(f"Скасовано давно призупинених розсилок: {pruned[0]}, видалено записів доставки: {pruned[1]}")
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Помилка обслуговування message_logs: {e}")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,110 @@
+import os
+import asyncio
+import logging
+from database import run_db, log_message, log_messages_bulk
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Параметри буферизованого запису логів
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "10000"))  # максимальна кількість записів у черзі
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "500"))  # скидаємо пачку, щойно набралося стільки записів
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1.0"))  # або щонайпізніше через стільки секунд
+LOG_PUT_TIMEOUT = float(os.getenv("LOG_PUT_TIMEOUT", "5.0"))  # скільки чекати місця в повній черзі
+
+
+class MessageLogWriter:
+    """Відкладений запис message_logs: обробники кладуть записи в обмежену чергу,
+    фонова задача скидає їх пачками одним багаторядковим INSERT.
+
+    Якщо черга повна, log() чекає на місце до LOG_PUT_TIMEOUT секунд (backpressure),
+    після чого запис відкидається з попередженням. stop() дописує все, що лишилось у черзі.
+    """
+
+    def __init__(self, max_queue=LOG_QUEUE_MAX, batch_size=LOG_BATCH_SIZE,
+                 flush_interval=LOG_FLUSH_INTERVAL, put_timeout=LOG_PUT_TIMEOUT):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._queue = None
+        self._task = None
+        self._stopping = False
+        self.dropped = 0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def qsize(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Буферизований запис логів запущено (batch={self.batch_size}, interval={self.flush_interval}s)")
+
+    async def stop(self):
+        if not self.running:
+            return
+        self._stopping = True
+        await self._task
+        self._task = None
+        logger.info("Буферизований запис логів зупинено, черга дописана")
+
+    async def log(self, user_id: int, direction: str, message_type: str, content: str | None = None, extra: dict | None = None):
+        row = (user_id, direction, message_type, content, extra)
+        if not self.running or self._stopping:
+            # Без фонової задачі пишемо напряму
+            await run_db(log_message, *row)
+            return
+        try:
+            self._queue.put_nowait(row)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self._queue.put(row), timeout=self.put_timeout)
+            except asyncio.TimeoutError:
+                self.dropped += 1
+                logger.warning(f"Черга логів переповнена, запис для {user_id} відкинуто (всього відкинуто: {self.dropped})")
+
+    async def _collect_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        if self._stopping:
+            # При зупинці не чекаємо, а забираємо все, що є
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            return batch
+        try:
+            batch.append(await asyncio.wait_for(self._queue.get(), timeout=self.flush_interval))
+        except asyncio.TimeoutError:
+            return batch
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0 or self._stopping:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while not self._stopping or not self._queue.empty():
+            try:
+                batch = await self._collect_batch()
+                if batch and not await run_db(log_messages_bulk, batch):
+                    logger.error(f"Не вдалося записати пачку з {len(batch)} логів")
+            except Exception as e:
+                logger.error(f"Помилка фонового запису логів: {e}")
+
+
+# Спільний екземпляр для обробників
+message_log = MessageLogWriter()
@@ -1,14 +1,39 @@
 import os
 import signal
+import asyncio
 import logging
 import time
-import asyncio
-import psycopg2
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram.ext import Application, CallbackContext, CommandHandler, CallbackQueryHandler, ChatMemberHandler, ContextTypes, MessageHandler, TypeHandler, filters
 from telegram.error import TelegramError, Conflict
-from broadcast import broadcast  # Імпорт broadcast з окремого файлу
-from database import init_db, load_users, save_user, update_subscription_status, update_blocked_status, save_contact, log_message  # Імпорт з database.py
+from broadcast import broadcast, broadcast_pause, broadcast_resume, broadcast_cancel, broadcast_jobs  # Імпорт broadcast з окремого файлу
+from broadcast_jobs import start_inprocess_worker, stop_inprocess_worker, start_progress_reporter, stop_progress_reporter, BROADCAST_INPROCESS_WORKER
+from log_writer import message_log
+from history import history
+from stats import stats, StatsRecount
+from funnel import funnel, FunnelRollup
+from media_registry import media_registry
+from subscription_cache import SubscriptionCache, SUBSCRIBED_STATUSES
+from subscription_sync import SubscriptionReconciler
+from followups import FollowupScheduler
+from update_processor import PerUserUpdateProcessor
+from update_intake import filter_update, mark_update_processed, answer_callback, processed_updates, ProcessedUpdatesPruner, DROP_PENDING_UPDATES, UPDATE_DONE_GROUP
+from coordination import SingletonJob, CacheBus
+from migrations import BackgroundMigrations
+from log_retention import MessageLogMaintenance
+from metrics import MetricsServer, MetricsRequest, track_handler, queue_size, db_pool_connections
+from webhook_server import WebhookServer, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS
+from database import (  # Імпорт з database.py
+    init_db,
+    forget_profile,
+    clear_profile_cache,
+    unit_of_work,
+    set_subscription_statuses,
+    run_db,
+    pool_stats,
+    close_pool,
+    shutdown_executor,
+)
 
 # Налаштування логування
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -18,19 +43,42 @@ logger = logging.getLogger(__name__)
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 CHANNEL_ID = "-1002834216129"  # Перевірте та оновіть цей ID для https://t.me/+QPGNI10IfqU5MGEy
 CHANNEL_LINK = "https://t.me/+ZzEgiQVCP6s2Y2Ji"  # Посилання на канал
-DATABASE_URL = os.getenv("DATABASE_URL")
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling або webhook
+
+# Кеш статусів підписки на канал (оновлюється також з chat_member)
+subscription_cache = SubscriptionCache(CHANNEL_ID)
+subscription_reconciler = None  # фонова звірка підписок, створюється в on_startup
+
+# Відкладені повідомлення (таблиця scheduled_followups), створюється в on_startup
+CONTACT_FOLLOWUP = "contact_followup"
+CONTACT_FOLLOWUP_DELAY = 60  # секунд після надання контакту
+followup_scheduler = None
+processed_updates_pruner = ProcessedUpdatesPruner()
+
+# Координація кількох інстансів через Postgres: фонові задачі в одному інстансі,
+# інвалідація кешів між інстансами через LISTEN/NOTIFY
+cache_bus = CacheBus()
+singleton_jobs = []
+background_migrations = BackgroundMigrations()  # міграції даних, що лишились після init_db
+message_log_maintenance = MessageLogMaintenance()  # секції message_logs і архівування старих
+stats_recount = StatsRecount()  # звірка лічильників /stats з users
+funnel_rollup = FunnelRollup()  # агрегати воронки онбордингу з message_logs
+metrics_server = MetricsServer()  # локальний /metrics (METRICS_PORT, METRICS_LISTEN)
 
 # Обробник команди /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-    save_user(
-        user.id,
-        username=user.username,
-        first_name=user.first_name,
-        last_name=user.last_name,
-        language_code=user.language_code
-    )
-    log_message(user.id, 'in', 'command', '/start', extra={'username': user.username})
+    async with unit_of_work() as uow:
+        uow.save_user(
+            user.id,
+            username=user.username,
+            first_name=user.first_name,
+            last_name=user.last_name,
+            language_code=user.language_code,
+            # Профіль змінився — інші інстанси скидають його з кешу
+            on_changed=lambda: cache_bus.publish('profile', {'user_id': user.id}),
+        )
+    await message_log.log(user.id, 'in', 'command', '/start', extra={'username': user.username})
     
     # Створюємо клавіатуру для запиту контактів
     keyboard = [[KeyboardButton("Поділитися контактом", request_contact=True)]]
@@ -40,13 +88,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Вітаємо {user.first_name}! Для продовження роботи потрібно поділитися вашим контактом.",
         reply_markup=reply_markup
     )
-    log_message(user.id, 'out', 'text', 'Запит контакту на старті')
+    await message_log.log(user.id, 'out', 'text', 'Запит контакту на старті')
 
 # Перевірка підписки користувача
 async def is_user_subscribed(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
     try:
-        member = await context.bot.get_chat_member(CHANNEL_ID, user_id)
-        return member.status in ["member", "administrator", "creator"]
+        return await subscription_cache.is_subscribed(context.bot, user_id)
     except TelegramError as e:
         logger.error(f"Не вдалося перевірити підписку для {user_id}: {e}")
         return False
@@ -66,17 +113,16 @@ async def send_channel_invite_message(context: ContextTypes.DEFAULT_TYPE, chat_i
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     try:
-        if os.path.exists(image_path) and os.path.getsize(image_path) > 1000:
-            with open(image_path, "rb") as photo:
-                await context.bot.send_photo(chat_id=chat_id, photo=photo, caption=caption, reply_markup=reply_markup)
-        else:
+        # Після першого завантаження надсилається лише збережений file_id
+        sent = await media_registry.send_photo(context.bot, chat_id, image_path, caption=caption, reply_markup=reply_markup)
+        if sent is None:
             await context.bot.send_message(chat_id=chat_id, text=f"{caption}\n{CHANNEL_LINK}", reply_markup=reply_markup)
         # Лог вихідного повідомлення
-        log_message(chat_id, 'out', 'invite', caption, extra={'with_buttons': True})
+        await message_log.log(chat_id, 'out', 'invite', caption, extra={'with_buttons': True})
     except Exception as e:
         logger.error(f"Помилка відправки інвайту в канал: {e}")
         await context.bot.send_message(chat_id=chat_id, text=f"{caption}\n{CHANNEL_LINK}", reply_markup=reply_markup)
-        log_message(chat_id, 'out', 'invite', caption, extra={'fallback': True, 'with_buttons': True})
+        await message_log.log(chat_id, 'out', 'invite', caption, extra={'fallback': True, 'with_buttons': True})
 
 # Відправка меню регіональних каналів
 async def send_region_menu(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
@@ -98,11 +144,11 @@ async def send_region_menu(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
         "Оберіть свій регіон:"
     )
     await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
-    log_message(chat_id, 'out', 'text', text)
+    await message_log.log(chat_id, 'out', 'region_menu', text)
 
-# Фолов-ап після надання контакту: чек підписки через 60с, нагадування (якщо треба), потім меню регіонів
+# Фолов-ап після надання контакту (через CONTACT_FOLLOWUP_DELAY з планувальника):
+# чек підписки, нагадування (якщо треба), потім меню регіонів
 async def post_contact_followup(context: ContextTypes.DEFAULT_TYPE, user_id: int, chat_id: int):
-    await asyncio.sleep(60)
     subscribed = await is_user_subscribed(context, user_id)
     if not subscribed:
         try:
@@ -113,7 +159,7 @@ async def post_contact_followup(context: ContextTypes.DEFAULT_TYPE, user_id: int
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
-            log_message(user_id, 'out', 'reminder', text)
+            await message_log.log(user_id, 'out', 'reminder', text)
         except Exception as e:
             logger.error(f"Не вдалося надіслати нагадування: {e}")
     # Після цього надсилаємо меню регіонів незалежно від підписки
@@ -126,45 +172,47 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     if contact:
-        # Зберігаємо контакт в базу даних
-        save_contact(
-            user_id=user.id,
-            phone_number=contact.phone_number,
-            first_name=contact.first_name,
-            last_name=contact.last_name,
-        )
-        log_message(user.id, 'in', 'contact', contact.phone_number, extra={'first_name': contact.first_name, 'last_name': contact.last_name})
-        
+        # Контакт і фолов-ап записуються одним комітом до відправок: збій відправки їх не скасує.
+        # Через CONTACT_FOLLOWUP_DELAY: якщо не підписався — нагадаємо; далі відправимо меню регіонів
+        async with unit_of_work() as uow:
+            uow.save_contact(user.id, contact.phone_number, contact.first_name, contact.last_name)
+            uow.schedule_followup(user.id, chat_id, CONTACT_FOLLOWUP, CONTACT_FOLLOWUP_DELAY)
+            uow.after_commit(followup_scheduler.wake)
+            uow.after_commit(lambda: cache_bus.publish('profile', {'user_id': user.id}))
+        await message_log.log(user.id, 'in', 'contact', contact.phone_number, extra={'first_name': contact.first_name, 'last_name': contact.last_name})
+
         # Прибираємо клавіатуру
         await update.message.reply_text(
             "Дякуємо!",
             reply_markup=ReplyKeyboardMarkup([[]], resize_keyboard=True),
         )
-        log_message(user.id, 'out', 'text', 'Підтвердження отримання контакту')
-        
-        # 1) Інвайт у канал з посиланням і (за наявності) зображенням
+        await message_log.log(user.id, 'out', 'text', 'Підтвердження отримання контакту')
+
+        # Інвайт у канал з посиланням і (за наявності) зображенням
         await send_channel_invite_message(context, chat_id)
-        
-        # 2) Через 60с: якщо не підписався — нагадаємо; далі відправимо меню регіонів
-        asyncio.create_task(post_contact_followup(context, user.id, chat_id))
     else:
         await update.message.reply_text("Будь ласка, поділіться вашим контактом для продовження роботи.")
-        log_message(user.id, 'out', 'text', 'Запит повторити надсилання контакту')
+        await message_log.log(user.id, 'out', 'text', 'Запит повторити надсилання контакту')
 
 # Обробник колбека для кнопки підписки та регіонів
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
+    if not await answer_callback(query):
+        return
     user_id = query.from_user.id
-    log_message(user_id, 'in', 'callback', query.data)
+    await message_log.log(user_id, 'in', 'callback', query.data)
     
     if query.data == "subscribe":
         chat_id = CHANNEL_ID  # Використовуємо змінну CHANNEL_ID
         try:
-            member = await context.bot.get_chat_member(chat_id, user_id)
-            logger.info(f"Статус користувача {user_id} у каналі {chat_id}: {member.status}")
-            if member.status in ['member', 'administrator', 'creator']:
-                update_subscription_status(user_id, True)
+            status = await subscription_cache.get_status(context.bot, user_id)
+            logger.info(f"Статус користувача {user_id} у каналі {chat_id}: {status}")
+            if status in SUBSCRIBED_STATUSES:
+                await message_log.log(user_id, 'in', 'subscribed', status)  # крок воронки онбордингу
+                async with unit_of_work() as uow:
+                    uow.update_subscription_status(user_id, True)
+                    # Меню регіонів надсилаємо зараз, тож відкладений фолов-ап уже не потрібен
+                    uow.cancel_followup(user_id, CONTACT_FOLLOWUP)
                 # Після підтвердження підписки показуємо меню регіонів
                 await send_region_menu(context, query.message.chat_id)
             else:
@@ -174,28 +222,28 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     f"Приєднуйтесь до нашого каналу: {CHANNEL_LINK}"
                 )
                 await query.message.reply_text(text)
-                log_message(user_id, 'out', 'text', text)
+                await message_log.log(user_id, 'out', 'text', text)
         except TelegramError as e:
             if "not enough rights" in str(e).lower() or "unauthorized" in str(e).lower():
                 logger.error(f"Бот не має прав для перевірки підписки в каналі {chat_id} для користувача {user_id}: {str(e)}")
                 await query.message.reply_text(
                     "Помилка: бот не має доступу до каналу. Зверніться до адміністратора."
                 )
-                log_message(user_id, 'out', 'text', 'Помилка доступу до каналу при перевірці підписки')
+                await message_log.log(user_id, 'out', 'text', 'Помилка доступу до каналу при перевірці підписки')
             else:
                 logger.error(f"Помилка при перевірці підписки для користувача {user_id}: {str(e)}")
                 await query.message.reply_text(
                     "Помилка перевірки підписки.\n\n"
                     "Спробуйте ще раз або зверніться до адміністратора."
                 )
-                log_message(user_id, 'out', 'text', 'Помилка перевірки підписки')
+                await message_log.log(user_id, 'out', 'text', 'Помилка перевірки підписки')
         except Exception as e:
             logger.error(f"Невідома помилка при перевірці підписки для користувача {user_id}: {str(e)}")
             await query.message.reply_text(
                 "Помилка перевірки підписки.\n\n"
                 "Спробуйте ще раз або зверніться до адміністратора."
             )
-            log_message(user_id, 'out', 'text', 'Невідома помилка перевірки підписки')
+            await message_log.log(user_id, 'out', 'text', 'Невідома помилка перевірки підписки')
     
     elif query.data == "other_regions":
         try:
@@ -206,7 +254,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"Помилка при завантаженні регіонів: {str(e)}\n\n"
                 "Спробуйте ще раз або зверніться до адміністратора."
             )
-            log_message(user_id, 'out', 'text', 'Помилка при завантаженні регіонів')
+            await message_log.log(user_id, 'out', 'text', 'Помилка при завантаженні регіонів')
     
     elif query.data == "main_cities":
         try:
@@ -216,57 +264,121 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.message.reply_text(
                 "Помилка при завантаженні меню. Спробуйте ще раз або зверніться до адміністратора."
             )
-            log_message(user_id, 'out', 'text', 'Помилка при завантаженні меню регіонів')
-
-# Обробник команди /stats
-async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    admin_id = 293102975
-    if user_id != admin_id:
-        await update.message.reply_text("Ця команда доступна лише адміністратору!")
+            await message_log.log(user_id, 'out', 'text', 'Помилка при завантаженні меню регіонів')
+
+# Зміна статусу учасника каналу: оновлюємо кеш і users.is_subscribed без запитів до API
+async def channel_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    member_update = update.chat_member
+    if str(member_update.chat.id) != CHANNEL_ID:
         return
-    
-    conn = None
+    member = member_update.new_chat_member
+    subscription_cache.set(member.user.id, member.status)
+    await cache_bus.publish('subscription', {'user_id': member.user.id, 'status': member.status})
+    subscribed = member.status in SUBSCRIBED_STATUSES
+    await run_db(set_subscription_statuses, [(member.user.id, subscribed)])
+    logger.info(f"Статус користувача {member.user.id} у каналі змінився: {member.status}")
+
+# Запуск фонових задач після ініціалізації додатку
+async def on_startup(application: Application):
+    global subscription_reconciler, followup_scheduler
+    message_log.start()
+    await processed_updates.start()
+
+    # Метрики черг і пулу БД обчислюються під час запиту /metrics
+    queue_size.set_function(message_log.qsize, queue="message_log")
+    queue_size.set_function(application.update_queue.qsize, queue="updates")
+    for state in ('open', 'in_use', 'idle', 'max'):
+        db_pool_connections.set_function(lambda state=state: (pool_stats() or {}).get(state), state=state)
+    metrics_server.start()
+
+    async def contact_followup(user_id, chat_id):
+        context = CallbackContext(application, chat_id=chat_id, user_id=user_id)
+        await post_contact_followup(context, user_id, chat_id)
+
+    # Планувальник безпечний для кількох інстансів (SKIP LOCKED), тож працює в кожному
+    followup_scheduler = FollowupScheduler({CONTACT_FOLLOWUP: contact_followup})
+    followup_scheduler.start()
+
+    def set_subscription(data):
+        subscription_cache.set(data['user_id'], data['status'])
+
+    def drop_profile(data):
+        forget_profile(data['user_id'])
+
+    cache_bus.subscribe('subscription', set_subscription, reset=subscription_cache.clear)
+    cache_bus.subscribe('profile', drop_profile, reset=clear_profile_cache)
+    cache_bus.start()
+
+    # Задачі, що мають працювати лише в одному інстансі
+    subscription_reconciler = SubscriptionReconciler(application.bot, CHANNEL_ID, cache=subscription_cache)
+    singleton_jobs.extend([
+        SingletonJob('subscription_reconciler', subscription_reconciler.start, subscription_reconciler.stop),
+        SingletonJob('processed_updates_pruner', processed_updates_pruner.start, processed_updates_pruner.stop),
+        SingletonJob('broadcast_progress_reporter', lambda: start_progress_reporter(application.bot), stop_progress_reporter),
+        SingletonJob('background_migrations', background_migrations.start, background_migrations.stop),
+        SingletonJob('message_log_maintenance', message_log_maintenance.start, message_log_maintenance.stop),
+        SingletonJob('stats_recount', stats_recount.start, stats_recount.stop),
+        SingletonJob('funnel_rollup', funnel_rollup.start, funnel_rollup.stop),
+    ])
+    for job in singleton_jobs:
+        job.start()
+
+    # Воркер розсилки в процесі бота підхоплює і незавершені до перезапуску розсилки
+    start_inprocess_worker(application, with_worker=BROADCAST_INPROCESS_WORKER)
+
+# Зупинка фонових задач і розсилок до завершення роботи бота (контрольна точка зберігається, розсилка продовжиться після запуску)
+async def on_stop(application: Application):
+    for job in singleton_jobs:
+        await job.stop()
+    await cache_bus.stop()
+    if followup_scheduler is not None:
+        await followup_scheduler.stop()
+    await stop_inprocess_worker()
+    await processed_updates.stop()
+    await metrics_server.stop()
+
+# Коректне завершення: дописуємо буфер логів і закриваємо ресурси БД.
+# Викликається PTB після SIGINT/SIGTERM (stop_signals у run_polling).
+async def on_shutdown(application: Application):
+    logger.info("Отримано сигнал завершення, вимикаю бота...")
+    await message_log.stop()
+    shutdown_executor()
+    close_pool()
+
+# Режим webhook: Application запускається вручну, тож post_init/post_stop/post_shutdown
+# (on_startup/on_stop/on_shutdown) викликаємо самі в тому ж порядку, що й run_polling
+async def run_webhook(application: Application):
+    server = WebhookServer(application, secret_token=WEBHOOK_SECRET)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    await on_startup(application)
     try:
-        # Отримуємо параметри підключення з змінних середовища
-        if DATABASE_URL:
-            # Використовуємо DATABASE_URL
-            conn = psycopg2.connect(DATABASE_URL)
-        else:
-            # Використовуємо окремі параметри
-            conn = psycopg2.connect(
-                dbname=os.getenv("PGDATABASE"),
-                user=os.getenv("PGUSER"),
-                password=os.getenv("PGPASSWORD"),
-                host=os.getenv("PGHOST"),
-                port=os.getenv("PGPORT")
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=DROP_PENDING_UPDATES,
             )
-        
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM users")
-        total_users = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM users WHERE is_subscribed = TRUE AND is_blocked = FALSE")
-        subscribed_users = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM users WHERE is_blocked = TRUE")
-        blocked_users = cur.fetchone()[0]
-        
-        await update.message.reply_text(
-            f"Статистика користувачів:\n\n"
-            f"Загальна кількість: {total_users}\n"
-            f"Підписані на канал: {subscribed_users}\n"
-            f"Заблоковані: {blocked_users}"
-        )
-    except Exception as e:
-        logger.error(f"Помилка при отриманні статистики: {e}")
-        await update.message.reply_text(f"Помилка: {e}")
+            logger.info(f"Webhook зареєстровано: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        else:
+            logger.warning("WEBHOOK_URL не задано: webhook у Telegram не реєструється (локальний режим)")
+        await application.start()
+        server.start()
+        await stop_event.wait()
     finally:
-        if conn:
-            conn.close()
-
-# Обробник сигналів для коректного завершення
-def signal_handler(sig, frame):
-    logger.info("Отримано сигнал завершення, вимикаю бота...")
-    os._exit(0)
+        await server.stop()
+        if application.running:
+            await application.stop()
+        await on_stop(application)
+        await application.shutdown()
+        await on_shutdown(application)
 
 # Ініціалізація та запуск бота
 if __name__ == "__main__":
@@ -275,30 +387,53 @@ if __name__ == "__main__":
         logger.error("TELEGRAM_BOT_TOKEN не знайдено в змінних середовища!")
         exit(1)
     
-    # Налаштування обробки сигналів
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-    
     # Ініціалізація бази даних
     init_db()
 
     # Створення додатку з правильними таймаутами
     application = (Application.builder()
                   .token(TOKEN)
-                  .get_updates_read_timeout(30)
-                  .get_updates_write_timeout(30)
-                  .get_updates_connect_timeout(30)
-                  .get_updates_pool_timeout(30)
+                  # Запити до Bot API з метриками часу і кодів відповіді
+                  .request(MetricsRequest(connection_pool_size=256))
+                  .get_updates_request(MetricsRequest(read_timeout=30, write_timeout=30, connect_timeout=30, pool_timeout=30))
+                  # Оновлення різних користувачів обробляються паралельно, одного — по черзі
+                  .concurrent_updates(PerUserUpdateProcessor())
+                  .post_init(on_startup)
+                  .post_stop(on_stop)
+                  .post_shutdown(on_shutdown)
                   .build())
 
+    # Відсіювання повторних і застарілих оновлень перед усіма обробниками
+    application.add_handler(TypeHandler(Update, track_handler(filter_update)), group=-1)
+    # Після всіх обробників: оновлення позначається обробленим лише тепер
+    application.add_handler(TypeHandler(Update, mark_update_processed), group=UPDATE_DONE_GROUP)
+
     # Додавання обробників команд
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("broadcast", broadcast))
-    application.add_handler(CommandHandler("stats", stats))
-    application.add_handler(CallbackQueryHandler(button_callback))
-    application.add_handler(MessageHandler(filters.CONTACT, handle_contact))
+    application.add_handler(CommandHandler("start", track_handler(start)))
+    application.add_handler(CommandHandler("broadcast", track_handler(broadcast)))
+    application.add_handler(CommandHandler("broadcast_pause", track_handler(broadcast_pause)))
+    application.add_handler(CommandHandler("broadcast_resume", track_handler(broadcast_resume)))
+    application.add_handler(CommandHandler("broadcast_cancel", track_handler(broadcast_cancel)))
+    application.add_handler(CommandHandler("broadcast_jobs", track_handler(broadcast_jobs)))
+    application.add_handler(CommandHandler("stats", track_handler(stats)))
+    application.add_handler(CommandHandler("history", track_handler(history)))
+    application.add_handler(CommandHandler("funnel", track_handler(funnel)))
+    application.add_handler(CallbackQueryHandler(track_handler(button_callback)))
+    application.add_handler(MessageHandler(filters.CONTACT, track_handler(handle_contact)))
+    application.add_handler(ChatMemberHandler(track_handler(channel_member_update), ChatMemberHandler.CHAT_MEMBER))
+
+    if BOT_MODE == "webhook":
+        # Кожен інстанс реєструє webhook при старті, тож секрет має бути спільним:
+        # випадковий секрет кожного інстансу перезаписав би секрет інших
+        if WEBHOOK_URL and not WEBHOOK_SECRET:
+            logger.error("WEBHOOK_URL задано без WEBHOOK_SECRET: задайте однаковий секрет для всіх інстансів")
+            exit(1)
+        logger.info("Запуск бота в режимі webhook")
+        asyncio.run(run_webhook(application))
+        exit(0)
 
-    # Запуск бота з повторною спробою при конфлікті
+    # Запуск бота з повторною спробою при конфлікті.
+    # Long polling допускає лише один інстанс; для кількох інстансів використовуйте BOT_MODE=webhook.
     max_retries = 3
     for attempt in range(max_retries):
         try:
@@ -310,7 +445,9 @@ if __name__ == "__main__":
                 time.sleep(10 + attempt * 5)
             
             # Запускаємо бот
-            application.run_polling(drop_pending_updates=True)
+            # chat_member не надходить без явного allowed_updates
+            # Черга оновлень за час простою дочитується; повтори відсікає filter_update
+            application.run_polling(drop_pending_updates=DROP_PENDING_UPDATES, allowed_updates=Update.ALL_TYPES)
             break
             
         except Conflict as e:
@@ -0,0 +1,119 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from telegram.error import BadRequest
+from database import run_db, get_media_file_id, save_media_file_id, delete_media_file_id
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Як часто перевіряти (os.stat), чи змінився файл на диску
+MEDIA_CHECK_INTERVAL = float(os.getenv("MEDIA_CHECK_INTERVAL", "60"))
+MEDIA_MIN_SIZE = 1000  # менші файли вважаємо заглушками і не надсилаємо
+
+# Відповіді Bot API, після яких збережений file_id більше не можна використати
+STALE_FILE_ID_ERRORS = ("wrong file identifier", "wrong remote file identifier", "file reference expired")
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(65536), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class MediaRegistry:
+    """Реєстр file_id для локальних файлів, які бот надсилає повторно.
+
+    Файл завантажується в Telegram лише один раз: отриманий file_id зберігається
+    в таблиці media_files за sha256 вмісту і далі надсилається замість файлу.
+    Ключ за хешем робить інвалідацію автоматичною: змінений файл має інший хеш,
+    тож буде завантажений заново. Диск перевіряється не частіше MEDIA_CHECK_INTERVAL
+    секунд (за mtime і розміром), хеш перераховується лише коли вони змінились.
+    """
+
+    def __init__(self, check_interval=MEDIA_CHECK_INTERVAL, min_size=MEDIA_MIN_SIZE):
+        self.check_interval = check_interval
+        self.min_size = min_size
+        self._files = {}  # path -> {'checked': monotonic, 'stat': (mtime, size) | None, 'hash': str | None}
+        self._file_ids = {}  # content_hash -> file_id
+        self._locks = {}  # content_hash -> asyncio.Lock (одне завантаження на файл)
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_size <= self.min_size:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    async def _content_hash(self, path):
+        """sha256 файлу або None, якщо файлу немає чи він замалий."""
+        now = time.monotonic()
+        entry = self._files.get(path)
+        if entry is not None and now - entry['checked'] < self.check_interval:
+            return entry['hash']
+        stat = self._stat(path)
+        if entry is not None and entry['stat'] == stat:
+            entry['checked'] = now
+            return entry['hash']
+        content_hash = await asyncio.to_thread(_file_sha256, path) if stat is not None else None
+        self._files[path] = {'checked': now, 'stat': stat, 'hash': content_hash}
+        return content_hash
+
+    async def _file_id(self, content_hash):
+        file_id = self._file_ids.get(content_hash)
+        if file_id is None:
+            file_id = await run_db(get_media_file_id, content_hash)
+            if file_id is not None:
+                self._file_ids[content_hash] = file_id
+        return file_id
+
+    async def _forget(self, content_hash, file_id):
+        if self._file_ids.get(content_hash) == file_id:
+            del self._file_ids[content_hash]
+        await run_db(delete_media_file_id, content_hash, file_id)
+
+    async def send_photo(self, bot, chat_id, path, **kwargs):
+        """Надсилає фото з файлу path, за можливості — за збереженим file_id.
+
+        Повертає Message або None, якщо файлу немає (тоді викликач надсилає текстовий варіант).
+        """
+        content_hash = await self._content_hash(path)
+        if content_hash is None:
+            return None
+        file_id = await self._file_id(content_hash)
+        if file_id is not None:
+            try:
+                return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+            except BadRequest as e:
+                message = str(e).lower()
+                if not any(error in message for error in STALE_FILE_ID_ERRORS):
+                    # Помилка не стосується файлу (напр., чат не знайдено) — file_id лишається дійсним
+                    raise
+                # file_id став недійсним (напр., інший токен бота) — завантажуємо заново
+                logger.warning(f"file_id для {path} не прийнято ({e}), завантажую файл повторно")
+                await self._forget(content_hash, file_id)
+
+        lock = self._locks.setdefault(content_hash, asyncio.Lock())
+        async with lock:
+            # Поки чекали, файл міг завантажити інший обробник
+            cached = self._file_ids.get(content_hash)
+            if cached is not None and cached != file_id:
+                return await bot.send_photo(chat_id=chat_id, photo=cached, **kwargs)
+            with open(path, "rb") as photo:
+                message = await bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+            if message.photo:
+                new_file_id = message.photo[-1].file_id
+                self._file_ids[content_hash] = new_file_id
+                await run_db(save_media_file_id, content_hash, new_file_id, path)
+                logger.info(f"Файл {path} завантажено в Telegram, file_id збережено")
+            return message
+
+
+# Спільний екземпляр для обробників
+media_registry = MediaRegistry()
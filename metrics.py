@@ -0,0 +1,244 @@
+import os
+import time
+import bisect
+import logging
+import functools
+import threading
+import tornado.web
+from telegram.ext import ApplicationHandlerStop
+from telegram.request import HTTPXRequest
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Параметри локального HTTP-ендпоінта /metrics
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # 0 — не запускати
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")  # лише локально; для Prometheus в іншому хості задайте 0.0.0.0
+
+# Межі кошиків гістограм латентності, секунд
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Метрика з мітками; значення зберігаються за кортежем значень міток."""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {_escape(self.documentation)}", f"# TYPE {self.name} {self.type}"]
+        for name, key, value in self._samples():
+            lines.append(f"{name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Поточне значення: задається set() або обчислюється функцією під час збору метрик."""
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, func, **labels):
+        self._functions[self._key(labels)] = func
+
+    def _samples(self):
+        values = {}
+        for key, func in list(self._functions.items()):
+            try:
+                values[key] = func()
+            except Exception as e:
+                logger.warning(f"Метрика {self.name}{dict(zip(self.labelnames, key))}: {e}")
+        with self._lock:
+            values.update(self._values)
+        return [(self.name, key, value) for key, value in sorted(values.items()) if value is not None]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # [кількість у кожному кошику + в +Inf, сума, кількість]
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {_escape(self.documentation)}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = [(key, list(entry[0]), entry[1], entry[2]) for key, entry in sorted(self._values.items())]
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+handler_seconds = Histogram("bot_handler_seconds", "Час обробки оновлення обробником", ["handler", "outcome"])
+db_seconds = Histogram("bot_db_seconds", "Час виклику функції database.py через run_db (з очікуванням потоку)", ["function", "outcome"])
+bot_api_seconds = Histogram("bot_api_request_seconds", "Час HTTP-запиту до Bot API", ["method", "code"])
+broadcast_messages = Counter("bot_broadcast_messages_total", "Результати відправки повідомлень розсилки", ["outcome"])
+broadcast_throttled = Counter("bot_broadcast_throttled_total", "Відповіді RetryAfter під час розсилки")
+broadcast_rate = Gauge("bot_broadcast_rate", "Поточний ліміт швидкості розсилки, повідомлень/с")
+cache_lookups = Counter("bot_cache_lookups_total", "Звернення до локальних кешів", ["cache", "result"])
+queue_size = Gauge("bot_queue_size", "Кількість елементів у черзі", ["queue"])
+db_pool_connections = Gauge("bot_db_pool_connections", "З'єднання пулу БД", ["state"])
+
+
+def track_handler(callback):
+    """Обгортка обробника PTB, що пише його латентність у bot_handler_seconds."""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            outcome = "stopped"  # напр., filter_update відсіяв повтор
+            raise
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, handler=name, outcome=outcome)
+
+    return wrapper
+
+
+class MetricsRequest(HTTPXRequest):
+    """HTTPXRequest, що пише час і HTTP-код кожного запиту до Bot API.
+
+    Код — статус відповіді (429, 403, ...), або назва винятку, якщо відповіді немає
+    (TimedOut, NetworkError). Метод — остання частина URL (sendMessage, getUpdates).
+    """
+
+    async def do_request(self, url, *args, **kwargs):
+        method = "file" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, *args, **kwargs)
+        except Exception as e:
+            bot_api_seconds.observe(time.perf_counter() - started, method=method, code=type(e).__name__)
+            raise
+        bot_api_seconds.observe(time.perf_counter() - started, method=method, code=str(code))
+        return code, payload
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """GET /metrics у текстовому форматі Prometheus."""
+
+    def initialize(self, registry):
+        self.registry = registry
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(self.registry.render())
+
+
+class MetricsServer:
+    """Локальний HTTP-сервер з /metrics (tornado), працює в циклі подій бота."""
+
+    def __init__(self, listen=METRICS_LISTEN, port=METRICS_PORT, registry=REGISTRY):
+        self.listen = listen
+        self.port = port
+        self.registry = registry
+        self._server = None
+
+    def start(self):
+        if self.port <= 0 or self._server is not None:
+            return
+        app = tornado.web.Application([("/metrics", MetricsHandler, dict(registry=self.registry))])
+        try:
+            self._server = app.listen(self.port, address=self.listen)
+        except OSError as e:
+            # Напр., порт зайнятий іншим процесом на цьому хості — бот працює і без метрик
+            logger.error(f"Не вдалося запустити /metrics на {self.listen}:{self.port}: {e}")
+            return
+        logger.info(f"Метрики доступні на http://{self.listen}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server is None:
+            return
+        self._server.stop()
+        await self._server.close_all_connections()
+        self._server = None
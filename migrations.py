@@ -0,0 +1,60 @@
+import os
+import asyncio
+import logging
+from database import run_db, run_background_migration_batch, pending_background_migrations
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Параметри фонових міграцій даних
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "1000"))  # рядків в одній транзакції
+MIGRATION_BATCH_PAUSE = float(os.getenv("MIGRATION_BATCH_PAUSE", "0.2"))  # пауза між пачками, щоб не заважати обробникам
+MIGRATION_RETRY_DELAY = 30
+
+
+class BackgroundMigrations:
+    """Виконує фонові міграції даних, що лишились після init_db, невеликими пачками.
+
+    Кожна пачка — окрема коротка транзакція, тож блокування не тримаються довго.
+    Після перезапуску міграція починається спочатку, але вже перенесені рядки
+    пропускаються умовою в самій міграції. Завершена міграція записується в
+    schema_migrations і більше не запускається.
+    """
+
+    def __init__(self, migrations=None, batch_size=MIGRATION_BATCH_SIZE, pause=MIGRATION_BATCH_PAUSE):
+        self.migrations = migrations if migrations is not None else pending_background_migrations
+        self.batch_size = batch_size
+        self.pause = pause
+        self._task = None
+
+    def start(self):
+        if self._task is None and self.migrations:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while self.migrations:
+            version, name, migrate = self.migrations[0]
+            logger.info(f"Фонова міграція {version} ({name}): старт")
+            after_key, batches = None, 0
+            while True:
+                result = await run_db(run_background_migration_batch, version, name, migrate, after_key, self.batch_size)
+                if result is None:
+                    await asyncio.sleep(MIGRATION_RETRY_DELAY)
+                    continue
+                after_key, done = result
+                batches += 1
+                if done:
+                    break
+                await asyncio.sleep(self.pause)
+            self.migrations.pop(0)
+            logger.info(f"Фонова міграція {version} ({name}) завершена ({batches} пачок)")
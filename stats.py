@@ -0,0 +1,93 @@
+import os
+import asyncio
+import logging
+from datetime import timezone
+from telegram import Update
+from telegram.ext import ContextTypes
+from broadcast import ADMIN_ID
+from database import run_db, get_user_stats, get_user_stats_async, recount_user_stats
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Як часто звіряти лічильники статистики з точним підрахунком по users
+STATS_RECOUNT_INTERVAL = float(os.getenv("STATS_RECOUNT_INTERVAL", "86400"))
+
+
+def _percent(part, whole):
+    return f"{part / whole * 100:.1f}%" if whole else "—"
+
+
+class StatsRecount:
+    """Періодичний точний перерахунок лічильників user_stats_counters.
+
+    Лічильники оновлює тригер на users, тож розходитися з реальністю вони можуть
+    лише після ручних змін в обхід тригера (напр., TRUNCATE чи відновлення з бекапу).
+    Перерахунок робить один прохід по users зі знімка, не блокуючи записи, і логує
+    знайдену розбіжність. Одразу після міграції лічильники ще не перераховані — тоді
+    перший перерахунок виконується при старті задачі.
+    """
+
+    def __init__(self, interval=STATS_RECOUNT_INTERVAL):
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        current = await run_db(get_user_stats)
+        if current is None or current['recounted_at'] is not None:
+            await asyncio.sleep(self.interval)
+        while True:
+            try:
+                drift = await run_db(recount_user_stats)
+                if drift is not None and any(drift.values()):
+                    logger.warning(f"Лічильники статистики розійшлися з users і виправлені: {drift}")
+                elif drift is not None:
+                    logger.info("Лічильники статистики звірено, розбіжностей немає")
+            except Exception as e:
+                logger.error(f"Помилка звірки лічильників статистики: {e}")
+            await asyncio.sleep(self.interval)
+
+
+# Обробник команди /stats: читає лише лічильники й підсумки розсилок, тож час
+# відповіді не залежить від кількості користувачів
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("Ця команда доступна лише адміністратору!")
+        return
+
+    stats_data = await get_user_stats_async()
+    if stats_data is None:
+        await update.message.reply_text("Помилка: не вдалося отримати статистику")
+        return
+    total = stats_data['total']
+    with_contact = stats_data['with_contact']
+    subscribed = stats_data['subscribed']
+    attempted = stats_data['broadcast_sent'] + stats_data['broadcast_blocked'] + stats_data['broadcast_errors']
+    recounted_at = stats_data['recounted_at']
+    await update.message.reply_text(
+        f"Статистика користувачів:\n\n"
+        f"Загальна кількість: {total}\n"
+        f"Поділилися контактом: {with_contact} ({_percent(with_contact, total)})\n"
+        f"Підписані на канал: {subscribed} ({_percent(subscribed, total)} від усіх, "
+        f"{_percent(subscribed, with_contact)} від тих, хто дав контакт)\n"
+        f"Заблоковані: {stats_data['blocked']} ({_percent(stats_data['blocked'], total)})\n\n"
+        f"Розсилки ({stats_data['broadcasts']}):\n"
+        f"Доставлено: {stats_data['broadcast_sent']} ({_percent(stats_data['broadcast_sent'], attempted)})\n"
+        f"Заблокували бота: {stats_data['broadcast_blocked']}\n"
+        f"Помилки: {stats_data['broadcast_errors']}\n\n"
+        f"Точний перерахунок: {f'{recounted_at.astimezone(timezone.utc):%Y-%m-%d %H:%M} UTC' if recounted_at else '—'}"
+    )
@@ -0,0 +1,101 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from metrics import cache_lookups
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Параметри кешу перевірок підписки
+SUBSCRIPTION_POSITIVE_TTL = float(os.getenv("SUBSCRIPTION_POSITIVE_TTL", "300"))  # скільки секунд вірити "підписаний"
+SUBSCRIPTION_NEGATIVE_TTL = float(os.getenv("SUBSCRIPTION_NEGATIVE_TTL", "10"))  # і "не підписаний" (коротко: користувач може саме підписуватись)
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "50000"))
+
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator")
+
+
+class SubscriptionCache:
+    """Кеш статусів користувачів у каналі поверх get_chat_member.
+
+    Позитивні й негативні результати живуть різний час (positive_ttl / negative_ttl).
+    Одночасні перевірки одного користувача чекають на один спільний запит.
+    Помилки Telegram не кешуються і передаються кожному, хто чекав.
+    Оновлення chat_member передаються через set(), тож кеш не відстає від каналу.
+    Влучання й промахи рахуються в bot_cache_lookups_total{cache="subscription"}.
+    """
+
+    def __init__(self, chat_id, positive_ttl=SUBSCRIPTION_POSITIVE_TTL,
+                 negative_ttl=SUBSCRIPTION_NEGATIVE_TTL, max_size=SUBSCRIPTION_CACHE_SIZE):
+        self.chat_id = chat_id
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # user_id -> (status, expires_at)
+        self._inflight = {}  # user_id -> asyncio.Task
+        self._generation = {}  # user_id -> лічильник інвалідацій під час запиту
+
+    def _ttl(self, status):
+        return self.positive_ttl if status in SUBSCRIBED_STATUSES else self.negative_ttl
+
+    def _cached(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        status, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[user_id]
+            return None
+        return status
+
+    def set(self, user_id, status):
+        """Записує відомий статус (напр., з оновлення chat_member)."""
+        self._bump(user_id)
+        self._store(user_id, status)
+
+    def clear(self):
+        for user_id in self._inflight:
+            self._bump(user_id)
+        self._entries.clear()
+
+    def _bump(self, user_id):
+        # Результат запиту, що вже летить, застарів — не записуємо його в кеш
+        if user_id in self._inflight:
+            self._generation[user_id] = self._generation.get(user_id, 0) + 1
+
+    def _store(self, user_id, status):
+        self._entries[user_id] = (status, time.monotonic() + self._ttl(status))
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def _fetch(self, bot, user_id):
+        generation = self._generation.get(user_id, 0)
+        try:
+            member = await bot.get_chat_member(self.chat_id, user_id)
+            if self._generation.get(user_id, 0) == generation:
+                self._store(user_id, member.status)
+            return member.status
+        finally:
+            self._inflight.pop(user_id, None)
+            self._generation.pop(user_id, None)
+
+    async def get_status(self, bot, user_id):
+        """Статус користувача в каналі (member, left, kicked, ...). Помилки Telegram пробрасуються."""
+        status = self._cached(user_id)
+        if status is not None:
+            cache_lookups.inc(cache="subscription", result="hit")
+            return status
+        cache_lookups.inc(cache="subscription", result="miss")
+        task = self._inflight.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._fetch(bot, user_id))
+            # Помилку забираємо тут, навіть якщо всі, хто чекав, уже скасовані
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight[user_id] = task
+        # shield: скасування одного з тих, хто чекає, не скасовує спільний запит
+        return await asyncio.shield(task)
+
+    async def is_subscribed(self, bot, user_id):
+        return await self.get_status(bot, user_id) in SUBSCRIBED_STATUSES
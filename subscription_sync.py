@@ -0,0 +1,156 @@
+import os
+import asyncio
+import logging
+from telegram.error import TelegramError, RetryAfter
+from database import run_db, fetch_subscription_page, sample_subscription_states, set_subscription_statuses
+from broadcast_engine import TokenBucket
+from subscription_cache import SUBSCRIBED_STATUSES
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Параметри фонової звірки підписок з каналом
+SUBSCRIPTION_RECONCILE_INTERVAL = float(os.getenv("SUBSCRIPTION_RECONCILE_INTERVAL", "21600"))  # секунд між звірками, 0 — вимкнено
+SUBSCRIPTION_RECONCILE_SAMPLE = int(os.getenv("SUBSCRIPTION_RECONCILE_SAMPLE", "0"))  # скільки випадкових користувачів перевіряти, 0 — усіх
+SUBSCRIPTION_RECONCILE_RATE = float(os.getenv("SUBSCRIPTION_RECONCILE_RATE", "5"))  # запитів get_chat_member на секунду (решта ліміту — розсилкам)
+SUBSCRIPTION_RECONCILE_WORKERS = int(os.getenv("SUBSCRIPTION_RECONCILE_WORKERS", "4"))
+SUBSCRIPTION_RECONCILE_BATCH = int(os.getenv("SUBSCRIPTION_RECONCILE_BATCH", "500"))  # змін в одному UPDATE
+SUBSCRIPTION_RECONCILE_MAX_RETRIES = 3
+
+
+class SubscriptionReconciler:
+    """Фонова звірка users.is_subscribed зі статусами в каналі.
+
+    Оновлення chat_member тримають статус актуальним між звірками; звірка виправляє
+    пропущені оновлення (простій бота, зміни до того, як бот став адміністратором).
+    Користувачі перевіряються паралельно під спільним лімітом швидкості, а змінені
+    статуси записуються пачками одним UPDATE.
+    """
+
+    def __init__(self, bot, chat_id, cache=None, interval=SUBSCRIPTION_RECONCILE_INTERVAL,
+                 sample=SUBSCRIPTION_RECONCILE_SAMPLE, rate=SUBSCRIPTION_RECONCILE_RATE,
+                 workers=SUBSCRIPTION_RECONCILE_WORKERS, batch_size=SUBSCRIPTION_RECONCILE_BATCH):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.cache = cache
+        self.interval = interval
+        self.sample = sample
+        self.rate = rate
+        self.workers = workers
+        self.batch_size = batch_size
+        self._task = None
+
+    def start(self):
+        if self.interval <= 0 or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Звірку підписок запущено (кожні {self.interval}s, {self.rate} запитів/с)")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reconcile(self.sample)
+            except Exception as e:
+                logger.error(f"Помилка звірки підписок: {e}")
+
+    async def _states(self, sample):
+        if sample:
+            rows = await run_db(sample_subscription_states, sample)
+            if rows is None:
+                raise RuntimeError("Не вдалося вибрати користувачів для звірки")
+            for row in rows:
+                yield row
+            return
+        after_user_id = None
+        while True:
+            page = await run_db(fetch_subscription_page, after_user_id, 1000)
+            if page is None:
+                raise RuntimeError(f"Не вдалося завантажити користувачів після user_id={after_user_id}")
+            for row in page:
+                yield row
+            if len(page) < 1000:
+                return
+            after_user_id = page[-1][0]
+
+    async def _check(self, bucket, user_id):
+        """Поточний статус у каналі або None, якщо перевірити не вдалося."""
+        for _ in range(SUBSCRIPTION_RECONCILE_MAX_RETRIES):
+            await bucket.acquire()
+            try:
+                member = await self.bot.get_chat_member(self.chat_id, user_id)
+                return member.status
+            except RetryAfter as e:
+                bucket.pause(e.retry_after)
+            except TelegramError as e:
+                logger.warning(f"Звірка: не вдалося перевірити {user_id}: {e}")
+                return None
+        return None
+
+    async def reconcile(self, sample=0):
+        """Одна звірка: усі користувачі або sample випадкових. Повертає лічильники."""
+        bucket = TokenBucket(self.rate)
+        queue = asyncio.Queue(maxsize=self.workers * 2)
+        changes = []
+        stats = {'checked': 0, 'changed': 0, 'errors': 0}
+
+        async def flush():
+            if not changes:
+                return
+            batch = changes[:]
+            changes.clear()
+            if await run_db(set_subscription_statuses, batch):
+                stats['changed'] += len(batch)
+            else:
+                stats['errors'] += len(batch)
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                user_id, is_subscribed = item
+                status = await self._check(bucket, user_id)
+                if status is None:
+                    stats['errors'] += 1
+                    continue
+                stats['checked'] += 1
+                if self.cache is not None:
+                    self.cache.set(user_id, status)
+                subscribed = status in SUBSCRIBED_STATUSES
+                if subscribed != bool(is_subscribed):
+                    changes.append((user_id, subscribed))
+                    if len(changes) >= self.batch_size:
+                        await flush()
+
+        logger.info(f"Звірка підписок: старт ({'вибірка ' + str(sample) if sample else 'усі користувачі'})")
+        tasks = [asyncio.create_task(worker()) for _ in range(self.workers)]
+        try:
+            async for row in self._states(sample):
+                await queue.put(row)
+            for _ in tasks:
+                await queue.put(None)
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Помилка читання чи зупинка: зупиняємо перевірки, але вже знайдені зміни записуємо
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            await flush()
+        logger.info(
+            f"Звірка підписок завершена: перевірено {stats['checked']}, "
+            f"змінено {stats['changed']}, помилок {stats['errors']}"
+        )
+        return stats
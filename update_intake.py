@@ -0,0 +1,189 @@
+import os
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timezone
+from telegram import Update
+from telegram.error import BadRequest
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+from database import run_db, is_update_processed, max_processed_update_id, mark_updates_processed, prune_processed_updates
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Параметри прийому оновлень після перезапуску
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "0") == "1"  # відкидати чергу оновлень при старті (стара поведінка)
+UPDATE_MAX_MESSAGE_AGE = float(os.getenv("UPDATE_MAX_MESSAGE_AGE", "0"))  # пропускати повідомлення, старші за N секунд; 0 — обробляти всі
+PROCESSED_UPDATES_KEEP = float(os.getenv("PROCESSED_UPDATES_KEEP", "172800"))  # скільки секунд пам'ятати оброблені update_id
+PROCESSED_UPDATES_PRUNE_INTERVAL = float(os.getenv("PROCESSED_UPDATES_PRUNE_INTERVAL", "3600"))
+PROCESSED_UPDATES_BATCH_SIZE = int(os.getenv("PROCESSED_UPDATES_BATCH_SIZE", "200"))  # записуємо оброблені update_id пачками
+PROCESSED_UPDATES_FLUSH_INTERVAL = float(os.getenv("PROCESSED_UPDATES_FLUSH_INTERVAL", "1.0"))
+PROCESSED_UPDATES_RECENT = 10000  # скільки останніх update_id пам'ятати в процесі
+UPDATE_DONE_GROUP = 100  # група обробника, що позначає оновлення обробленим (після всіх інших)
+
+
+class ProcessedUpdates:
+    """Облік оброблених update_id для доставки «щонайменше раз».
+
+    Оновлення позначається обробленим лише після того, як відпрацювали всі обробники,
+    тож якщо процес впав посеред обробки, Telegram доставить його знову і воно
+    обробиться повторно (обробники мають бути ідемпотентними: upsert-и, ON CONFLICT).
+    Позначки пишуться в processed_updates пачками у фоні, без окремого запиту на кожне оновлення.
+
+    Повтори можливі лише для оновлень, доставлених до перезапуску, тобто з update_id не
+    більшим за найбільший записаний при старті; лише їх перевіряємо в БД. Повтори нових
+    оновлень у межах процесу відсікає пам'ять останніх update_id.
+    """
+
+    def __init__(self, batch_size=PROCESSED_UPDATES_BATCH_SIZE, flush_interval=PROCESSED_UPDATES_FLUSH_INTERVAL,
+                 recent_size=PROCESSED_UPDATES_RECENT):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.replay_until = None  # update_id, до якого оновлення могли бути оброблені до старту
+        self._recent = set()
+        self._recent_order = deque()
+        self._recent_size = recent_size
+        self._pending = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+    async def start(self):
+        if self._task is not None:
+            return
+        self.replay_until = await run_db(max_processed_update_id)
+        if self.replay_until is None:
+            # Не знаємо, що вже оброблено, — перевіряємо в БД кожне оновлення
+            self.replay_until = float("inf")
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    async def seen(self, update_id):
+        """True, якщо оновлення вже обробляється чи оброблене; інакше бере його в роботу."""
+        if update_id in self._recent:
+            return True
+        if self.replay_until is None or update_id <= self.replay_until:
+            if await run_db(is_update_processed, update_id):
+                return True
+        self._remember(update_id)
+        return False
+
+    def mark(self, update_id):
+        self._pending.append(update_id)
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def _remember(self, update_id):
+        self._recent.add(update_id)
+        self._recent_order.append(update_id)
+        if len(self._recent_order) > self._recent_size:
+            self._recent.discard(self._recent_order.popleft())
+
+    async def flush(self):
+        if not self._pending:
+            return
+        update_ids, self._pending = self._pending, []
+        if not await run_db(mark_updates_processed, update_ids):
+            logger.error(f"Не вдалося позначити оброблені оновлення: {len(update_ids)}")
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Помилка запису оброблених оновлень: {e}")
+        await self.flush()
+
+
+processed_updates = ProcessedUpdates()
+
+
+def _message_age(update):
+    """Вік повідомлення в секундах або None, якщо в оновленні немає дати."""
+    message = update.message or update.edited_message
+    if message is None:
+        return None
+    sent_at = (message.edit_date or message.date) if update.edited_message else message.date
+    if sent_at is None:
+        return None
+    return (datetime.now(timezone.utc) - sent_at).total_seconds()
+
+
+# Обробник групи -1: виконується перед усіма іншими для кожного оновлення.
+# ApplicationHandlerStop зупиняє подальшу обробку оновлення.
+async def filter_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await processed_updates.seen(update.update_id):
+        logger.info(f"Оновлення {update.update_id} вже оброблено, пропускаю")
+        raise ApplicationHandlerStop
+    if UPDATE_MAX_MESSAGE_AGE > 0:
+        age = _message_age(update)
+        if age is not None and age > UPDATE_MAX_MESSAGE_AGE:
+            logger.info(f"Оновлення {update.update_id} застаріле ({int(age)}с), пропускаю")
+            processed_updates.mark(update.update_id)
+            raise ApplicationHandlerStop
+
+
+# Обробник групи UPDATE_DONE_GROUP: виконується після всіх обробників оновлення
+# (PTB переходить до наступної групи і після винятку в обробнику)
+async def mark_update_processed(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    processed_updates.mark(update.update_id)
+
+
+async def answer_callback(query):
+    """Відповідає на колбек. False означає, що колбек застарів і обробляти його не варто.
+
+    У колбеків немає дати, тож їхній вік визначає Telegram: на запит, старший
+    приблизно за 15 хвилин (натиснутий під час простою бота), відповісти вже не можна.
+    """
+    try:
+        await query.answer()
+        return True
+    except BadRequest as e:
+        message = str(e).lower()
+        if "query is too old" in message or "query id is invalid" in message:
+            logger.info(f"Колбек {query.data} від {query.from_user.id} застарів, пропускаю")
+            return False
+        raise
+
+
+class ProcessedUpdatesPruner:
+    """Періодично видаляє старі записи processed_updates, щоб таблиця не росла."""
+
+    def __init__(self, keep_seconds=PROCESSED_UPDATES_KEEP, interval=PROCESSED_UPDATES_PRUNE_INTERVAL):
+        self.keep_seconds = keep_seconds
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            deleted = await run_db(prune_processed_updates, self.keep_seconds)
+            if deleted:
+                logger.info(f"Видалено {deleted} старих записів processed_updates")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,62 @@
+import os
+import asyncio
+import logging
+from telegram.ext import BaseUpdateProcessor
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Скільки оновлень обробляється одночасно (для різних користувачів)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Паралельна обробка оновлень зі збереженням порядку в межах одного користувача.
+
+    Оновлення різних користувачів обробляються одночасно (не більше max_concurrent_updates),
+    тож повільний get_chat_member чи запис у БД одного користувача не затримує інших.
+    Оновлення одного користувача (/start → контакт → колбек) виконуються строго по черзі.
+    Черга користувача чекає до того, як займе слот, тож один активний користувач
+    не може зайняти всі слоти.
+    """
+
+    def __init__(self, max_concurrent_updates=UPDATE_CONCURRENCY):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}  # ключ -> [asyncio.Lock, кількість оновлень у черзі]
+
+    @staticmethod
+    def _key(update):
+        user = getattr(update, "effective_user", None)
+        if user is not None:
+            return user.id
+        chat = getattr(update, "effective_chat", None)
+        if chat is not None:
+            return chat.id
+        return None
+
+    async def process_update(self, update, coroutine):
+        key = self._key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # Lock віддає себе очікувачам у порядку надходження (FIFO)
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,103 @@
+import os
+import hmac
+import json
+import logging
+import tornado.web
+from telegram import Update
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Параметри режиму webhook
+WEBHOOK_PORT = int(os.getenv("PORT", os.getenv("WEBHOOK_PORT", "8443")))  # PORT задає хостинг (Heroku/Railway)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публічна адреса без шляху; якщо не задана, webhook у Telegram не реєструється (локальне тестування)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # X-Telegram-Bot-Api-Secret-Token, символи A-Z a-z 0-9 _ -
+# Без секрету оновлення не перевіряються, тож сервер за замовчуванням доступний лише локально
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0" if WEBHOOK_SECRET else "127.0.0.1")
+LOOPBACK_ADDRESSES = ("127.0.0.1", "::1", "localhost")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # одночасних з'єднань від Telegram (1-100)
+
+
+class TelegramUpdateHandler(tornado.web.RequestHandler):
+    """Приймає оновлення від Telegram і кладе їх у чергу Application."""
+
+    def initialize(self, application, secret_token):
+        self.application_ptb = application
+        self.secret_token = secret_token
+
+    async def post(self):
+        if self.secret_token is not None:
+            received = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(received, self.secret_token):
+                logger.warning(f"Webhook: запит з невірним секретним токеном від {self.request.remote_ip}")
+                raise tornado.web.HTTPError(403)
+        try:
+            data = json.loads(self.request.body)
+            update = Update.de_json(data, self.application_ptb.bot)
+        except Exception as e:
+            logger.warning(f"Webhook: не вдалося розібрати оновлення: {e}")
+            raise tornado.web.HTTPError(400)
+        if update is None:
+            raise tornado.web.HTTPError(400)
+        await self.application_ptb.update_queue.put(update)
+        self.set_status(200)
+
+    def log_exception(self, typ, value, tb):
+        # HTTPError (403/400) вже залоговано вище
+        if not isinstance(value, tornado.web.HTTPError):
+            super().log_exception(typ, value, tb)
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    """GET /healthz: 200, якщо Application приймає оновлення, інакше 503."""
+
+    def initialize(self, application):
+        self.application_ptb = application
+
+    def get(self):
+        running = self.application_ptb.running
+        self.set_status(200 if running else 503)
+        self.write({
+            "status": "ok" if running else "stopped",
+            "update_queue": self.application_ptb.update_queue.qsize(),
+        })
+
+
+class WebhookServer:
+    """Локальний HTTP-сервер режиму webhook (tornado з python-telegram-bot[webhooks]).
+
+    WEBHOOK_PATH приймає оновлення, /healthz — перевірка для балансувальника/хостингу.
+    Для локального тестування без WEBHOOK_URL можна надсилати записані оновлення:
+    curl -X POST -H 'Content-Type: application/json' -d @update.json localhost:8443/telegram
+    """
+
+    def __init__(self, application, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT,
+                 path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET, handlers=None):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.extra_handlers = handlers or []
+        self._server = None
+
+    def start(self):
+        if not self.secret_token and self.listen not in LOOPBACK_ADDRESSES:
+            # Інакше будь-хто з доступом до порту може надіслати підроблене оновлення від імені адміністратора
+            raise RuntimeError(f"Webhook-сервер без WEBHOOK_SECRET можна запускати лише на 127.0.0.1, а не на {self.listen}")
+        app = tornado.web.Application([
+            (self.path, TelegramUpdateHandler, dict(application=self.application, secret_token=self.secret_token)),
+            ("/healthz", HealthHandler, dict(application=self.application)),
+            *self.extra_handlers,
+        ])
+        self._server = app.listen(self.port, address=self.listen)
+        logger.info(f"Webhook-сервер слухає {self.listen}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._server is None:
+            return
+        self._server.stop()
+        await self._server.close_all_connections()
+        self._server = None
+        logger.info("Webhook-сервер зупинено")